@@ -0,0 +1,107 @@
+import bisect
+import mmap
+import os
+import threading
+import time
+import zlib
+
+class CaptureEntry(object):
+    """ One index entry: when it was captured, what kind of entry it is
+    ("output" for a command's output, "cycle" for the end of a cycle), the
+    command (or for a cycle, "full" or "fast"), and where its compressed
+    data is.
+    """
+    __slots__ = ("timestamp", "kind", "command", "offset", "length")
+
+    def __init__(self, timestamp, kind, command, offset, length):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.command = command
+        self.offset = offset
+        self.length = length
+
+class CaptureStore:
+    """ Append-only store of captured command output, for replaying the
+    daemon's cycles offline.
+
+    Everything goes into one data file, each entry compressed as its own
+    gzip member (so the whole file still reads with zcat), and a text
+    index with one line per entry, in the order they were captured:
+    "timestamp\\tkind\\toffset\\tlength\\tcommand".
+
+    Both files are opened for each entry written, rather than held open,
+    since daemonising closes everything it isn't told about. For reading,
+    the data file is memory-mapped, and entries are only decompressed when
+    they're asked for.
+    """
+
+    data_filename = "captures.gz"
+    index_filename = "captures.index"
+    compression_level = 6
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_path = os.path.join(directory, self.data_filename)
+        self.index_path = os.path.join(directory, self.index_filename)
+        self.lock = threading.Lock()
+        self.data_map = None
+
+    def record(self, kind, command, output, timestamp=None):
+        """ Compresses and appends one entry.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        # ^-- 16+ for a gzip header and trailer
+        data = compressor.compress(output) + compressor.flush()
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self.data_path, "ab") as data_file:
+                data_file.seek(0, os.SEEK_END)
+                offset = data_file.tell()
+                data_file.write(data)
+            with open(self.index_path, "a") as index_file:
+                index_file.write("%.6f\t%s\t%d\t%d\t%s\n" %
+                                 (timestamp, kind, offset, len(data), command))
+
+    def read_index(self):
+        """ Returns all the entries, as CaptureEntrys, oldest first. Any
+        half-written last line is left out.
+        """
+        entries = list()
+        with open(self.index_path, "r") as index_file:
+            for line in index_file:
+                if not line.endswith("\n"):
+                    break
+                (timestamp, kind, offset, length, command) = line.rstrip("\n").split("\t", 4)
+                entries.append(CaptureEntry(float(timestamp), kind, command,
+                                            int(offset), int(length)))
+        return entries
+
+    def open_for_reading(self):
+        if self.data_map is None:
+            with open(self.data_path, "rb") as data_file:
+                self.data_map = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, entry):
+        """ Decompresses one entry's output.
+        """
+        self.open_for_reading()
+        if entry.offset + entry.length > len(self.data_map):
+            raise IOError("capture entry at %d runs past the end of %s" %
+                          (entry.offset, self.data_path))
+        return zlib.decompress(self.data_map[entry.offset:entry.offset + entry.length],
+                               16 + zlib.MAX_WBITS)
+
+    def close(self):
+        if self.data_map is not None:
+            self.data_map.close()
+            self.data_map = None
+
+    @staticmethod
+    def first_index_at(entries, timestamp):
+        """ Index of the first entry captured at or after timestamp.
+        """
+        return bisect.bisect_left([ x.timestamp for x in entries ], timestamp)
@@ -0,0 +1,127 @@
+class HostResults(object):
+    """ All of one host's passive check results, stored by column rather
+    than as one object per result, since there's one result per host per
+    sensor and the per-object overhead would dominate.
+
+    The service names and units come from the host's evaluation plan
+    (whose entries start with the sensor name and end with its unit), so
+    they're shared by every host using that plan, and the hostname is
+    interned. States are kept one byte each. The output and perfdata text
+    isn't built until a result is serialised: each result just keeps its
+    datum and _nagtxt text, or, with no datum, the whole output text
+    (perfdata included, if there is any).
+
+    Iterating or indexing gives CheckResults.
+    """
+    __slots__ = ("hostname", "plan", "states", "values", "texts", "uncontactable")
+
+    def __init__(self, hostname, plan, states, values, texts, uncontactable=False):
+        self.hostname = hostname
+        self.plan = plan
+        self.states = bytearray(states)
+        self.values = tuple(values)
+        # ^-- None where there's no datum
+        self.texts = tuple(texts)
+        self.uncontactable = uncontactable
+
+    def worst_state(self):
+        if len(self.states) == 0:
+            return 0
+        return max(self.states)
+
+    def services(self):
+        return [ x[0] for x in self.plan ]
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.states)
+        if not 0 <= index < len(self.states):
+            raise IndexError("host result index out of range")
+        return CheckResult(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self.states)):
+            yield CheckResult(self, index)
+
+class CheckResult(object):
+    """ One passive check result, as a view onto its host's HostResults:
+    hostname, service (sensor) name, state, and output, built on demand.
+
+    Still indexes and unpacks like the old message quads,
+    (hostname, service, state, output).
+    """
+    __slots__ = ("host_results", "index")
+
+    def __init__(self, host_results, index):
+        self.host_results = host_results
+        self.index = index
+
+    @property
+    def hostname(self):
+        return self.host_results.hostname
+
+    @property
+    def service(self):
+        return self.host_results.plan[self.index][0]
+
+    @property
+    def state(self):
+        return self.host_results.states[self.index]
+
+    @property
+    def plugin_output(self):
+        """ The output before the "|". """
+        datum = self.host_results.values[self.index]
+        text = self.host_results.texts[self.index]
+        if datum is None:
+            return text.partition("|")[0]
+        if text is not None:
+            return text
+        return "%s%s" % (datum, self.host_results.plan[self.index][-1])
+
+    @property
+    def status_text(self):
+        """ The part of the output whose changing is worth sending a
+        result for: the _nagtxt text, or the whole output (perfdata left
+        off) when there's no datum. A bare datum doesn't count, since it
+        changes nearly every cycle; "" then.
+        """
+        datum = self.host_results.values[self.index]
+        text = self.host_results.texts[self.index]
+        if datum is None:
+            return text.partition("|")[0]
+        if text is not None:
+            return text
+        return ""
+
+    @property
+    def performance_data(self):
+        """ The output after the "|", or "" if there isn't one. """
+        datum = self.host_results.values[self.index]
+        if datum is None:
+            return self.host_results.texts[self.index].partition("|")[2]
+        (service, unit) = (self.host_results.plan[self.index][0],
+                           self.host_results.plan[self.index][-1])
+        return "%s=%s%s" % (service, datum, unit)
+
+    @property
+    def output(self):
+        datum = self.host_results.values[self.index]
+        if datum is None:
+            return self.host_results.texts[self.index]
+        return "%s|%s" % (self.plugin_output, self.performance_data)
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return (self.hostname, self.service, self.state, self.output)[index]
+
+    def __iter__(self):
+        return iter((self.hostname, self.service, self.state, self.output))
+
+    def __repr__(self):
+        return "CheckResult(%r, %r, %r, %r)" % tuple(self)
@@ -35,6 +35,17 @@ class MessageDevice:
                             )
                         )
 
-    def send_message_quads(self, message_quads):
-        self.send_one_message('\n'.join([' '.join([str(y) for y in x]) for x in message_quads]))
+    def send_message_quads(self, message_quads, undelivered=None):
+        separator = ""
+        for message_quad in message_quads:
+            try:
+                self.send_one_message("%s%s %s %d %s" % (separator,
+                                                        message_quad.hostname,
+                                                        message_quad.service,
+                                                        message_quad.state,
+                                                        message_quad.output))
+            except IOError:
+                if undelivered is not None:
+                    undelivered([message_quad])
+            separator = "\n"
         pass
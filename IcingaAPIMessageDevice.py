@@ -0,0 +1,137 @@
+import itertools
+import json
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import Metrics
+
+requests = None
+# ^-- imported when the device's made, since it's slow to import
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already-sorted list.
+    """
+    if len(sorted_values) == 0:
+        return 0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+class MessageDevice:
+    """ Our abstracted messaging device, Icinga2 API implementation.
+
+    Submits passive check results straight to Icinga2's
+    /v1/actions/process-check-result, using the same credentials as
+    IcingaService, so NSCA isn't needed at all. Results are submitted
+    concurrently from a fixed-size pool of threads, sharing one keep-alive
+    session, spread across however many API endpoints are configured.
+    """
+
+    def __init__(self, config, logger, retry_backoff=0.5, results_per_map=100):
+        self.config = config
+        self.logger = logger
+        endpoints = config["icinga_api_endpoints"]
+        if len(endpoints) == 0:
+            endpoints = [ config["icinga_server"] ]
+        self.urls = [ "%s/v1/actions/process-check-result" % x.rstrip("/")
+                      for x in endpoints ]
+        self.timeout = config["icinga_api_timeout"]
+        self.retries = config["icinga_api_retries"]
+        self.retry_backoff = retry_backoff
+        self.workers = config["icinga_api_workers"]
+
+        global requests
+        import requests
+        self.session = None
+        self.pool = None
+        # ^-- both made on first use rather than here, since daemonising
+        #     happens in between and threads (and sockets) don't survive it
+        self.results_per_map = results_per_map * self.workers
+
+    def start(self):
+        self.session = requests.Session()
+        self.session.auth = (self.config["icinga_username"], self.config["icinga_password"])
+        self.session.verify = False
+        # ^-- same as IcingaService
+        self.session.headers.update({ "Accept": "application/json" })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.urls),
+                                                pool_maxsize=self.workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool = ThreadPool(self.workers)
+
+    def make_payload(self, message_quad):
+        payload = { "exit_status": message_quad.state,
+                    "plugin_output": str(message_quad.plugin_output) }
+        perfdata = message_quad.performance_data
+        if perfdata != "":
+            payload["performance_data"] = perfdata.split()
+        return payload
+
+    def send_one_result(self, indexed_quad):
+        """ Posts one result, retrying server errors and connection
+        failures. Returns (seconds taken, whether it was accepted), where
+        None means it never got a response at all.
+        """
+        (index, message_quad) = indexed_quad
+        url = self.urls[index % len(self.urls)]
+        params = { "service": "%s!%s" % (message_quad.hostname, message_quad.service) }
+        data = json.dumps(self.make_payload(message_quad))
+        time_start = time.time()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                response = self.session.post(url, params=params, data=data,
+                                             timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                error = sys.exc_info()[1]
+                continue
+            if response.status_code < 500:
+                break
+            error = "response code %d" % response.status_code
+        else:
+            self.logger.warn("could not submit result for %s: %s" %
+                             (params["service"], error))
+            return (time.time() - time_start, None)
+
+        if response.status_code != 200:
+            self.logger.warn("result for %s rejected: response code %d" %
+                             (params["service"], response.status_code))
+            return (time.time() - time_start, False)
+        return (time.time() - time_start, True)
+
+    def send_message_quads(self, message_quads, undelivered=None):
+        """ Submits results as they come from message_quads, which can be any
+        iterable, handing the pool results_per_map of them at a time.
+
+        Results that couldn't be submitted (but not ones Icinga rejected)
+        are passed, a list at a time, to undelivered, if it's given.
+        """
+        if self.pool is None:
+            self.start()
+        time_start = time.time()
+        results = list()
+        indexed_quads = enumerate(message_quads)
+        while True:
+            chunk = list(itertools.islice(indexed_quads, self.results_per_map))
+            if len(chunk) == 0:
+                break
+            chunk_results = self.pool.map(self.send_one_result, chunk)
+            results.extend([ (x[0], x[1] is True) for x in chunk_results ])
+            if undelivered is not None:
+                failed = [ quad for ((_, quad), x) in zip(chunk, chunk_results) if x[1] is None ]
+                if failed:
+                    undelivered(failed)
+        latencies = sorted([ x[0] for x in results ])
+        failures = len([ x for x in results if x[1] == False ])
+        if failures > 0:
+            Metrics.SEND_FAILURES.inc(failures, ("icinga_api",))
+        self.logger.info(("submitted %d results to the Icinga API in %.1f s, "
+                          "%d failed; latency p50 %.3f s, p90 %.3f s, "
+                          "p99 %.3f s, max %.3f s.") %
+                         (len(results), time.time() - time_start, failures,
+                          percentile(latencies, 0.5),
+                          percentile(latencies, 0.9),
+                          percentile(latencies, 0.99),
+                          percentile(latencies, 1.0)))
@@ -1,66 +1,218 @@
-import requests
+import json
 import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+requests = None
+# ^-- imported when the querier's made, since it's slow to import
+
+def iter_json_results(chunks):
+    """ Incremental parser for Icinga API responses, which look like
+    { "results": [ {...}, {...}, ... ] }: yields each object in the results
+    list as soon as it has been read, so the whole response never has to be
+    held in memory, either as text or as parsed objects.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_results = False
+    for chunk in chunks:
+        buffer += chunk
+        if not in_results:
+            start = buffer.find("[")
+            if start < 0:
+                continue
+            buffer = buffer[start + 1:]
+            in_results = True
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer[:1] in ("", "]"):
+                break
+            try:
+                (result, end) = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+                # ^-- haven't got the whole object yet
+            yield result
+            buffer = buffer[end:]
+        if buffer[:1] == "]":
+            return
 
 class IcingaService:
     """ Intended to be the accessor for data about the Icinga service
     we need to update or send data to.
+
+    Nothing is asked of Icinga until connect() is called. Given a
+    hostname_set (from a snapshot), has_host can answer from that in the
+    meantime, and anything that does need Icinga waits for the connection.
     """
-    def __init__(self, config, logger):
-        self.querier = IcingaServiceQuerier(config["icinga_server"],
-                                            config["icinga_username"], 
-                                            config["icinga_password"],
-                                            logger, 
-                                            verify_ssl=False)
-        self.needs_update = True
-        self.hostname_list = None
-        self.update_host_list()
+    def __init__(self, config, logger, hostname_set=None):
+        self.config = config
         self.logger = logger
+        self.delete_missing_hosts = config["icinga_delete_missing_hosts"]
+        self.delete_max_fraction = config["icinga_delete_max_fraction"]
+        self.reconcile_interval = config["icinga_reconcile_interval"]
+        self.last_reconciled = 0
+        self.querier = None
+        self.connected = threading.Event()
+        if hostname_set is None:
+            self.needs_update = True
+            self.hostname_set = set()
+        else:
+            self.needs_update = False
+            self.hostname_set = set(hostname_set)
+
+    def connect(self):
+        """ Makes the querier, checking the credentials, and gets the host
+        list.
+        """
+        self.querier = IcingaServiceQuerier(self.config["icinga_server"],
+                                            self.config["icinga_username"],
+                                            self.config["icinga_password"],
+                                            self.logger,
+                                            verify_ssl=False,
+                                            max_parallel=self.config["icinga_max_parallel"],
+                                            timeout=self.config["icinga_api_timeout"])
+        self.hostname_set = set(self.querier.get_hostname_list())
+        self.needs_update = False
+        self.connected.set()
 
-    def add_host(self, host, add_vars=dict()):
-        result = self.querier.create_host(host, add_vars)
-        self.needs_update = True
-        # maybe should only mark needs update if success? TODO
+    def add_host(self, host, add_vars=dict(), host_ip=None):
+        result = self.querier.create_host(host, add_vars, host_ip)
+        if result == True:
+            self.hostname_set.add(host)
+            # ^-- no need to download the whole host list again for this
         return result
 
     def remove_host(self, host):
-        self.needs_update = True
-        self.querier.remove_host(host.name)
-        pass
+        self.querier.delete_host(host)
+        self.hostname_set.discard(host)
 
     def has_host(self, hostname):
         if self.needs_update == True:
             self.update_host_list()
-        if hostname in self.hostname_list:
-            return True
-        else:
-            return False
+        return hostname in self.hostname_set
 
     def update_host_list(self):
-        self.hostname_list = self.querier.get_hostname_list()
+        self.connected.wait()
+        self.hostname_set = set(self.querier.get_hostname_list())
         self.needs_update = False
 
     def get_hostname_list(self):
         if self.needs_update == True:
             self.update_host_list()
-        return self.hostname_list
+        return list(self.hostname_set)
 
     def ensure_hosts_exist(self, host_service_dict):
-        for host in host_service_dict.keys():
-            if not self.has_host(host):
-                self.logger.warn("Icinga host entry \"%s\" was not found, attempting to create." % host)
-                result = self.add_host(host, add_vars={ ("%s" % x): "1" for x in host_service_dict[host] })
-                if result == False:
-                    self.logger.error("failed to add host entry for \"%s\"." % host)
-                else:
-                    self.logger.warn("Icinga host entry \"%s\" created." % host) 
-                    # ^- this isn't really a warning but it closes off the warning above
-            pass
+        if self.needs_update == True:
+            self.update_host_list()
+        missing_hosts = [ x for x in host_service_dict.keys()
+                          if not x in self.hostname_set ]
+        if len(missing_hosts) == 0:
+            return
+        self.connected.wait()
+
+        for host in missing_hosts:
+            self.logger.warn("Icinga host entry \"%s\" was not found, attempting to create." % host)
+        addresses = self.querier.resolve_addresses(missing_hosts)
+
+        def add_one_host(host):
+            return self.add_host(host,
+                                 add_vars={ ("%s" % x): "1" for x in host_service_dict[host] },
+                                 host_ip=addresses[host])
+        results = self.querier.pool.map(add_one_host, missing_hosts)
+
+        for (host, result) in zip(missing_hosts, results):
+            if result == False:
+                self.logger.error("failed to add host entry for \"%s\"." % host)
+            else:
+                self.logger.warn("Icinga host entry \"%s\" created." % host) 
+                # ^- this isn't really a warning but it closes off the warning above
+
+    def reconcile_hosts(self, host_service_dict):
+        """ Brings Icinga's SGE hosts into line with what SGE says they
+        should be: creates missing hosts, updates the passive_checks vars of
+        hosts whose sensors have changed, and (if configured to) deletes
+        hosts SGE no longer reports. Nothing's deleted if SGE reported no
+        hosts at all, or if more than delete_max_fraction of Icinga's SGE
+        hosts would go at once: that's far more likely to be qhost failing
+        than the cluster shrinking.
+
+        This needs the vars of every host, so it's only done every
+        reconcile_interval seconds: in between, only missing hosts are
+        created, from the cached host set.
+        """
+        if ((time.time() - self.last_reconciled < self.reconcile_interval) or
+            (not self.connected.is_set())):
+            return self.ensure_hosts_exist(host_service_dict)
+            # ^-- not connected yet: reconciling's left until it is
+        time_start = time.time()
+
+        current_checks = dict()
+        hostname_set = set()
+        for host in self.querier.iter_hosts(attrs=["name", "vars"]):
+            name = host["attrs"]["name"]
+            host_vars = host["attrs"]["vars"] or dict()
+            hostname_set.add(name)
+            if host_vars.get("sge_node") == 1:
+                current_checks[name] = host_vars.get("passive_checks") or dict()
+        self.hostname_set = hostname_set
+        self.needs_update = False
+
+        self.ensure_hosts_exist(host_service_dict)
+
+        # Hosts needing the same vars can be updated in one request
+        changed = dict()
+        for (host, services) in host_service_dict.items():
+            if not host in current_checks:
+                continue
+            desired_checks = { ("%s" % x): "1" for x in services }
+            if current_checks[host] != desired_checks:
+                key = tuple(sorted(desired_checks.keys()))
+                changed.setdefault(key, list()).append(host)
+        for (services, hosts) in changed.items():
+            self.logger.info("updating passive_checks of %d Icinga hosts." % len(hosts))
+            if not self.querier.update_hosts_vars(
+                    hosts, { "passive_checks": { x: "1" for x in services } }):
+                self.logger.error("failed to update passive_checks of %d Icinga hosts." % len(hosts))
+
+        gone_hosts = [ x for x in current_checks.keys() if not x in host_service_dict ]
+        if (len(gone_hosts) > 0 and self.delete_missing_hosts and
+            ((len(host_service_dict) == 0) or
+             (len(gone_hosts) > self.delete_max_fraction * len(current_checks)))):
+            self.logger.error(("%d of %d Icinga SGE hosts are no longer reported by SGE, "
+                               "from a cycle that saw %d hosts: not deleting any, as SGE "
+                               "is more likely to have failed.") %
+                              (len(gone_hosts), len(current_checks), len(host_service_dict)))
+        elif len(gone_hosts) > 0 and self.delete_missing_hosts:
+            for host in gone_hosts:
+                self.logger.warn("Icinga host entry \"%s\" no longer reported by SGE, deleting." % host)
+
+            def remove_one_host(host):
+                try:
+                    self.remove_host(host)
+                except IcingaError, e:
+                    self.logger.error("failed to delete host entry for \"%s\": %s" % (host, e))
+            self.querier.pool.map(remove_one_host, gone_hosts)
+        elif len(gone_hosts) > 0:
+            self.logger.info("%d Icinga SGE hosts are no longer reported by SGE." % len(gone_hosts))
+
+        self.last_reconciled = time.time()
+        self.logger.info("reconciled Icinga hosts in %.1f s: %d checked, %d groups updated." %
+                         (self.last_reconciled - time_start,
+                          len(current_checks), len(changed)))
 
 
 
 class IcingaServiceQuerier:
-    def __init__(self, base_url, username, password, logger, verify_ssl=True):
+    """ Every request gives up after timeout seconds without a response
+    (or, while a response is streamed, without any more of it), raising
+    requests' Timeout, so a hung API can't hold anything up indefinitely.
+    """
+    def __init__(self, base_url, username, password, logger, verify_ssl=True, max_parallel=8,
+                 timeout=10):
         self.logger = logger
+        self.timeout = timeout
         if base_url[-1] == "/":
             base_url = base_url[0:-1] 
             # ^-- trimming the url here makes our urls clearer below
@@ -69,24 +221,49 @@ class IcingaServiceQuerier:
         self.username = username
         self.password = password
         self.authenticated = False
+        self.address_cache = dict()
+
+        global requests
+        import requests
+
+        # One keep-alive session, shared by a bounded pool of threads,
+        #  rather than a new connection (and TLS handshake) per request.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_parallel)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool = ThreadPool(max_parallel)
         self.check_authentication()
 
-    def __get(self, url_stub):
-        return requests.get("%s/v1/%s" % (self.base_url, url_stub),
+    def __get(self, url_stub, params=None, stream=False):
+        return self.session.get("%s/v1/%s" % (self.base_url, url_stub),
                             auth=(self.username, self.password), 
-                            verify=self.verify_ssl)
+                            params=params,
+                            stream=stream,
+                            verify=self.verify_ssl,
+                            timeout=self.timeout)
+
+    def __post(self, url_stub, data):
+        return self.session.post("%s/v1/%s" % (self.base_url, url_stub),
+                            auth=(self.username, self.password),
+                            data=data,
+                            headers={ "Accept": "application/json" }, 
+                            verify=self.verify_ssl,
+                            timeout=self.timeout)
 
     def __put(self, url_stub, data):
-        return requests.put("%s/v1/%s" % (self.base_url, url_stub),
+        return self.session.put("%s/v1/%s" % (self.base_url, url_stub),
                             auth=(self.username, self.password),
                             data=data,
                             headers={ "Accept": "application/json" }, 
-                            verify=self.verify_ssl)
+                            verify=self.verify_ssl,
+                            timeout=self.timeout)
 
     def __delete(self, url_stub):
-        return requests.delete("%s/v1/%s" % (self.base_url, url_stub),
+        return self.session.delete("%s/v1/%s" % (self.base_url, url_stub),
                             auth=(self.username, self.password), 
-                            verify=self.verify_ssl)
+                            verify=self.verify_ssl,
+                            timeout=self.timeout)
 
     def check_authentication(self):
         response = self.__get("")
@@ -101,65 +278,91 @@ class IcingaServiceQuerier:
         return self.authenticated
 
     def delete_service(self, service_name):
-        response = self.__get("objects/services?service=%s" % service_name)
+        # service_name is the full "host!service" name
+        response = self.__delete("objects/services/%s?cascade=1" % service_name)
 
-        if response.status_code == 200:
-            response = self.__delete("objects/services?service=%s" % hostname)
-            if response.status_code != 200:
-                error_msg = ("Could not delete service %s: code %d" % 
-                             (hostname, response.status_code)
-                             )
-                raise IcingaError(error_msg)
-        else:
+        if response.status_code == 404:
             error_msg = ("Could not delete service %s: service not found." %
-                         hostname
+                         service_name
+                         )
+            raise IcingaError(error_msg)
+        elif response.status_code != 200:
+            error_msg = ("Could not delete service %s: code %d" % 
+                         (service_name, response.status_code)
                          )
             raise IcingaError(error_msg)
         return
    
     def delete_host(self, hostname):
-        response = self.__get("objects/hosts?host=%s" % hostname)
+        # cascade=1 takes the host's services (and their state) with it
+        response = self.__delete("objects/hosts/%s?cascade=1" % hostname)
         
-        if response.status_code == 200:
-            response = self.__delete("objects/hosts?host=%s" % hostname)
-            if response.status_code != 200:
-                error_msg = ("Could not delete host %s: code %d" % 
-                             (hostname, response.status_code)
-                             )
-                raise IcingaError(error_msg)
-        else:
+        if response.status_code == 404:
             error_msg = ("Could not delete host %s: host not found." %
                           hostname
                           )
             raise IcingaError(error_msg)
+        elif response.status_code != 200:
+            error_msg = ("Could not delete host %s: code %d" % 
+                         (hostname, response.status_code)
+                         )
+            raise IcingaError(error_msg)
         return
 
+    def update_hosts_vars(self, hostnames, new_vars, hosts_per_request=500):
+        """ Sets the same vars on a lot of hosts, a few hundred hosts per
+        request, rather than one request per host.
+        """
+        success = True
+        for i in range(0, len(hostnames), hosts_per_request):
+            data = { "filter": "host.name in hostnames",
+                     "filter_vars": { "hostnames": hostnames[i:i + hosts_per_request] },
+                     "attrs": { ("vars.%s" % x): new_vars[x] for x in new_vars.keys() } }
+            response = self.__post("objects/hosts", json.dumps(data))
+            if response.status_code != 200:
+                self.logger.error(response.text)
+                success = False
+        return success
+
     def remove_service_from_host(self, service_name, hostname):
         return self.delete_service("%s!%s" % (hostname, service_name))
 
     def create_template(self,template_name, template_content):
         pass
 
-    def create_host(self, host, add_vars=dict()):
-        response = self.__get("objects/hosts?host=%s" % host)
+    def resolve_address(self, host):
+        if not host in self.address_cache:
+            try:
+                self.address_cache[host] = socket.gethostbyname(host)
+            except socket.gaierror, e:                                                  
+                self.logger.error('cannot resolve ip for host \"%s\" - assigning fake IP to host' % host)
+                return 'none'
+                # ^-- not cached, so it gets tried again next time
+        return self.address_cache[host]
+
+    def resolve_addresses(self, hosts):
+        """ Looks up the addresses of a list of hosts concurrently, returning
+        a dict of { host: address }.
+        """
+        return dict(zip(hosts, self.pool.map(self.resolve_address, hosts)))
 
+    def create_host(self, host, add_vars=dict(), host_ip=None):
+        # No GET to check whether the host exists first: the caller knows
+        #  from the host list, and if it's wrong Icinga refuses the PUT.
+        if host_ip is None:
+            host_ip = self.resolve_address(host)
+        add_vars_string = ', '.join([("\"%s\":\"%s\"" % (x, add_vars[x]))
+                                      for x in add_vars.keys()])
+        response = self.__put("objects/hosts/%s" % host, 
+                data = "{ \"templates\": [ \"generic-host\" ], \"attrs\": { \"address\": \"%s\", \"vars\": { \"sge_node\" : 1, \"passive_checks\" : { %s } } } }" % (host_ip, add_vars_string))
         if response.status_code == 200:
-            raise IcingaError("tried to create host that already exists: %s" % host)
+            return True
+        elif "already exists" in response.text:
+            self.logger.warn("tried to create host that already exists: %s" % host)
+            return True
         else:
-            try:
-                host_ip=socket.gethostbyname(host)
-            except socket.gaierror, e:                                                  
-                self.logger.error('cannot resolve ip for host \"%s\" - assigning fake IP to host %s' % host)
-                host_ip='none'
-            add_vars_string = ', '.join([("\"%s\":\"%s\"" % (x, add_vars[x]))
-                                          for x in add_vars.keys()])
-            response = self.__put("objects/hosts/%s" % host, 
-                    data = "{ \"templates\": [ \"generic-host\" ], \"attrs\": { \"address\": \"%s\", \"vars\": { \"sge_node\" : 1, \"passive_checks\" : { %s } } } }" % (host_ip, add_vars_string))
-            if response.status_code == 200:
-                return True
-            else:
-                self.logger.error(response.text)
-                return False
+            self.logger.error(response.text)
+            return False
 
     def create_service_as_clone(self, 
                                 service_name, 
@@ -173,9 +376,22 @@ class IcingaServiceQuerier:
         response = self.__get("objects/hosts")
         return response.json()
 
+    def iter_hosts(self, attrs=None, host_filter=None):
+        """ Streams the host objects, with only the given attributes,
+        optionally only those matching an Icinga filter expression.
+        """
+        params = dict()
+        if attrs is not None:
+            params["attrs"] = attrs
+        if host_filter is not None:
+            params["filter"] = host_filter
+        response = self.__get("objects/hosts", params=params, stream=True)
+        if response.status_code != 200:
+            raise IcingaError("Could not get host list: code %d" % response.status_code)
+        return iter_json_results(response.iter_content(chunk_size=65536))
+
     def get_hostname_list(self):
-        dict_hosts = self.get_hosts()
-        return [ host["name"] for host in dict_hosts["results"] ]
+        return [ host["attrs"]["name"] for host in self.iter_hosts(attrs=["name"]) ]
 
     def get_all_services(self):
         # curl -k -s -u 'username:password'
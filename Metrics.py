@@ -0,0 +1,179 @@
+import BaseHTTPServer
+import bisect
+import threading
+
+class Metric:
+    """ Base for the metric types: a named family of values, one per
+    combination of label values, that can render itself in the Prometheus
+    text exposition format.
+    """
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def label_string(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        return "{%s}" % ','.join([ "%s=\"%s\"" % (k, str(v).replace("\\", "\\\\").replace("\"", "\\\""))
+                                   for (k, v) in pairs ])
+
+    def render(self):
+        lines = [ "# HELP %s %s" % (self.name, self.help_text),
+                  "# TYPE %s %s" % (self.name, self.metric_type) ]
+        with self.lock:
+            items = sorted(self.values.items())
+        for (labelvalues, value) in items:
+            lines.extend(self.render_value(labelvalues, value))
+        return lines
+
+    def render_value(self, labelvalues, value):
+        return [ "%s%s %r" % (self.name, self.label_string(labelvalues), float(value)) ]
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, labelvalues=()):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, labelvalues=()):
+        with self.lock:
+            self.values[labelvalues] = value
+
+class Histogram(Metric):
+    metric_type = "histogram"
+    default_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=default_buckets):
+        Metric.__init__(self, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labelvalues=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                state = [ [0] * (len(self.buckets) + 1), 0.0, 0 ]
+                self.values[labelvalues] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render_value(self, labelvalues, state):
+        (bucket_counts, total, count) = (list(state[0]), state[1], state[2])
+        lines = list()
+        cumulative = 0
+        for (bound, bucket_count) in zip(self.buckets + ("+Inf",), bucket_counts):
+            cumulative += bucket_count
+            lines.append("%s_bucket%s %d" % (self.name,
+                                             self.label_string(labelvalues, [("le", bound)]),
+                                             cumulative))
+        lines.append("%s_sum%s %r" % (self.name, self.label_string(labelvalues), total))
+        lines.append("%s_count%s %d" % (self.name, self.label_string(labelvalues), count))
+        return lines
+
+class MetricsRegistry:
+    """ Holds all the metrics, and renders them all for scraping.
+    """
+    def __init__(self):
+        self.metrics = list()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.default_buckets):
+        return self.add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = list()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+# ^-- one per process: the daemon's stages all add to this one
+
+STAGE_SECONDS = REGISTRY.histogram("sge2icinga_stage_duration_seconds",
+                                   "Time taken by each stage of a cycle.",
+                                   ["stage", "cell"])
+HOSTS = REGISTRY.gauge("sge2icinga_hosts",
+                       "Hosts in the last cycle: seen in qhost, skipped for having no thresholds, or uncontactable.",
+                       ["kind", "cell"])
+RESULTS = REGISTRY.gauge("sge2icinga_results",
+                         "Results made in the last cycle, by state.",
+                         ["state", "cell"])
+RESULTS_SENT = REGISTRY.counter("sge2icinga_results_sent_total",
+                                "Results handed to the message device.")
+SEND_FAILURES = REGISTRY.counter("sge2icinga_send_failures_total",
+                                 "Failed sends, by message device.",
+                                 ["device"])
+CELL_CYCLE_SECONDS = REGISTRY.histogram("sge2icinga_cell_cycle_seconds",
+                                        "Time from each cell's full cycle tick until its results were sent.",
+                                        ["cell"])
+CELL_RESTARTS = REGISTRY.counter("sge2icinga_cell_restarts_total",
+                                 "Cell worker processes restarted, by cell and whether the worker died or stalled.",
+                                 ["cell", "reason"])
+MESSAGE_BYTES = REGISTRY.gauge("sge2icinga_message_bytes",
+                               "Largest per-host list of messages held in the last cycle, as measured by size_of_messages.",
+                               ["cell"])
+# ^-- the "cell" label is only given to cell workers' cycles, recorded
+#     here by record_cycle; values given fewer label values than there
+#     are names just leave the rest off
+
+def record_cycle(stats, cell=None):
+    """ Records a collect+compare cycle's stats, as MessageMaker.iter_make
+    leaves them in its cycle_stats: labelled by cell, if it's given, as
+    when they've come back from a cell worker process, whose own metrics
+    aren't served.
+    """
+    if cell is None:
+        cell_labels = ()
+    else:
+        cell_labels = (cell,)
+    for stage in ("collect", "compare"):
+        if stage in stats:
+            STAGE_SECONDS.observe(stats[stage], (stage,) + cell_labels)
+    for (kind, count) in stats.get("hosts", dict()).items():
+        HOSTS.set(count, (kind,) + cell_labels)
+    for (state, count) in stats.get("results", dict()).items():
+        RESULTS.set(count, (state,) + cell_labels)
+    if "message_bytes" in stats:
+        MESSAGE_BYTES.set(stats["message_bytes"], cell_labels)
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+def start_metrics_server(address, port):
+    """ Serves the registry over HTTP from a background thread, so scrapes
+    never hold up the daemon's own work.
+    """
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
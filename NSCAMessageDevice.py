@@ -1,13 +1,29 @@
+import os
+import re
+import signal
 import subprocess
 import sys
 import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import Metrics
 
 class MessageDevice:
     """ Our abstracted messaging device, NSCA implementation
 
     Buffers and sends messages using the NSCA command client client.
+
+    send_nsca doesn't cope with being given too much at once (see
+    DEVNOTES.md), so results are split into batches, limited both in bytes
+    and in number of results, and each batch gets its own send_nsca, run
+    from a fixed-size pool of workers with a timeout and retries.
     """
 
+    record_separator = "\x17"
+    # ^-- ^W: send_nsca takes this, not a newline, between results
+
     def __init__(self,
                  config,
                  logger,
@@ -15,13 +31,24 @@ class MessageDevice:
                  #nsca_send_command = "/send_nsca",
                  nsca_send_command = "/home/uccaiki/Code/opsview-gridengine-integration/shell_ver/send_nsca.2.9.1-11.el7",
                  #nsca_config_file  = "/usr/local/nagios/etc/send_nsca.cfg"):
-                 nsca_config_file  = "/home/uccaiki/Code/opsview-gridengine-integration/shell_ver/send_nsca.cfg"):
+                 nsca_config_file  = "/home/uccaiki/Code/opsview-gridengine-integration/shell_ver/send_nsca.cfg",
+                 retry_backoff = 1):
         self.config = config
         self.logger = logger
         self.message_buffer = list()
         self.destination_host   = config["nsca_dest_host"]
+        self.port               = config.get("nsca_port", 5667)
         self.nsca_send_command  = nsca_send_command
         self.nsca_config_file   = nsca_config_file
+        self.batch_bytes        = config["nsca_batch_bytes"]
+        self.batch_results      = config["nsca_batch_results"]
+        self.batch_timeout      = config["nsca_batch_timeout"]
+        self.batch_retries      = config["nsca_batch_retries"]
+        self.workers            = config["nsca_workers"]
+        self.retry_backoff      = retry_backoff
+        self.pool               = None
+        # ^-- made on first use rather than here, since daemonising
+        #     happens in between and threads don't survive it
 
     def add_message_to_buffer(self, message):
         self.message_buffer.append("message")
@@ -35,39 +62,170 @@ class MessageDevice:
         self.send_one_message(message)
         self.clear_message_buffer()
         
+    def start_messenger(self, stdout, stderr, timeout=300):
+        return subprocess.Popen(
+                        [self.nsca_send_command, 
+                         self.destination_host,
+                         "-p",
+                         "%d" % self.port,
+                         "-to",
+                         "%d" % timeout, # <- timeout, in seconds
+                         "-c", 
+                         "%s" % self.nsca_config_file], 
+                        stdin=subprocess.PIPE,
+                        stdout=stdout,
+                        stderr=stderr,
+                        preexec_fn=os.setsid
+                        # ^-- own process group, so it can be killed whole
+                        )
+
+    def log_messenger_output(self, stdout_text, stderr_text):
+        if stderr_text != "":
+            for line in stderr_text.strip().split('\n'):
+                self.logger.warn(line)
+        if stdout_text != "":
+            for line in stdout_text.strip().split('\n'):
+                self.logger.info(line)
+
     def send_one_message(self, message):
         try:
-            messenger = subprocess.Popen(
-                            [self.nsca_send_command, 
-                             self.destination_host,
-                             "-to",
-                             "300", # <- timeout, in seconds
-                             "-c", 
-                             "%s" % self.nsca_config_file], 
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
-                            )
-            (stdout_text, stderr_text) = messenger.communicate(input=message)
-            if stderr_text != "":
-                for line in stderr_text.strip().split('\n'):
-                    self.logger.warn(line)
-            if stdout_text != "":
-                for line in stdout_text.strip().split('\n'):
-                    self.logger.info(line)
-
+            (sent, output_text) = self.run_messenger(message)
+            # ^-- killed if it's still going after batch_timeout, like the batches
         except:
             self.logger.error("could not send message: %s" % sys.exc_info()[1]) 
+            Metrics.SEND_FAILURES.inc(1, ("send_nsca",))
             pass
         else:
-            self.logger.info("sent message.")
+            if sent:
+                self.log_messenger_output(output_text, "")
+                self.logger.info("sent message.")
+            else:
+                self.logger.error("could not send message: %s" % output_text)
+                Metrics.SEND_FAILURES.inc(1, ("send_nsca",))
 
-    def send_message_quads(self, message_quads):
-        total_message = (''.join(['\t'.join([str(y) for y in x]) for x in message_quads]) + "\n")
-        
+    def run_messenger(self, message):
+        """ Runs one send_nsca on message, killing it if it's still going
+        after batch_timeout seconds. Returns (whether it worked, output).
+        """
+        messenger = self.start_messenger(subprocess.PIPE, subprocess.STDOUT,
+                                         self.batch_timeout)
+        killer = threading.Timer(self.batch_timeout + 5, self.kill_messenger, (messenger,))
+        # ^-- a little later than send_nsca's own timeout, so that gets
+        #     the chance to report first
+        killer.start()
+        try:
+            (output_text, _) = messenger.communicate(input=message)
+        finally:
+            killer.cancel()
+        if messenger.returncode < 0:
+            return (False, "killed after %d s" % self.batch_timeout)
+        return (messenger.returncode == 0, output_text.strip())
+
+    def kill_messenger(self, messenger):
+        try:
+            os.killpg(messenger.pid, signal.SIGKILL)
+        except OSError:
+            pass
+            # ^-- it finished just in time
+
+    def send_batch(self, batch):
+        """ Sends one batch, (batch number, results, text), retrying with
+        backoff. Returns (batch number, results, whether it was sent).
+        """
+        (batch_number, results, message) = batch
+        result_count = len(results)
+        time_start = time.time()
+        for attempt in range(self.batch_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                (sent, output_text) = self.run_messenger(message)
+            except Exception:
+                (sent, output_text) = (False, str(sys.exc_info()[1]))
+            if sent:
+                match = re.search(r"(\d+) data packet", output_text)
+                if match and int(match.group(1)) != result_count:
+                    output_text = "%s (expected %d)" % (output_text, result_count)
+                    sent = False
+                    # ^-- some got lost in transmission: send the lot again
+            if sent:
+                self.logger.info("batch %d: sent %d results, %d bytes, in %.1f s (attempt %d)." %
+                                 (batch_number, result_count, len(message),
+                                  time.time() - time_start, attempt + 1))
+                return (batch_number, results, True)
+            self.logger.warn("batch %d: attempt %d failed: %s" %
+                             (batch_number, attempt + 1, output_text))
+        self.logger.error("batch %d: could not send %d results after %d attempts." %
+                          (batch_number, result_count, self.batch_retries + 1))
+        Metrics.SEND_FAILURES.inc(1, ("send_nsca",))
+        return (batch_number, results, False)
+
+    def iter_batches(self, message_quads, copy_file=None):
+        """ Splits results up into (batch number, results, text) batches of no more than batch_results results and (unless a single
+        result is bigger) batch_bytes bytes.
+        """
+        results = list()
+        records = list()
+        batch_bytes = 0
+        batch_number = 0
+        for x in message_quads:
+            record = "%s\t%s\t%d\t%s%s" % (x.hostname, x.service, x.state, x.output,
+                                           self.record_separator)
+            if records and ((batch_bytes + len(record) > self.batch_bytes) or
+                            (len(records) >= self.batch_results)):
+                batch_number += 1
+                yield (batch_number, results, ''.join(records))
+                results = list()
+                records = list()
+                batch_bytes = 0
+            results.append(x)
+            records.append(record)
+            batch_bytes += len(record)
+            if copy_file is not None:
+                copy_file.write("%s\n" % record)
+        if records:
+            yield (batch_number + 1, results, ''.join(records))
+
+    def send_message_quads(self, message_quads, undelivered=None):
+        """ Sends results as they come from message_quads, which can be any
+        iterable, in batches handed to the worker pool. No more than twice
+        as many batches as there are workers are held at once.
+
+        The results of batches that couldn't be sent are passed, a list at
+        a time, to undelivered, if it's given.
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        time_start = time.time()
+        in_flight = threading.BoundedSemaphore(self.workers * 2)
+        outcomes = list()
+        def finished(outcome):
+            (batch_number, results, sent) = outcome
+            outcomes.append((batch_number, len(results), sent))
+            if (not sent) and (undelivered is not None):
+                try:
+                    undelivered(results)
+                except Exception:
+                    self.logger.exception("could not pass on undelivered results.")
+            in_flight.release()
+
+        copy_file = None
         if self.config.get("message_copy", False) != False: 
-            with open("messages.view", "w") as f:
-                f.write("%s\n" % total_message)
-        
-        self.send_one_message(total_message)
-        pass
+            copy_file = open("messages.view", "w")
+        try:
+            pending = list()
+            for batch in self.iter_batches(message_quads, copy_file):
+                in_flight.acquire()
+                pending.append(self.pool.apply_async(self.send_batch, (batch,),
+                                                     callback=finished))
+            for async_result in pending:
+                async_result.wait()
+        finally:
+            if copy_file is not None:
+                copy_file.close()
+
+        sent = sum([ x[1] for x in outcomes if x[2] ])
+        failed = [ x for x in outcomes if not x[2] ]
+        self.logger.info("sent %d of %d results to send_nsca in %d batches (%d failed) in %.1f s." %
+                         (sent, sent + sum([ x[1] for x in failed ]), len(outcomes),
+                          len(failed), time.time() - time_start))
@@ -0,0 +1,168 @@
+import binascii
+import itertools
+import socket
+import struct
+import sys
+import time
+import zlib
+
+import Metrics
+
+NSCA_PACKET_VERSION = 3
+NSCA_IV_LENGTH = 128
+NSCA_INIT_PACKET_LENGTH = NSCA_IV_LENGTH + 4
+NSCA_ENCRYPT_NONE = 0
+NSCA_ENCRYPT_XOR = 1
+NSCA_ENCRYPTION_METHODS = (NSCA_ENCRYPT_NONE, NSCA_ENCRYPT_XOR)
+
+def nsca_packet_format(max_output_length):
+    """ struct format for an NSCA data packet: version, (padding), CRC32,
+    timestamp, return code, host name, service description, plugin output,
+    (padding). The padding is the C struct alignment in nsca's common.h.
+    """
+    return "!hxxLLh64s128s%dsxx" % max_output_length
+
+def xor_key(length, iv, password):
+    """ NSCA's "XOR" encryption XORs each byte of a packet with the
+    connection's IV, then with the password, both repeating. Since that
+    doesn't depend on the packet contents, it can be done once per
+    connection: this returns the combined key as one big number.
+    """
+    key = bytearray(length)
+    iv = bytearray(iv)
+    for i in xrange(length):
+        key[i] = iv[i % NSCA_IV_LENGTH]
+    if password:
+        password = bytearray(password)
+        for i in xrange(length):
+            key[i] ^= password[i % len(password)]
+    return int(binascii.hexlify(key), 16)
+
+def xor_crypt(packet, key):
+    """ Applies (or removes -- it's its own inverse) an xor_key to a packet.
+    """
+    return binascii.unhexlify("%0*x" % (len(packet) * 2,
+                                        int(binascii.hexlify(packet), 16) ^ key))
+
+class MessageDevice:
+    """ Our abstracted messaging device, NSCA implementation that speaks the
+    NSCA protocol itself instead of running send_nsca.
+
+    Keeps one connection open to the NSCA daemon across sends, and writes
+    packets to it in bulk. Supports no encryption and XOR encryption.
+    """
+
+    def __init__(self, config, logger, packets_per_write=1000):
+        self.config = config
+        self.logger = logger
+        self.destination_host = config["nsca_dest_host"]
+        self.port = config["nsca_port"]
+        self.password = config["nsca_password"]
+        self.encryption = config["nsca_encryption"]
+        self.timeout = config["nsca_timeout"]
+        self.max_output_length = config["nsca_max_output_length"]
+        self.packet_format = nsca_packet_format(self.max_output_length)
+        self.packet_length = struct.calcsize(self.packet_format)
+        self.packets_per_write = packets_per_write
+        self.connection = None
+        self.xor_key = None
+        self.timestamp_offset = 0
+
+    def connect(self):
+        """ Opens a connection and reads the init packet, which has the IV
+        for encryption and the server's idea of the time.
+        """
+        self.close()
+        connection = socket.create_connection((self.destination_host, self.port),
+                                              self.timeout)
+        init_packet = ""
+        while len(init_packet) < NSCA_INIT_PACKET_LENGTH:
+            data = connection.recv(NSCA_INIT_PACKET_LENGTH - len(init_packet))
+            if data == "":
+                connection.close()
+                raise socket.error("connection closed before NSCA init packet was read")
+            init_packet += data
+        self.xor_key = xor_key(self.packet_length,
+                               init_packet[:NSCA_IV_LENGTH],
+                               self.password)
+        (server_time,) = struct.unpack("!L", init_packet[NSCA_IV_LENGTH:])
+        self.timestamp_offset = server_time - int(time.time())
+        # ^-- the connection is kept open for longer than the server's
+        #     max_packet_age, so the timestamp has to keep moving with it
+        self.connection = connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except socket.error:
+                pass
+            self.connection = None
+
+    def make_packet(self, hostname, service, state, output):
+        timestamp = int(time.time()) + self.timestamp_offset
+        fields = [ str(hostname)[:63],
+                   str(service)[:127],
+                   str(output)[:self.max_output_length - 1] ]
+        packet = struct.pack(self.packet_format, NSCA_PACKET_VERSION, 0,
+                             timestamp, int(state), *fields)
+        crc = zlib.crc32(packet) & 0xffffffff
+        packet = struct.pack(self.packet_format, NSCA_PACKET_VERSION, crc,
+                             timestamp, int(state), *fields)
+        if self.encryption == NSCA_ENCRYPT_XOR:
+            packet = xor_crypt(packet, self.xor_key)
+        return packet
+
+    def send_packets(self, message_quads):
+        self.connection.sendall(''.join([ self.make_packet(x.hostname, x.service, x.state, x.output)
+                                          for x in message_quads ]))
+
+    def send_chunk(self, message_quads):
+        """ Sends up to packets_per_write results in one write. Returns
+        whether that worked.
+        """
+        # One reconnection is allowed for, since the daemon may have
+        #  dropped a connection that's been sitting idle since last time.
+        #  The packets are made again after reconnecting, since the
+        #  encryption and timestamps depend on the connection.
+        for attempt in (1, 2):
+            try:
+                if self.connection is None:
+                    self.connect()
+                self.send_packets(message_quads)
+                return True
+            except (socket.error, socket.timeout):
+                self.close()
+                if attempt == 2:
+                    self.logger.error("could not send message: %s" % sys.exc_info()[1])
+                    Metrics.SEND_FAILURES.inc(1, ("nsca",))
+        return False
+
+    def send_message_quads(self, message_quads, undelivered=None):
+        """ Sends results as they come from message_quads, which can be any
+        iterable, holding at most packets_per_write of them at a time.
+
+        Results that couldn't be sent are passed, a list at a time, to
+        undelivered, if it's given.
+        """
+        sent = 0
+        unsent = 0
+        message_quads = iter(message_quads)
+        while True:
+            chunk = list(itertools.islice(message_quads, self.packets_per_write))
+            if len(chunk) == 0:
+                break
+            if self.send_chunk(chunk):
+                sent += len(chunk)
+            else:
+                # Don't keep waiting on a daemon that isn't there: the
+                #  rest of the cycle's results go straight to undelivered.
+                while len(chunk) > 0:
+                    unsent += len(chunk)
+                    if undelivered is not None:
+                        undelivered(chunk)
+                    chunk = list(itertools.islice(message_quads, self.packets_per_write))
+                break
+        if unsent > 0:
+            self.logger.error("could not send %d results to NSCA." % unsent)
+        self.logger.info("sent %d results to NSCA." % sent)
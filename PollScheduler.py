@@ -0,0 +1,82 @@
+import heapq
+
+class PollScheduler:
+    """ Keeps track of when each host is next due to be polled.
+
+    Every host gets polled by the full cycle each interval anyway, but
+    hosts that need watching -- anything not OK, or whose uncontactable
+    flag has changed within the last flap_window seconds -- are due again
+    fast_interval seconds after they were last seen, so they can be
+    re-checked in between, on their own.
+
+    Due times are kept in a heap of (due time, hostname), with the current
+    due time for each host in a dict: rescheduling just pushes a new entry,
+    and entries that no longer match the dict are skipped when popped.
+    """
+
+    def __init__(self, interval, fast_interval, flap_window):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.flap_window = flap_window
+        self.heap = list()
+        self.due = dict()
+        # ^-- { hostname: due time }
+        self.uncontactable = dict()
+        # ^-- { hostname: (last uncontactable flag, when it last changed) }
+
+    def set_hosts(self, hostnames):
+        """ Forgets any hosts that aren't in hostnames. New ones get
+        scheduled when they're first seen.
+        """
+        hostnames = set(hostnames)
+        for hostname in self.due.keys():
+            if hostname not in hostnames:
+                del self.due[hostname]
+        for hostname in self.uncontactable.keys():
+            if hostname not in hostnames:
+                del self.uncontactable[hostname]
+        self.compact()
+
+    def compact(self):
+        """ Rebuilds the heap without its stale entries.
+        """
+        self.heap = [ (due, hostname) for (hostname, due) in self.due.items() ]
+        heapq.heapify(self.heap)
+
+    def is_flapping(self, hostname, uncontactable, now):
+        previous = self.uncontactable.get(hostname)
+        if previous is None:
+            self.uncontactable[hostname] = (uncontactable, None)
+            return False
+        (last_flag, last_change) = previous
+        if uncontactable != last_flag:
+            last_change = now
+            self.uncontactable[hostname] = (uncontactable, now)
+        return (last_change is not None) and (now - last_change < self.flap_window)
+
+    def observe(self, host_results, now):
+        """ Reschedules a host from its latest results. Returns whether it's
+        on the fast schedule.
+        """
+        hostname = host_results.hostname
+        flapping = self.is_flapping(hostname, host_results.uncontactable, now)
+        fast = (host_results.worst_state() != 0) or flapping
+        if fast:
+            due = now + self.fast_interval
+        else:
+            due = now + self.interval
+        self.due[hostname] = due
+        heapq.heappush(self.heap, (due, hostname))
+        return fast
+
+    def pop_due(self, now):
+        """ Returns the hosts due by now, taking them off the schedule until
+        they're next observed.
+        """
+        hostnames = list()
+        while self.heap and self.heap[0][0] <= now:
+            (due, hostname) = heapq.heappop(self.heap)
+            if self.due.get(hostname) == due:
+                del self.due[hostname]
+                hostnames.append(hostname)
+        return hostnames
@@ -0,0 +1,337 @@
+import itertools
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from CheckResult import HostResults
+
+class Rollup:
+    """ Cluster-wide summary services, for questions the per-host checks
+    can't answer: how many nodes are critical on a sensor, and how the
+    sensor's values are spread across the cluster.
+
+    Each cycle, hosts' results are gathered block_hosts at a time as they
+    go by (see watch), and each block's states (one byte each) are stacked
+    into a 2D array (sensors x hosts, so each sensor's states are together
+    for counting) in one go. The critical and OK counts, and the fraction
+    of hosts uncontactable, are over every host.
+
+    So are min, max and the 5th/50th/95th percentiles of the values. The
+    values are Python objects, though, and turning them into numbers costs
+    far more than the rest put together, so on a big cluster sample_hosts
+    can be set to work those out over a systematic sample of about that
+    many hosts instead: every so many'th host, starting somewhere different
+    each cycle, so every host is looked at in turn. Columns numpy can't
+    convert itself (MEMORY values with suffixes, mostly) are remembered,
+    and parsed all together (see to_numbers).
+
+    The aggregates come out as HostResults for the synthetic host, one
+    service per sensor plus an "uncontactable" one.
+
+    Thresholds are a list of { service, aggregate, relop, value } dicts:
+    a service goes CRITICAL when relop(aggregate, value) is true, just as
+    for SGE's own load thresholds.
+
+    Needs numpy.
+    """
+
+    percentiles = (5, 50, 95)
+    memory_suffixes = { "K": 1024.0,
+                        "M": 1024.0 ** 2,
+                        "G": 1024.0 ** 3,
+                        "T": 1024.0 ** 4 }
+
+    def __init__(self, hostname, thresholds, cmp_op_from_string, block_hosts=4096,
+                 sample_hosts=0):
+        if numpy is None:
+            raise ImportError("cluster rollups need numpy")
+        self.hostname = hostname
+        self.block_hosts = block_hosts
+        self.sample_hosts = sample_hosts
+        self.cycles = 0
+        # ^-- for moving the sample along each cycle
+        self.suffix_letters = ""
+        self.suffix_multipliers = numpy.ones(256)
+        # ^-- by character code
+        for (suffix, multiplier) in self.memory_suffixes.items():
+            for letter in (suffix, suffix.lower()):
+                self.suffix_letters += letter
+                self.suffix_multipliers[ord(letter)] = multiplier
+        self.text_columns = None
+        self.text_columns_sensors = None
+        # ^-- which sensors text_columns was worked out for
+        self.thresholds = dict()
+        for threshold in thresholds:
+            self.thresholds.setdefault(threshold["service"], list()).append(
+                (threshold["aggregate"],
+                 cmp_op_from_string(threshold["relop"]),
+                 threshold["relop"],
+                 threshold["value"]))
+        self.begin(0)
+
+    def begin(self, max_hosts):
+        """ Starts a new cycle, for up to max_hosts hosts.
+        """
+        self.max_hosts = max_hosts
+        self.n_hosts = 0
+        self.sensors = None
+        # ^-- taken from the first host, as all plans list the same sensors
+        self.states = None
+        self.sampled = list()
+        if self.sample_hosts > 0:
+            self.sample_every = max(1, -(-max_hosts // self.sample_hosts))
+        else:
+            self.sample_every = 1
+        self.sample_start = self.cycles % self.sample_every
+        self.cycles += 1
+        self.uncontactable = 0
+        self.block = list()
+
+    def to_number(self, value):
+        """ Makes a float of a value that numpy couldn't, such as a MEMORY
+        value with a suffix, or NaN if it can't be done.
+        """
+        try:
+            return float(value[:-1]) * self.memory_suffixes[value[-1:].upper()]
+        except (ValueError, TypeError, KeyError, IndexError):
+            pass
+            # ^-- suffixes first, since they're what most of these are
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return float("nan")
+
+    def to_numbers(self, column):
+        """ to_number for a whole column (a list of strings) at once: the
+        values are joined into one string, numpy reads the numbers from it
+        with the suffixes taken out, and each is multiplied by its own
+        suffix's multiplier. If that doesn't come out as one number per
+        value, they go through to_number one at a time instead.
+        """
+        if len(column) == 0:
+            return numpy.zeros(0)
+        try:
+            text = " ".join(column)
+        except TypeError:
+            column = [ "nan" if x is None else x for x in column ]
+            # ^-- hosts with no value for a sensor (uncontactable ones, say)
+            try:
+                text = " ".join(column)
+            except TypeError:
+                return map(self.to_number, column)
+                # ^-- not all strs
+        try:
+            digits = text.translate(None, self.suffix_letters)
+        except TypeError:
+            return map(self.to_number, column)
+            # ^-- unicode
+        chars = numpy.frombuffer(text, dtype=numpy.uint8)
+        ends = numpy.append(numpy.flatnonzero(chars == ord(" ")) - 1, len(text) - 1)
+        multipliers = self.suffix_multipliers[chars[ends]]
+        if (len(ends) == len(column) and
+            len(text) - len(digits) == numpy.count_nonzero(multipliers != 1)):
+            # ^-- no spaces in the values, and suffixes only at their ends
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                # ^-- numpy's complaint about text it can't read
+                numbers = numpy.fromstring(digits, sep=" ")
+            if len(numbers) == len(column):
+                return numbers * multipliers
+        return map(self.to_number, column)
+
+    def add(self, host_results):
+        self.block.append(host_results)
+        if len(self.block) >= self.block_hosts:
+            self.flush()
+
+    def add_block(self, block):
+        """ add for a list of hosts at once. Returns the list.
+        """
+        self.block.extend(block)
+        self.flush()
+        return block
+
+    def watch(self, host_results_iter):
+        """ Passes each host's HostResults on from host_results_iter, adding
+        them as they go by. The same as calling add for each, but the
+        hosts are taken a block at a time, so there's no Python code run
+        per host: each block is added before any of its hosts are passed on.
+        """
+        host_results_iter = iter(host_results_iter)
+        blocks = iter(lambda: list(itertools.islice(host_results_iter, self.block_hosts)), [])
+        return itertools.chain.from_iterable(itertools.imap(self.add_block, blocks))
+
+    def flush(self):
+        """ Copies the hosts waiting in the block into the arrays.
+        """
+        block = self.block[:self.max_hosts - self.n_hosts]
+        self.block = list()
+        if len(block) == 0:
+            return
+        if self.sensors is None:
+            self.sensors = [ x[0] for x in block[0].plan if x[1] is not None ]
+            # ^-- queue state services (with no _nagtxt) come after the
+            #     sensors, and vary between hosts, so they're left out
+            if self.sensors != self.text_columns_sensors:
+                self.text_columns = None
+            self.states = numpy.zeros((len(self.sensors), self.max_hosts), dtype=numpy.uint8)
+        n_sensors = len(self.sensors)
+        states = [ x.states for x in block ]
+        # ^-- comprehensions rather than map and attrgetter, which are slower
+        flat = bytearray().join(states)
+        if len(flat) == n_sensors * len(block):
+            lengths = None
+            # ^-- the usual case: every host has just the sensors. All the
+            #     plans list the same sensors, so no host has fewer results,
+            #     and if the total's right none has any more.
+        else:
+            lengths = numpy.fromiter(map(len, states), dtype=numpy.intp, count=len(block))
+            fits = (lengths >= n_sensors)
+            if not fits.all():
+                block = list(itertools.compress(block, fits))
+                states = list(itertools.compress(states, fits))
+                lengths = lengths[fits]
+                flat = bytearray().join(states)
+                # ^-- any host without all the sensors is left out
+                if len(block) == 0:
+                    return
+        rows = slice(self.n_hosts, self.n_hosts + len(block))
+        flat = numpy.frombuffer(bytes(flat), dtype=numpy.uint8)
+        if lengths is None:
+            self.states[:, rows] = flat.reshape(len(block), n_sensors).T
+        else:
+            starts = numpy.cumsum(lengths) - lengths
+            self.states[:, rows] = flat[starts[:, None] + numpy.arange(n_sensors)].T
+            # ^-- hosts with queue states have more results than sensors
+        self.uncontactable += len([ x for x in block if x.uncontactable ])
+
+        sampled = block[(self.sample_start - self.n_hosts) % self.sample_every::self.sample_every]
+        self.n_hosts += len(block)
+        self.sampled.extend([ x.values for x in sampled ])
+        # ^-- just the values tuples: they're converted all at once, by
+        #     sample_values, as numpy's per-call overheads add up
+
+    def sample_values(self):
+        """ The sampled hosts' values, as a 2D array of floats (hosts x
+        sensors), with NaN for values that aren't numbers.
+        """
+        n_sensors = len(self.sensors)
+        values = numpy.empty((len(self.sampled), n_sensors))
+        if len(self.sampled) == 0:
+            return values
+        flat = list(itertools.chain.from_iterable(self.sampled))
+        if len(flat) != values.size:
+            flat = list(itertools.chain.from_iterable([ x[:n_sensors] for x in self.sampled ]))
+            # ^-- hosts with queue states have more values than sensors
+        if self.text_columns is None:
+            try:
+                values.flat[:] = flat
+                # ^-- None goes in as NaN
+                return values
+            except (ValueError, TypeError):
+                self.text_columns = list()
+                self.text_columns_sensors = self.sensors
+        numeric_columns = [ j for j in xrange(n_sensors) if j not in self.text_columns ]
+        try:
+            values[:, numeric_columns] = numpy.array(
+                [ flat[j::n_sensors] for j in numeric_columns ], dtype=float).T
+            # ^-- None goes in as NaN; slicing the flat list is quicker
+            #     than zip(*self.sampled)
+        except (ValueError, TypeError):
+            for j in numeric_columns:
+                try:
+                    values[:, j] = flat[j::n_sensors]
+                except (ValueError, TypeError):
+                    self.text_columns.append(j)
+        if self.text_columns:
+            text = self.to_numbers(list(itertools.chain.from_iterable(
+                                       [ flat[j::n_sensors] for j in self.text_columns ])))
+            values[:, self.text_columns] = numpy.reshape(text, (len(self.text_columns), -1)).T
+            # ^-- all in one go, again for numpy's overheads
+        return values
+
+    def state_for(self, service, aggregates):
+        for (aggregate, operator_function, relop, value) in self.thresholds.get(service, ()):
+            if (aggregate in aggregates and operator_function is not None and
+                operator_function(aggregates[aggregate], value)):
+                return (2, " (%s %s %s)" % (aggregate, relop, value))
+        return (0, "")
+
+    def value_aggregates(self, values_array):
+        """ min, the percentiles and max of each column, ignoring NaNs, and
+        how many numbers each came from. All the columns are sorted at once
+        (NaNs sort last), rather than by nanpercentile one column at a time.
+        """
+        numeric_counts = numpy.count_nonzero(~numpy.isnan(values_array), axis=0)
+        ordered = numpy.sort(values_array, axis=0)
+        columns = numpy.arange(values_array.shape[1])
+        last = numpy.maximum(numeric_counts - 1, 0)
+        aggregates = [ ordered[0], ordered[last, columns] ]
+        for p in self.percentiles:
+            position = last * (p / 100.0)
+            below = numpy.floor(position).astype(numpy.intp)
+            above = numpy.ceil(position).astype(numpy.intp)
+            fraction = position - below
+            aggregates.append(ordered[below, columns] * (1 - fraction) +
+                              ordered[above, columns] * fraction)
+            # ^-- linear interpolation, as numpy.percentile does by default
+        return (numeric_counts, aggregates[0], aggregates[1], aggregates[2:])
+
+    def finish(self):
+        """ Works out the aggregates, and returns them as the synthetic
+        host's HostResults.
+        """
+        self.flush()
+        n = self.n_hosts
+        plan = list()
+        states = list()
+        texts = list()
+
+        if self.sensors is not None and n > 0:
+            states_array = self.states[:, :n]
+            critical_counts = numpy.count_nonzero(states_array == 2, axis=1)
+            ok_counts = numpy.count_nonzero(states_array == 0, axis=1)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                # ^-- inf - inf in interpolating, for infinite values
+                (numeric_counts, minima, maxima, percentiles) = self.value_aggregates(
+                    self.sample_values())
+            if self.sample_every > 1:
+                sampled = " of %d sampled hosts" % len(self.sampled)
+            else:
+                sampled = ""
+
+            for (j, sensor) in enumerate(self.sensors):
+                aggregates = { "critical": int(critical_counts[j]),
+                               "ok": int(ok_counts[j]) }
+                text = "%d critical, %d ok" % (aggregates["critical"], aggregates["ok"])
+                perfdata = [ "critical=%d" % aggregates["critical"],
+                             "ok=%d" % aggregates["ok"] ]
+                if numeric_counts[j] > 0:
+                    aggregates["min"] = float(minima[j])
+                    aggregates["max"] = float(maxima[j])
+                    for (p, values) in zip(self.percentiles, percentiles):
+                        aggregates["p%d" % p] = float(values[j])
+                    names = [ "min" ] + [ "p%d" % p for p in self.percentiles ] + [ "max" ]
+                    text += "; %s%s" % (", ".join([ "%s %g" % (x, aggregates[x]) for x in names ]),
+                                        sampled)
+                    perfdata.extend([ "%s=%g" % (x, aggregates[x]) for x in names ])
+                (state, reason) = self.state_for(sensor, aggregates)
+                plan.append((sensor, None))
+                states.append(state)
+                texts.append("%s%s|%s" % (text, reason, " ".join(perfdata)))
+
+        uncontactable = self.uncontactable
+        fraction = float(uncontactable) / n if n > 0 else 0.0
+        aggregates = { "count": uncontactable, "fraction": fraction }
+        (state, reason) = self.state_for("uncontactable", aggregates)
+        plan.append(("uncontactable", None))
+        states.append(state)
+        texts.append("%d of %d hosts uncontactable (%.1f%%)%s|uncontactable=%d fraction=%g" %
+                     (uncontactable, n, 100 * fraction, reason, uncontactable, fraction))
+
+        return HostResults(self.hostname, tuple(plan), states,
+                           [ None ] * len(states), texts)
@@ -0,0 +1,58 @@
+import cPickle
+import os
+import time
+
+class Snapshot:
+    """ On-disk copy of the state the daemon otherwise has to build from
+    scratch at startup: the compiled thresholds and comparators, the set of
+    hosts Icinga has, and the states last sent for each service. Starting
+    from it, the daemon can send its first results straight away, while
+    the real sources are read again in the background.
+
+    It's a pickle, tagged with a format version and the settings the
+    thresholds were built with, so that one written by a different version
+    or with different settings is ignored rather than trusted. Saving
+    writes a temporary file and renames it over the old one, so a crash
+    mid-write leaves the last good snapshot in place.
+    """
+
+    version = 1
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def load(self, settings):
+        """ Returns the saved state dict, or None if there's no usable
+        snapshot.
+        """
+        if not os.path.exists(self.path):
+            return None
+        time_start = time.time()
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                snapshot = cPickle.load(snapshot_file)
+        except Exception:
+            self.logger.exception("could not read snapshot %s, ignoring it." % self.path)
+            return None
+        if snapshot.get("version") != self.version:
+            self.logger.warn("snapshot %s is from a different version, ignoring it." % self.path)
+            return None
+        if snapshot.get("settings") != settings:
+            self.logger.warn("snapshot %s was made with different settings, ignoring it." % self.path)
+            return None
+        self.logger.info("loaded snapshot from %.0f s ago in %.3f s." %
+                         (time.time() - snapshot["saved"], time.time() - time_start))
+        return snapshot["state"]
+
+    def save(self, settings, state):
+        time_start = time.time()
+        temporary_path = "%s.tmp" % self.path
+        with open(temporary_path, "wb") as snapshot_file:
+            cPickle.dump({ "version": self.version,
+                           "settings": settings,
+                           "saved": time.time(),
+                           "state": state },
+                         snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, self.path)
+        self.logger.info("saved snapshot in %.3f s." % (time.time() - time_start))
@@ -0,0 +1,230 @@
+import mmap
+import os
+import re
+import struct
+import threading
+
+class SpooledResult(object):
+    """ A result read back from the spool: the same attributes the message
+    devices use from a CheckResult, with the output already serialised.
+    """
+    __slots__ = ("hostname", "service", "state", "output")
+
+    def __init__(self, hostname, service, state, output):
+        self.hostname = hostname
+        self.service = service
+        self.state = state
+        self.output = output
+
+    @property
+    def plugin_output(self):
+        return self.output.partition("|")[0]
+
+    @property
+    def performance_data(self):
+        return self.output.partition("|")[2]
+
+class Spool:
+    """ Append-only on-disk store for results that couldn't be delivered.
+
+    Results go into fixed-size segment files, each memory-mapped, as
+    length-prefixed records: "hostname\\tservice\\tstate\\toutput". A
+    zero length marks the end of a segment's records, which is what a new
+    (sparse, zeroed) segment file reads as, so the spool can be picked up
+    again after a restart just by scanning the segments.
+
+    Only the newest record for each host/service is worth delivering, so
+    an index of where those are is kept, and anything else is skipped when
+    reading back. Segments are read back whole, oldest first, and deleted
+    once they've been delivered. If the spool grows past max_bytes, the
+    oldest segments are thrown away.
+    """
+
+    length_format = "!I"
+    length_size = struct.calcsize(length_format)
+    segment_name_pattern = re.compile(r"^segment-(\d+)\.spool$")
+
+    def __init__(self, directory, max_bytes, segment_bytes, logger):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.segments = list()
+        # ^-- segment numbers, oldest first; the last one is written to
+        self.latest = dict()
+        # ^-- { (hostname, service): (segment number, offset) }
+        self.write_map = None
+        self.write_offset = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in os.listdir(directory):
+            match = self.segment_name_pattern.match(filename)
+            if match:
+                self.segments.append(int(match.group(1)))
+        self.segments.sort()
+        for number in self.segments:
+            for (offset, result) in self.read_segment(number):
+                self.latest[(result.hostname, result.service)] = (number, offset)
+        if self.segments:
+            self.open_segment(self.segments[-1])
+            self.logger.info("found %d undelivered results in %d spool segments." %
+                             (len(self.latest), len(self.segments)))
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "segment-%08d.spool" % number)
+
+    def map_segment(self, number):
+        with open(self.segment_path(number), "r+b") as segment_file:
+            if os.fstat(segment_file.fileno()).st_size < self.segment_bytes:
+                segment_file.truncate(self.segment_bytes)
+            return mmap.mmap(segment_file.fileno(), 0)
+
+    def iter_records(self, segment_map):
+        """ Yields (offset, record) for each record in a mapped segment.
+        """
+        offset = 0
+        while offset + self.length_size <= len(segment_map):
+            (length,) = struct.unpack_from(self.length_format, segment_map, offset)
+            if (length == 0) or (offset + self.length_size + length > len(segment_map)):
+                break
+            yield (offset, segment_map[offset + self.length_size:
+                                       offset + self.length_size + length])
+            offset += self.length_size + length
+
+    def read_segment(self, number):
+        """ Returns a list of (offset, SpooledResult) for every record in a
+        segment.
+        """
+        segment_map = self.map_segment(number)
+        try:
+            results = list()
+            for (offset, record) in self.iter_records(segment_map):
+                (hostname, service, state, output) = record.split("\t", 3)
+                results.append((offset, SpooledResult(hostname, service, int(state), output)))
+            return results
+        finally:
+            segment_map.close()
+
+    def open_segment(self, number):
+        if self.write_map is not None:
+            self.write_map.close()
+        self.write_map = self.map_segment(number)
+        self.write_offset = 0
+        for (offset, record) in self.iter_records(self.write_map):
+            self.write_offset = offset + self.length_size + len(record)
+
+    def new_segment(self):
+        if self.segments:
+            number = self.segments[-1] + 1
+        else:
+            number = 1
+        open(self.segment_path(number), "ab").close()
+        self.segments.append(number)
+        self.open_segment(number)
+        self.evict()
+
+    def evict(self):
+        """ Deletes the oldest segments (never the one being written) while
+        the spool's over max_bytes.
+        """
+        while (len(self.segments) > 1 and
+               len(self.segments) * self.segment_bytes > self.max_bytes):
+            number = self.segments[0]
+            evicted = self.forget_segment(number)
+            self.logger.warn("spool full: evicted segment %d, dropping %d undelivered results." %
+                             (number, evicted))
+
+    def forget_segment(self, number):
+        """ Deletes a segment, and drops any index entries pointing into it.
+        Returns how many there were.
+        """
+        dropped = 0
+        for (offset, result) in self.read_segment(number):
+            key = (result.hostname, result.service)
+            if self.latest.get(key) == (number, offset):
+                del self.latest[key]
+                dropped += 1
+        os.remove(self.segment_path(number))
+        self.segments.remove(number)
+        return dropped
+
+    def append(self, results):
+        """ Writes results to the spool, superseding any older records for
+        the same host/service.
+        """
+        with self.lock:
+            if self.write_map is None:
+                self.new_segment()
+            for result in results:
+                record = "%s\t%s\t%d\t%s" % (result.hostname, result.service,
+                                             result.state, result.output)
+                needed = self.length_size + len(record) + self.length_size
+                # ^-- room for the end marker too
+                if needed > self.segment_bytes:
+                    self.logger.warn("result for %s!%s too big to spool." %
+                                     (result.hostname, result.service))
+                    continue
+                if self.write_offset + needed > self.segment_bytes:
+                    self.write_map.flush()
+                    self.new_segment()
+                offset = self.write_offset
+                self.write_map[offset + self.length_size:
+                               offset + self.length_size + len(record)] = record
+                self.write_map[offset:offset + self.length_size] = struct.pack(self.length_format,
+                                                                               len(record))
+                # ^-- length last, so a half-written record reads as the end
+                self.write_offset += self.length_size + len(record)
+                self.latest[(result.hostname, result.service)] = (self.segments[-1], offset)
+            self.write_map.flush()
+
+    def supersede(self, hostname, service):
+        """ Drops the spooled result for a host/service, if there is one,
+        because a newer one has been sent.
+        """
+        if (hostname, service) in self.latest:
+            with self.lock:
+                self.latest.pop((hostname, service), None)
+
+    def take_oldest(self):
+        """ Returns the number of the oldest segment, starting a new one to
+        write to first if that's the one being written. None if the spool's
+        empty.
+        """
+        with self.lock:
+            if len(self.segments) == 0:
+                return None
+            if len(self.segments) == 1:
+                if self.write_offset == 0:
+                    return None
+                self.write_map.flush()
+                self.new_segment()
+            return self.segments[0]
+
+    def read_live(self, number):
+        """ Returns the results in a segment that are still the newest for
+        their host/service, as (offset, SpooledResult).
+        """
+        with self.lock:
+            return [ (offset, result) for (offset, result) in self.read_segment(number)
+                     if self.latest.get((result.hostname, result.service)) == (number, offset) ]
+
+    def delivered(self, number, records):
+        """ Drops the index entries for (offset, SpooledResult) records
+        from a segment that have now been delivered.
+        """
+        with self.lock:
+            for (offset, result) in records:
+                key = (result.hostname, result.service)
+                if self.latest.get(key) == (number, offset):
+                    del self.latest[key]
+
+    def is_live(self, number, record):
+        (offset, result) = record
+        return self.latest.get((result.hostname, result.service)) == (number, offset)
+
+    def remove_segment(self, number):
+        with self.lock:
+            if number in self.segments:
+                self.forget_segment(number)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from Spool import Spool
+
+class MessageDevice:
+    """ Wraps another message device so that results it can't deliver are
+    kept in an on-disk Spool instead of being lost, and replayed later.
+
+    Results the wrapped device reports as undelivered are appended to the
+    spool. A background thread tries to deliver the spool's contents every
+    spool_drain_interval seconds, at no more than spool_drain_rate results
+    a second so the sink doesn't get everything at once when it comes back,
+    and gives up until next time as soon as anything fails again. Any
+    spooled result for a host/service that's since been sent afresh is
+    dropped.
+    """
+
+    def __init__(self, config, logger, device):
+        self.config = config
+        self.logger = logger
+        self.device = device
+        self.spool = Spool(config["spool_directory"],
+                           config["spool_max_bytes"],
+                           config["spool_segment_bytes"],
+                           logger)
+        self.drain_rate = config["spool_drain_rate"]
+        self.drain_interval = config["spool_drain_interval"]
+        self.drainer = None
+        self.send_lock = threading.Lock()
+        # ^-- the sender and the drainer take turns with the device, since
+        #     not all of them can be used from two threads at once
+
+    def start_drainer(self):
+        # Started on first use rather than in __init__, since daemonising
+        #  happens in between and threads don't survive it.
+        self.drainer = threading.Thread(target=self.drain_loop, name="spool-drain")
+        self.drainer.daemon = True
+        self.drainer.start()
+
+    def superseding(self, message_quads):
+        for message_quad in message_quads:
+            self.spool.supersede(message_quad.hostname, message_quad.service)
+            yield message_quad
+
+    def spool_results(self, results):
+        self.spool.append(results)
+        self.logger.warn("spooled %d undelivered results." % len(results))
+
+    def send_message_quads(self, message_quads, undelivered=None):
+        if self.drainer is None:
+            self.start_drainer()
+        with self.send_lock:
+            self.device.send_message_quads(self.superseding(message_quads),
+                                           self.spool_results)
+
+    def drain_loop(self):
+        while True:
+            time.sleep(self.drain_interval)
+            try:
+                self.drain()
+            except Exception:
+                self.logger.exception("could not drain the spool.")
+
+    def drain(self):
+        """ Replays spooled results, oldest segment first, until the spool's
+        empty or the sink fails again.
+        """
+        while True:
+            number = self.spool.take_oldest()
+            if number is None:
+                return
+            records = self.spool.read_live(number)
+            replayed = 0
+            for start in xrange(0, len(records), self.drain_rate):
+                time_start = time.time()
+                chunk = [ x for x in records[start:start + self.drain_rate]
+                          if self.spool.is_live(number, x) ]
+                if len(chunk) == 0:
+                    continue
+                failed = list()
+                with self.send_lock:
+                    self.device.send_message_quads([ x[1] for x in chunk ], failed.extend)
+                if failed:
+                    failed = set([ id(x) for x in failed ])
+                    self.spool.delivered(number, [ x for x in chunk if id(x[1]) not in failed ])
+                    self.logger.warn("spool replay stopped: %d results still undelivered." %
+                                     len(failed))
+                    return
+                self.spool.delivered(number, chunk)
+                replayed += len(chunk)
+                time.sleep(max(0, 1 - (time.time() - time_start)))
+            self.spool.remove_segment(number)
+            self.logger.info("replayed %d results from spool segment %d." %
+                             (replayed, number))
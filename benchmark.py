@@ -0,0 +1,1250 @@
+#!/usr/bin/env python
+
+""" Offline benchmarks for the daemon.
+
+Generates fake SGE command output (or uses output captured from a real
+cluster), puts stand-in `qhost` and `qconf` commands that print it at the
+front of the PATH, and times the daemon's own functions against it.
+No SGE or Icinga is needed.
+
+Run from the directory with the scripts in, e.g.:
+
+    ./benchmark.py --hosts 10000 --sensors 30
+    ./benchmark.py --qhost-F captured.txt --qhost-xml captured.xml
+    ./benchmark.py --stages pipeline --pipeline-sizes 100x10 5000x100 20000x300
+"""
+
+import argparse
+import BaseHTTPServer
+import gc
+import itertools
+import json
+import logging
+import os
+import Queue
+import resource
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+import sge_to_icinga_d
+from CheckResult import HostResults
+import DummyMessageDevice
+import Metrics
+import NSCAMessageDevice
+import Rollup
+import NSCAProtocolMessageDevice
+
+failures = list()
+
+def check(condition, message):
+    """ Notes a failed expectation, printing it where it happened, so the
+    run can carry on with the other stages but still exit non-zero.
+    """
+    if not condition:
+        print "  FAILED: %s" % message
+        failures.append(message)
+    return condition
+
+def make_sensor_names(n_sensors):
+    # qhost-F.yaml.sh only recognises sensor names made of [a-z_], so the
+    #  index is spelt in letters: sensor_aaa, sensor_aab, ...
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [ "sensor_%s%s%s" % (letters[i / 676 % 26], letters[i / 26 % 26], letters[i % 26])
+             for i in range(n_sensors) ]
+
+def make_hostnames(n_hosts):
+    # qhost-F.yaml.sh only recognises hosts shaped like node-....-...
+    return [ "node-x%03d-%03d" % (i / 100, i % 100) for i in range(n_hosts) ]
+
+def sensor_type(sensor_index):
+    if sensor_index % 3 == 2:
+        return "MEMORY"
+    return "INT"
+
+def sensor_value(host_index, sensor_index):
+    if sensor_type(sensor_index) == "MEMORY":
+        return "%d.%dG" % ((host_index + sensor_index) % 500, host_index % 10)
+    return "%d" % ((host_index * 7 + sensor_index) % 4)
+
+def sensor_threshold(sensor_index):
+    if sensor_type(sensor_index) == "MEMORY":
+        return "20G"
+    return 3
+
+def make_thresholds(hostnames, sensor_names):
+    """ The dict get_threshold_dict would make, with thresholds on every
+    other sensor.
+    """
+    thresholds = dict()
+    for hostname in hostnames:
+        host_thresholds = { "hostname": hostname,
+                            "qname": "all.q@%s" % hostname }
+        for (i, name) in enumerate(sensor_names):
+            if i % 2 == 0:
+                host_thresholds[name] = sensor_threshold(i)
+        thresholds[hostname] = host_thresholds
+    return thresholds
+
+def make_per_host_thresholds_yaml(hostnames, sensor_names):
+    """ Fake per-host-thresholds.yaml.sh output, for the same thresholds as
+    make_thresholds.
+    """
+    lines = list()
+    for hostname in hostnames:
+        lines.append("- hostname: %s" % hostname)
+        lines.append("  qname: all.q@%s" % hostname)
+        for (i, name) in enumerate(sensor_names):
+            if i % 2 == 0:
+                lines.append("  %s: %s" % (name, sensor_threshold(i)))
+    return '\n'.join(lines) + "\n"
+
+def make_qconf_sq(hostnames, sensor_names, single_line=True):
+    """ Fake `qconf -sq "*@*"` output: each host has an all.q instance with
+    the same thresholds as make_thresholds, and a short.q instance with a
+    stricter threshold on just the first sensor. Without single_line, long
+    values are continued over several lines, as qconf does without
+    SGE_SINGLE_LINE.
+    """
+    if single_line:
+        separator = ","
+    else:
+        separator = ",\\\n" + " " * 22
+    lines = list()
+    for hostname in hostnames:
+        for (qname, load_thresholds) in (
+                ("all.q", [ "%s=%s" % (name, sensor_threshold(i))
+                            for (i, name) in enumerate(sensor_names) if i % 2 == 0 ]),
+                ("short.q", [ "%s=%s" % (sensor_names[0], 2) ])):
+            lines.append("%-21s %s" % ("qname", qname))
+            lines.append("%-21s %s" % ("hostname", hostname))
+            lines.append("%-21s %s" % ("seq_no", 0))
+            lines.append("%-21s %s" % ("load_thresholds", separator.join(load_thresholds)))
+            lines.append("%-21s %s" % ("suspend_thresholds", "NONE"))
+            lines.append("%-21s %s" % ("nsuspend", 1))
+            lines.append("%-21s %s" % ("suspend_interval", "00:05:00"))
+            lines.append("%-21s %s" % ("priority", 0))
+            lines.append("%-21s %s" % ("qtype", "BATCH INTERACTIVE"))
+            lines.append("%-21s %s" % ("pe_list", separator.join([ "make", "smp", "mpi" ])))
+            lines.append("%-21s %s" % ("rerun", "FALSE"))
+            lines.append("%-21s %s" % ("slots", 16))
+            lines.append("%-21s %s" % ("tmpdir", "/tmp"))
+            lines.append("%-21s %s" % ("shell", "/bin/bash"))
+            lines.append("%-21s %s" % ("user_lists", "NONE"))
+            lines.append("%-21s %s" % ("complex_values", "NONE"))
+            lines.append("%-21s %s" % ("s_rt", "INFINITY"))
+            lines.append("%-21s %s" % ("h_rt", "INFINITY"))
+            lines.append("%-21s %s" % ("h_vmem", "INFINITY"))
+    return '\n'.join(lines) + "\n"
+
+def make_qstat_explain(hostnames, sensor_names, uncontactable_every=50, alarm_every=7):
+    """ Fake `qstat -explain aAcE -F <sensors>` output for the same hosts as
+    make_qhost_F: an all.q and a short.q instance on each, with the
+    uncontactable ones in state au with an error for each sensor, and
+    every alarm_every'th host in load alarm on the first sensor.
+    """
+    lines = [ "queuename                      qtype resv/used/tot. load_avg arch          states",
+              "---------------------------------------------------------------------------------" ]
+    for (h, hostname) in enumerate(hostnames):
+        for qname in ("all.q", "short.q"):
+            queue = "%s@%s" % (qname, hostname)
+            if h % uncontactable_every == uncontactable_every - 1:
+                lines.append("%-30s BIP   0/0/16         -NA-     -NA-          au" % queue)
+                for name in sensor_names:
+                    lines.append("\terror: no value for \"%s\" because execd is in unknown state" % name)
+            elif h % alarm_every == 0:
+                lines.append("%-30s BIP   0/4/16         0.01     lx-amd64      a" % queue)
+                lines.append("\talarm hl:%s=%s load-threshold=%s" %
+                             (sensor_names[0], sensor_value(h, 0), sensor_threshold(0)))
+            else:
+                lines.append("%-30s BIP   0/4/16         0.01     lx-amd64" % queue)
+            if not (h % uncontactable_every == uncontactable_every - 1):
+                for (i, name) in enumerate(sensor_names):
+                    lines.append("\thl:%s=%s" % (name, sensor_value(h, i)))
+            lines.append("---------------------------------------------------------------------------------")
+    return '\n'.join(lines) + "\n"
+
+def make_threshold_comparators(sensor_names):
+    """ Fake threshold_comparators.sh output: name, relop, type.
+    """
+    lines = [ "arch == STRING" ]
+    for line in make_qconf_sc(sensor_names).split("\n"):
+        fields = line.split()
+        if len(fields) > 3 and fields[0][0] != "#":
+            lines.append("%s %s %s" % (fields[0], fields[3], fields[2]))
+    return '\n'.join(lines) + "\n"
+
+def make_qconf_sc(sensor_names):
+    """ Fake `qconf -sc` output: each sensor is a complex with a _nagtxt
+    partner, like the load sensors on a real cell.
+    """
+    lines = [ "#name                      shortcut                   type       relop   requestable consumable default  urgency ",
+              "#----------------------------------------------------------------------------------------------------------------",
+              "arch                       a                          STRING     ==      YES         NO         NONE     0" ]
+    for (i, name) in enumerate(sensor_names):
+        if sensor_type(i) == "MEMORY":
+            relop = "<="
+        else:
+            relop = ">="
+        lines.append("%-26s %-26s %-10s %-7s NO          NO         0        0" %
+                     (name, name, sensor_type(i), relop))
+        lines.append("%-26s %-26s %-10s %-7s NO          NO         NONE     0" %
+                     ("%s_nagtxt" % name, "%s_nagtxt" % name, "STRING", "=="))
+    lines.append("# >#< starts a comment but comments are not saved across edits --------")
+    return '\n'.join(lines) + "\n"
+
+def make_qhost_F(hostnames, sensor_names, uncontactable_every=50):
+    """ Fake `qhost -F` output, laid out the way qhost lays it out.
+    """
+    lines = [ "HOSTNAME                ARCH         NCPU NSOC NCOR NTHR  LOAD  MEMTOT  MEMUSE  SWAPTO  SWAPUS",
+              "----------------------------------------------------------------------------------------------",
+              "global                  -               -    -    -    -     -       -       -       -       -" ]
+    for (h, hostname) in enumerate(hostnames):
+        if h % uncontactable_every == uncontactable_every - 1:
+            lines.append("%-23s -               -    -    -    -     -       -       -       -       -" % hostname)
+            continue
+        lines.append("%-23s lx-amd64       16    2   16   16  0.01   62.9G    2.1G    4.0G     0.0" % hostname)
+        lines.append("   hl:arch=lx-amd64")
+        lines.append("   hl:num_proc=16.000000")
+        for (i, name) in enumerate(sensor_names):
+            value = sensor_value(h, i)
+            lines.append("   hl:%s=%s" % (name, value))
+            lines.append("   hl:%s_nagtxt=%s reads %s" % (name, name, value))
+    return '\n'.join(lines) + "\n"
+
+def make_qhost_xml(hostnames, sensor_names, uncontactable_every=50):
+    """ Fake `qhost -xml -F` output, with the same content as make_qhost_F.
+    """
+    dashes = ''.join([ "   <hostvalue name='%s'>-</hostvalue>\n" % x
+                       for x in ("arch_string", "num_proc", "load_avg", "mem_total") ])
+    lines = [ "<?xml version='1.0'?>",
+              "<qhost xmlns:xsd=\"http://gridengine.sunsource.net/source/browse/*checkout*/gridengine/source/dist/util/resources/schemas/qhost/qhost.xsd?revision=1.2\">",
+              " <host name='global'>\n%s </host>" % dashes ]
+    for (h, hostname) in enumerate(hostnames):
+        lines.append(" <host name=%s>" % quoteattr(hostname))
+        if h % uncontactable_every == uncontactable_every - 1:
+            lines.append(dashes + " </host>")
+            continue
+        lines.append("   <hostvalue name='arch_string'>lx-amd64</hostvalue>")
+        lines.append("   <hostvalue name='num_proc'>16</hostvalue>")
+        lines.append("   <resourcevalue name='arch' dominance='hl'>lx-amd64</resourcevalue>")
+        for (i, name) in enumerate(sensor_names):
+            value = sensor_value(h, i)
+            lines.append("   <resourcevalue name='%s' dominance='hl'>%s</resourcevalue>" %
+                         (name, value))
+            lines.append("   <resourcevalue name='%s_nagtxt' dominance='hl'>%s</resourcevalue>" %
+                         (name, escape("%s reads %s" % (name, value))))
+        lines.append(" </host>")
+    lines.append("</qhost>")
+    return '\n'.join(lines) + "\n"
+
+
+class FakeSGE:
+    """ A temporary directory of stand-in SGE commands that print canned
+    output, put at the front of the PATH for as long as it's in use.
+
+    The commands named in hung never print anything or finish, as when
+    the qmaster's stopped answering. Those named in failing print the
+    first 1000 lines of their output and then exit 1, as when it goes
+    down (or fails over) part-way through.
+    """
+    def __init__(self, outputs, hung=(), failing=()):
+        self.directory = tempfile.mkdtemp(prefix="sge_to_icinga_bench.")
+        self.old_path = os.environ.get("PATH", "")
+        scripts = dict()
+        for (name, text) in outputs.items():
+            with open(os.path.join(self.directory, name), "w") as f:
+                f.write(text)
+        # qhost's output depends on whether -xml was asked for
+        scripts["qhost"] = ("#!/bin/sh\n"
+                            "case \" $* \" in *\" -xml \"*) exec cat %s/qhost-xml ;; esac\n"
+                            "exec cat %s/qhost-F\n" % (self.directory, self.directory))
+        # and qconf's on whether it's -sq or -sc
+        scripts["qconf"] = ("#!/bin/sh\n"
+                            "case \" $* \" in *\" -sq \"*) exec cat %s/qconf-sq ;; esac\n"
+                            "exec cat %s/qconf-sc\n" % (self.directory, self.directory))
+        for name in hung:
+            scripts[name] = "#!/bin/sh\nsleep 3600 | cat\n"
+            # ^-- a pipeline, like the helper scripts, so there's more than
+            #     one process to kill
+        for name in failing:
+            scripts[name + ".whole"] = scripts[name]
+            scripts[name] = ("#!/bin/sh\n"
+                             "%s/%s.whole \"$@\" 2>/dev/null | head -n 1000\n"
+                             "exit 1\n" % (self.directory, name))
+        for (name, text) in scripts.items():
+            path = os.path.join(self.directory, name)
+            with open(path, "w") as f:
+                f.write(text)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    def __enter__(self):
+        os.environ["PATH"] = "%s:%s" % (self.directory, self.old_path)
+        return self
+
+    def __exit__(self, *_):
+        os.environ["PATH"] = self.old_path
+        shutil.rmtree(self.directory)
+
+
+class FakeNSCAServer:
+    """ A stand-in NSCA daemon on a local port. Sends the init packet on each
+    connection, then decrypts and checks every data packet it receives,
+    counting the good and bad ones.
+    """
+    def __init__(self, password="", encryption=1, max_output_length=512):
+        self.password = password
+        self.encryption = encryption
+        self.packet_format = NSCAProtocolMessageDevice.nsca_packet_format(max_output_length)
+        self.packet_length = struct.calcsize(self.packet_format)
+        self.good = 0
+        self.bad = 0
+        self.lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept_connections)
+        thread.daemon = True
+        thread.start()
+
+    def accept_connections(self):
+        while True:
+            (connection, _) = self.listener.accept()
+            thread = threading.Thread(target=self.handle_connection, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def check_packet(self, packet, key):
+        if self.encryption == NSCAProtocolMessageDevice.NSCA_ENCRYPT_XOR:
+            packet = NSCAProtocolMessageDevice.xor_crypt(packet, key)
+        fields = list(struct.unpack(self.packet_format, packet))
+        crc = fields[1]
+        fields[1] = 0
+        return ((fields[0] == NSCAProtocolMessageDevice.NSCA_PACKET_VERSION) and
+                (zlib.crc32(struct.pack(self.packet_format, *fields)) & 0xffffffff == crc) and
+                (fields[4].rstrip("\0") != ""))
+
+    def handle_connection(self, connection):
+        iv = os.urandom(NSCAProtocolMessageDevice.NSCA_IV_LENGTH)
+        connection.sendall(iv + struct.pack("!L", int(time.time())))
+        key = NSCAProtocolMessageDevice.xor_key(self.packet_length, iv, self.password)
+        buffer = ""
+        while True:
+            data = connection.recv(65536)
+            if data == "":
+                break
+            buffer += data
+            good = 0
+            bad = 0
+            offset = 0
+            while len(buffer) - offset >= self.packet_length:
+                if self.check_packet(buffer[offset:offset + self.packet_length], key):
+                    good += 1
+                else:
+                    bad += 1
+                offset += self.packet_length
+            buffer = buffer[offset:]
+            with self.lock:
+                self.good += good
+                self.bad += bad
+        connection.close()
+
+    def wait_for(self, n_packets, timeout=60):
+        time_limit = time.time() + timeout
+        while (self.good + self.bad < n_packets) and (time.time() < time_limit):
+            time.sleep(0.01)
+
+
+class FakeIcingaAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # ^-- so that connections are kept alive, as with the real API
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # ^-- the reply goes out in one write, flushed at the end of each
+    #     request, rather than header by header; otherwise Nagle and
+    #     delayed ACKs hold every response up, and the numbers measure
+    #     this stand-in rather than the device
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = (server.fail_every > 0) and (server.requests % server.fail_every == 0)
+        try:
+            payload = json.loads(body)
+            valid = (self.path.startswith("/v1/actions/process-check-result") and
+                     "!" in query["service"][0] and
+                     "exit_status" in payload and "plugin_output" in payload)
+        except (ValueError, KeyError):
+            valid = False
+        if fail:
+            status = 503
+        elif valid:
+            status = 200
+            with server.lock:
+                server.accepted += 1
+        else:
+            status = 400
+        reply = json.dumps({ "results": [ { "code": status } ] })
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *_):
+        pass
+
+class FakeIcingaAPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A stand-in for the Icinga2 API's process-check-result action on a
+    local port, which fails every fail_every'th request with a 503 so that
+    retries get exercised.
+    """
+    daemon_threads = True
+
+    def __init__(self, fail_every=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeIcingaAPIHandler)
+        self.fail_every = fail_every
+        self.requests = 0
+        self.accepted = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def make_message_quads(hostnames, sensor_names):
+    plan = tuple([ (name, "") for name in sensor_names ])
+    # ^-- just the parts of an evaluation plan HostResults uses
+    return [ result
+             for (h, hostname) in enumerate(hostnames)
+             for result in HostResults(hostname, plan,
+                                       [ (h + i) % 3 for i in range(len(sensor_names)) ],
+                                       [ h ] * len(sensor_names),
+                                       [ "%s reads %d" % (name, h) for name in sensor_names ]) ]
+
+class CannedCommands:
+    """ Substitutes the daemon's get_command_output and
+    get_command_output_lines with versions that return canned output,
+    keyed by the command, so no processes are run at all.
+
+    delays gives commands a wait before their output starts, standing in
+    for the time qhost and qstat spend waiting on the qmaster.
+    """
+    def __init__(self, outputs, delays=dict()):
+        self.outputs = outputs
+        self.delays = delays
+
+    def get_command_output(self, command, args=(), deadline=None):
+        return self.outputs[" ".join([ command ] + list(args))]
+
+    def get_command_output_lines(self, command_args, deadline=None):
+        command = " ".join(command_args)
+        time.sleep(self.delays.get(command, 0))
+        for line in self.outputs[command].splitlines(True):
+            yield line
+
+    def __enter__(self):
+        self.originals = (sge_to_icinga_d.get_command_output,
+                          sge_to_icinga_d.get_command_output_lines)
+        sge_to_icinga_d.get_command_output = self.get_command_output
+        sge_to_icinga_d.get_command_output_lines = self.get_command_output_lines
+        return self
+
+    def __exit__(self, *_):
+        (sge_to_icinga_d.get_command_output,
+         sge_to_icinga_d.get_command_output_lines) = self.originals
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_stage(stage_name, function, *args):
+    """ Runs one pipeline stage, printing its wall time, the process's
+    peak RSS afterwards (and how much the stage raised it), and the change
+    in the number of live objects the garbage collector tracks (Python 2
+    has no allocation tracing, and tuples of strings aren't tracked, so
+    this undercounts).
+    Returns whatever the stage returned.
+    """
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    rss_before = peak_rss_kb()
+    time_start = time.time()
+    result = function(*args)
+    seconds = time.time() - time_start
+    rss_after = peak_rss_kb()
+    objects_after = len(gc.get_objects())
+    print "  %-16s %8.3f s  peak RSS %8d KB (+%7d KB)  %+9d gc objects" % (
+            stage_name, seconds, rss_after, rss_after - rss_before,
+            objects_after - objects_before)
+    return result
+
+def time_collector(collector, comparators):
+    """ Runs one collector to completion, returns (seconds, hosts seen).
+    """
+    time_start = time.time()
+    hosts = 0
+    for _ in sge_to_icinga_d.get_host_data_generator(comparators, collector):
+        hosts += 1
+    return (time.time() - time_start, hosts)
+
+def bench_collectors(args):
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    outputs = { "qconf-sc": make_qconf_sc(sensor_names) }
+    if args.qhost_F is not None:
+        outputs["qhost-F"] = open(args.qhost_F).read()
+    else:
+        outputs["qhost-F"] = make_qhost_F(hostnames, sensor_names)
+    if args.qhost_xml is not None:
+        outputs["qhost-xml"] = open(args.qhost_xml).read()
+    else:
+        outputs["qhost-xml"] = make_qhost_xml(hostnames, sensor_names)
+
+    print "collectors: %d bytes of qhost -F, %d bytes of qhost -xml -F" % (
+            len(outputs["qhost-F"]), len(outputs["qhost-xml"]))
+    with FakeSGE(outputs):
+        comparators = sge_to_icinga_d.get_sensor_comparator_dict()
+        for collector in args.collectors:
+            (seconds, hosts) = time_collector(collector, comparators)
+            print "  %-8s %8.3f s  %6d hosts" % (collector, seconds, hosts)
+
+
+def uncompiled_compare(host_docs, thresholds, comparators):
+    """ The comparison loop as it was before evaluation plans, kept here
+    as the baseline to measure them against.
+    """
+    messages = list()
+    for host_data in host_docs:
+        hostname = host_data["hostname"]
+        if hostname == "global" or not thresholds.has_key(hostname):
+            continue
+        errors = dict()
+        for k in comparators.keys():
+            if ((k[-7:] != "_nagtxt") and
+                comparators.has_key("%s_nagtxt" % k) and
+                not k in ["hostname","qname"]):
+                if thresholds[hostname].has_key(k) and host_data.has_key(k):
+                    result = sge_to_icinga_d.compare_datum(host_data[k], thresholds[hostname][k], comparators[k])
+                else:
+                    result = 0
+                if comparators[k][1] == "MEMORY":
+                    append_to_value = "B"
+                else:
+                    append_to_value = ""
+                if host_data.has_key("%s_nagtxt" % k) and host_data.has_key(k):
+                    data_string = "%s|%s=%s%s" % (host_data["%s_nagtxt" % k], k, str(host_data[k]), append_to_value)
+                elif host_data.has_key(k):
+                    data_string = "%s%s|%s=%s%s" % (host_data[k], append_to_value, k, str(host_data[k]), append_to_value)
+                elif errors.has_key(k):
+                    result = 2
+                    data_string = errors[k]
+                else:
+                    data_string = "0"
+                messages.append((hostname, k, result, data_string))
+    return messages
+
+def compiled_compare(host_docs, plans):
+    messages = list()
+    for host_data in host_docs:
+        plan = plans.get(host_data["hostname"])
+        if plan is not None:
+            messages.append(sge_to_icinga_d.evaluate_host(host_data["hostname"], host_data, plan))
+    return messages
+
+def bench_compare(args):
+    """ Per-cycle CPU time of the comparison step alone, with and without
+    precompiled evaluation plans, on already-parsed host data.
+    """
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    comparators = dict()
+    for line in make_qconf_sc(sensor_names).split("\n"):
+        fields = line.split()
+        if len(fields) > 3 and fields[0][0] != "#":
+            comparators[fields[0]] = (sge_to_icinga_d.cmp_op_from_string(fields[3]), fields[2])
+    thresholds = make_thresholds(hostnames, sensor_names)
+    host_docs = list(sge_to_icinga_d.parse_qhost_F(
+                        make_qhost_F(hostnames, sensor_names).splitlines(True),
+                        sge_to_icinga_d.get_nagtxt_sensor_names(comparators)))
+
+    cpu_start = time.clock()
+    before = uncompiled_compare(host_docs, thresholds, comparators)
+    cpu_before = time.clock() - cpu_start
+
+    cpu_start = time.clock()
+    plans = sge_to_icinga_d.compile_evaluation_plans(thresholds, comparators)
+    cpu_compile = time.clock() - cpu_start
+
+    cpu_start = time.clock()
+    after = compiled_compare(host_docs, plans)
+    cpu_after = time.clock() - cpu_start
+
+    print "compare: %d hosts x %d sensors, %d messages" % (args.hosts, args.sensors, len(before))
+    print "  uncompiled        %8.3f s CPU per cycle" % cpu_before
+    print "  evaluation plans  %8.3f s CPU per cycle (+ %.3f s once, to compile)" % (cpu_after, cpu_compile)
+    if sorted(before) != sorted([ tuple(x) for x in itertools.chain.from_iterable(after) ]):
+        print "  WARNING: the two methods produced different messages"
+    print "  message tuples    %8d bytes by size_of_messages" % sge_to_icinga_d.size_of_messages(before)
+    print "  HostResults       %8d bytes by size_of_messages" % sge_to_icinga_d.size_of_messages(after)
+
+
+def bench_nsca(args):
+    """ Throughput of the built-in NSCA client against a stand-in listener,
+    and of send_nsca too if one was given to run.
+    """
+    quads = make_message_quads(make_hostnames(args.hosts), make_sensor_names(args.sensors))
+    config = { "nsca_dest_host": "127.0.0.1",
+               "nsca_password": "benchmark",
+               "nsca_encryption": NSCAProtocolMessageDevice.NSCA_ENCRYPT_XOR,
+               "nsca_timeout": 10,
+               "nsca_max_output_length": 512,
+               "nsca_workers": 4,
+               "nsca_batch_results": 500,
+               "nsca_batch_bytes": 65536,
+               "nsca_batch_timeout": 10,
+               "nsca_batch_retries": 2,
+               "message_copy": False }
+    logger = logging.getLogger("SGE2NSCA")
+    print "nsca: %d results" % len(quads)
+
+    server = FakeNSCAServer(config["nsca_password"], config["nsca_encryption"])
+    config["nsca_port"] = server.port
+    device = NSCAProtocolMessageDevice.MessageDevice(config, logger)
+    undelivered = list()
+    time_start = time.time()
+    device.send_message_quads(quads, undelivered.extend)
+    server.wait_for(len(quads))
+    seconds = time.time() - time_start
+    device.close()
+    print "  built-in client  %8.3f s  %8.0f results/s  %d good, %d bad packets" % (
+            seconds, len(quads) / seconds, server.good, server.bad)
+    check(server.good == len(quads) and server.bad == 0,
+          "built-in NSCA client: %d good, %d bad packets for %d results" % (
+              server.good, server.bad, len(quads)))
+    check(len(undelivered) == 0,
+          "built-in NSCA client handed back %d results undelivered" % len(undelivered))
+
+    if args.send_nsca is None:
+        print "  send_nsca        (skipped: use --send-nsca to give a binary to compare)"
+        return
+    server = FakeNSCAServer(config["nsca_password"], config["nsca_encryption"])
+    config["nsca_port"] = server.port
+    nsca_config_file = tempfile.NamedTemporaryFile(prefix="send_nsca.", suffix=".cfg")
+    nsca_config_file.write("password=%s\nencryption_method=%d\n" %
+                           (config["nsca_password"], config["nsca_encryption"]))
+    nsca_config_file.flush()
+    device = NSCAMessageDevice.MessageDevice(config, logger,
+                                             nsca_send_command=args.send_nsca,
+                                             nsca_config_file=nsca_config_file.name)
+    time_start = time.time()
+    device.send_message_quads(quads)
+    server.wait_for(len(quads), timeout=5)
+    seconds = time.time() - time_start
+    print "  send_nsca        %8.3f s  %8.0f results/s  %d good, %d bad packets" % (
+            seconds, server.good / seconds, server.good, server.bad)
+    check(server.good == len(quads) and server.bad == 0,
+          "send_nsca: %d good, %d bad packets for %d results" % (
+              server.good, server.bad, len(quads)))
+
+
+def bench_api(args):
+    """ Throughput of the Icinga API message device against a stand-in
+    API server.
+    """
+    import IcingaAPIMessageDevice
+    quads = make_message_quads(make_hostnames(args.hosts), make_sensor_names(args.sensors))
+    server = FakeIcingaAPIServer(fail_every=1000)
+    config = { "icinga_server": "http://127.0.0.1:%d" % server.server_address[1],
+               "icinga_username": "icinga",
+               "icinga_password": "icinga",
+               "icinga_api_endpoints": [],
+               "icinga_api_workers": 8,
+               "icinga_api_timeout": 10,
+               "icinga_api_retries": 2 }
+    device = IcingaAPIMessageDevice.MessageDevice(config, logging.getLogger("SGE2NSCA"),
+                                                  retry_backoff=0.01)
+    undelivered = list()
+    time_start = time.time()
+    device.send_message_quads(quads, undelivered.extend)
+    seconds = time.time() - time_start
+    print "api: %d results" % len(quads)
+    print "  icinga_api       %8.3f s  %8.0f results/s  %d accepted, %d requests" % (
+            seconds, len(quads) / seconds, server.accepted, server.requests)
+    check(server.accepted == len(quads),
+          "icinga_api: %d of %d results accepted" % (server.accepted, len(quads)))
+    check(len(undelivered) == 0,
+          "icinga_api handed back %d results undelivered" % len(undelivered))
+
+
+def make_delta_cycle(hostnames, plan, cycle, change_every=100):
+    """ One cycle's results for bench_delta: every datum drifts every cycle,
+    as load and free memory do. Two sensors in three have _nagtxt text,
+    which only changes with the state; the third is a bare datum. One
+    result in change_every changes state each cycle.
+    """
+    n_sensors = len(plan)
+    results = list()
+    for (h, hostname) in enumerate(hostnames):
+        states = [ int((h * n_sensors + i + cycle) % change_every == 0)
+                   for i in range(n_sensors) ]
+        values = [ (h + i + cycle * 7) % 1000 for i in range(n_sensors) ]
+        texts = [ (None if i % 3 == 2 else "%s %s" % (plan[i][0], ("OK", "WARNING")[states[i]]))
+                  for i in range(n_sensors) ]
+        results.append(HostResults(hostname, plan, states, values, texts))
+    return results
+
+def bench_delta(args):
+    """ What delta_only saves: the fraction of results ResultCache holds
+    back over an hour of cycles at the default check_interval, for a
+    couple of freshness thresholds, with the default heartbeat_fraction.
+    """
+    check_interval = 120
+    heartbeat_fraction = 0.5
+    hours = 1
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    plan = tuple([ (name, "") for name in sensor_names ])
+    n_cycles = hours * 3600 / check_interval
+    print "delta: %d hosts x %d sensors, %d cycles %d s apart" % (
+            args.hosts, args.sensors, n_cycles, check_interval)
+    for freshness_threshold in (600, 2400):
+        cache = sge_to_icinga_d.ResultCache(freshness_threshold * heartbeat_fraction)
+        total = 0
+        sent = 0
+        filter_seconds = 0
+        for cycle in range(n_cycles + 1):
+            results = make_delta_cycle(hostnames, plan, cycle)
+            time_start = time.time()
+            for _ in cache.filter(itertools.chain.from_iterable(results),
+                                  now=cycle * check_interval):
+                sent += 1
+            filter_seconds += time.time() - time_start
+            cache.commit()
+            if cycle > 0:
+                total += args.hosts * args.sensors
+            else:
+                sent = 0
+                # ^-- the first cycle sends everything whatever the cache does
+        print "  freshness %5d s  sent %8d of %8d (%.1f%% suppressed), %.3f s per cycle filtering" % (
+                freshness_threshold, sent, total, 100.0 * (total - sent) / total,
+                filter_seconds / (n_cycles + 1))
+
+
+def send_to_dummy_device(messages):
+    """ Sends through DummyMessageDevice, with its stdout thrown away.
+    """
+    device = DummyMessageDevice.MessageDevice(None)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        device.send_message_quads(messages)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def bench_pipeline_once(n_hosts, n_sensors, collector):
+    sensor_names = make_sensor_names(n_sensors)
+    hostnames = make_hostnames(n_hosts)
+    outputs = { "threshold_comparators.sh": make_threshold_comparators(sensor_names),
+                "qconf -sq *@*": make_qconf_sq(hostnames, sensor_names),
+                "qhost -F": make_qhost_F(hostnames, sensor_names),
+                "qhost -xml -F": make_qhost_xml(hostnames, sensor_names) }
+    print "pipeline: %d hosts x %d sensors, %s collector" % (n_hosts, n_sensors, collector)
+    with CannedCommands(outputs):
+        message_maker = measure_stage("load thresholds", sge_to_icinga_d.MessageMaker, collector)
+        measure_stage("streamed (dummy)", send_to_dummy_device,
+                      itertools.chain.from_iterable(message_maker.iter_make()))
+        # ^-- first, since peak RSS only goes up: the stages after it
+        #     hold the whole message list, as the daemon used to
+        messages = measure_stage("collect+compare", message_maker.make)
+        measure_stage("hosts/services", sge_to_icinga_d.make_hosts_services_dict, messages)
+        measure_stage("send (dummy)", send_to_dummy_device,
+                      itertools.chain.from_iterable(messages))
+    print "  %d messages, %d bytes by size_of_messages" % (
+            sum([ len(x) for x in messages ]), sge_to_icinga_d.size_of_messages(messages))
+
+def bench_pipeline(args):
+    """ The whole collect -> compare -> send pipeline, on canned command
+    output, at each of a range of cluster sizes.
+    """
+    for size in args.pipeline_sizes:
+        (n_hosts, n_sensors) = [ int(x) for x in size.split("x") ]
+        collector = args.collectors[-1]
+        if collector == "yaml":
+            collector = "native"
+            # ^-- no canned output for the YAML pipeline: it needs the real scripts
+        bench_pipeline_once(n_hosts, n_sensors, collector)
+
+
+def bench_metrics(args):
+    """ Cost of the metrics instrumentation: per metric update, per scrape,
+    and in total on the collect+compare loop, which is the only place that
+    does any per-host work for it (timing the collector).
+    """
+    n = 100000
+    registry = Metrics.MetricsRegistry()
+    counter = registry.counter("bench_counter", "Benchmark counter.", ["device"])
+    gauge = registry.gauge("bench_gauge", "Benchmark gauge.", ["kind"])
+    histogram = registry.histogram("bench_histogram", "Benchmark histogram.", ["stage"])
+    print "metrics:"
+    for (name, update) in (("counter inc", lambda: counter.inc(1, ("nsca",))),
+                           ("gauge set", lambda: gauge.set(5, ("seen",))),
+                           ("histogram observe", lambda: histogram.observe(3.2, ("send",)))):
+        time_start = time.time()
+        for _ in xrange(n):
+            update()
+        print "  %-18s %8.3f us per update" % (name, (time.time() - time_start) * 1e6 / n)
+    time_start = time.time()
+    text = Metrics.REGISTRY.render()
+    print "  %-18s %8.3f ms, %d bytes" % ("scrape", (time.time() - time_start) * 1e3, len(text))
+
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    comparators = dict([ (x.split()[0], (sge_to_icinga_d.cmp_op_from_string(x.split()[1]), x.split()[2]))
+                         for x in make_threshold_comparators(sensor_names).strip().split("\n") ])
+    plans = sge_to_icinga_d.compile_evaluation_plans(make_thresholds(hostnames, sensor_names), comparators)
+    host_docs = list(sge_to_icinga_d.parse_qhost_F(
+                        make_qhost_F(hostnames, sensor_names).splitlines(True),
+                        sge_to_icinga_d.get_nagtxt_sensor_names(comparators)))
+    time_start = time.time()
+    sge_to_icinga_d.check_data_against_thresholds(plans, host_docs)
+    cycle_seconds = time.time() - time_start
+    time_start = time.time()
+    for _ in host_docs:
+        time.time()
+        time.time()
+    instrument_seconds = time.time() - time_start
+    print "  %-18s %8.3f ms of a %.3f s compare cycle for %d hosts (%.2f%%)" % (
+            "hot path overhead", instrument_seconds * 1e3, cycle_seconds, len(host_docs),
+            100 * instrument_seconds / cycle_seconds)
+
+
+def bench_rollup(args):
+    """ Cost of the cluster rollup: copying each host's results into the
+    arrays as they go by, and the vectorised aggregation at the end.
+    """
+    if Rollup.numpy is None:
+        print "rollup: (skipped: needs numpy)"
+        return
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    comparators = dict([ (x.split()[0], (sge_to_icinga_d.cmp_op_from_string(x.split()[1]), x.split()[2]))
+                         for x in make_threshold_comparators(sensor_names).strip().split("\n") ])
+    plans = sge_to_icinga_d.compile_evaluation_plans(make_thresholds(hostnames, sensor_names), comparators)
+    host_docs = list(sge_to_icinga_d.parse_qhost_F(
+                        make_qhost_F(hostnames, sensor_names).splitlines(True),
+                        sge_to_icinga_d.get_nagtxt_sensor_names(comparators)))
+    time_start = time.time()
+    host_results = compiled_compare(host_docs, plans)
+    compare_seconds = time.time() - time_start
+
+    rollup = Rollup.Rollup("cluster",
+                           [ { "service": sensor_names[0], "aggregate": "critical",
+                               "relop": ">=", "value": 1 },
+                             { "service": "uncontactable", "aggregate": "fraction",
+                               "relop": ">", "value": 0.05 } ],
+                           sge_to_icinga_d.cmp_op_from_string,
+                           sample_hosts=args.rollup_sample_hosts)
+    if rollup.sample_hosts > 0:
+        sampled = "sampling %d hosts' values" % rollup.sample_hosts
+    else:
+        sampled = "every host's values"
+    print "rollup: %d hosts x %d sensors, %s" % (len(host_results), args.sensors, sampled)
+    timings = list()
+    for cycle in xrange(8):
+        # ^-- the first has to learn which columns need converting
+        time_start = time.time()
+        rollup.begin(len(plans))
+        for _ in rollup.watch(iter(host_results)):
+            pass
+        add_seconds = time.time() - time_start
+        time_start = time.time()
+        rollup_results = rollup.finish()
+        finish_seconds = time.time() - time_start
+        timings.append((add_seconds + finish_seconds, add_seconds, finish_seconds))
+    later = sorted(timings[1:])
+    for (label, (total_seconds, add_seconds, finish_seconds)) in [ ("first cycle", timings[0]),
+                                                                   ("later, median", later[len(later) // 2]),
+                                                                   ("later, worst", later[-1]) ]:
+        print "  %s:" % label
+        print "    %-16s %8.3f ms (%.3f us per host)" % ("watch hosts", add_seconds * 1e3,
+                                                         add_seconds * 1e6 / max(1, rollup.n_hosts))
+        print "    %-16s %8.3f ms for %d rollup services" % ("aggregate", finish_seconds * 1e3,
+                                                             len(rollup_results))
+        print "    %-16s %8.3f ms, on a %.3f s compare cycle (+%.1f%%)" % (
+                "total", total_seconds * 1e3, compare_seconds,
+                100 * total_seconds / compare_seconds)
+    print "  e.g. %s" % (rollup_results[0],)
+    check(rollup.n_hosts == len(host_results),
+          "rollup saw %d of %d hosts" % (rollup.n_hosts, len(host_results)))
+    check(len(rollup_results) == args.sensors + 1,
+          "rollup gave %d services, not %d" % (len(rollup_results), args.sensors + 1))
+    check(later[len(later) // 2][0] * 1e3 <= args.rollup_budget,
+          "rollup took %.3f ms a cycle (median), over its %.1f ms budget" % (
+              later[len(later) // 2][0] * 1e3, args.rollup_budget))
+
+def bench_queue_states(args):
+    """ Cost of the queue state services: parsing qstat -explain, and a
+    whole collect+compare cycle with and without them, with qhost and
+    qstat each made to wait a while before their output starts, as they
+    do on the qmaster. With the two running side by side, the wait
+    shouldn't be paid twice.
+    """
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    qstat_command = "qstat -explain aAcE -F %s" % ",".join(sorted(sensor_names))
+    outputs = { "threshold_comparators.sh": make_threshold_comparators(sensor_names),
+                "qconf -sq *@*": make_qconf_sq(hostnames, sensor_names),
+                "qhost -F": make_qhost_F(hostnames, sensor_names),
+                qstat_command: make_qstat_explain(hostnames, sensor_names) }
+    delays = { "qhost -F": args.command_wait,
+               qstat_command: args.command_wait }
+    print "queue states: %d hosts x %d sensors, 2 queues per host, %.1f s command wait" % (
+            args.hosts, args.sensors, args.command_wait)
+    lines = outputs[qstat_command].splitlines(True)
+    time_start = time.time()
+    index = sge_to_icinga_d.parse_qstat_explain(lines)
+    print "  %-26s %8.3f s for %d lines" % ("parse qstat -explain", time.time() - time_start,
+                                            len(lines))
+    with CannedCommands(outputs, delays):
+        for queue_states in (False, True):
+            message_maker = sge_to_icinga_d.MessageMaker("native", queue_states=queue_states)
+            time_start = time.time()
+            results = 0
+            critical = 0
+            for host_results in message_maker.iter_make():
+                results += len(host_results)
+                critical += sum([ 1 for x in host_results.states if x == 2 ])
+            print "  %-26s %8.3f s, %d results, %d critical" % (
+                    "cycle, queue states %s" % ("off", "on")[queue_states],
+                    time.time() - time_start, results, critical)
+    print "  e.g. %s" % (host_results[-1],)
+
+def bench_thresholds(args):
+    """ Building the per-host threshold dict: per-host-thresholds.yaml.sh's
+    output through yaml.load (just the loading: the script's own pipeline
+    can't be run without qconf), against the native qconf -sq parser, on
+    single-line and continued-line output, with each merge policy. With
+    "most", the two have to come out the same.
+    """
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    comparators = dict([ (x.split()[0], (sge_to_icinga_d.cmp_op_from_string(x.split()[1]), x.split()[2]))
+                         for x in make_threshold_comparators(sensor_names).strip().split("\n") ])
+    print "thresholds: %d hosts x %d sensors, 2 queues per host" % (args.hosts, args.sensors)
+    thresholds_yaml = make_per_host_thresholds_yaml(hostnames, sensor_names)
+    time_start = time.time()
+    script_thresholds = sge_to_icinga_d.parse_threshold_dict(thresholds_yaml)
+    print "  %-30s %8.3f s" % ("script output, yaml.load", time.time() - time_start)
+    for single_line in (True, False):
+        lines = make_qconf_sq(hostnames, sensor_names, single_line).splitlines(True)
+        for policy in ("most", "strictest", "union"):
+            time_start = time.time()
+            thresholds = sge_to_icinga_d.build_threshold_dict(lines, comparators, policy)
+            print "  %-30s %8.3f s, %d hosts" % (
+                    "native, %s, %s" % (("continued", "single line")[single_line], policy),
+                    time.time() - time_start, len(thresholds))
+            if policy == "most":
+                check(thresholds == script_thresholds,
+                      "native thresholds (%s) differ from the script's" %
+                      ("continued", "single line")[single_line])
+                # ^-- the script resolves each host's queues by most bits too
+
+def bench_reload(args):
+    """ Cost of refreshing the thresholds, from each threshold source: the
+    first load, a reload where nothing's changed, one where a threshold
+    has, and looking up a single new host.
+    """
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    new_hostname = "new-node-0001"
+    print "reload: %d hosts x %d sensors" % (args.hosts, args.sensors)
+    for source in ("script", "native"):
+        if source == "script":
+            (command, new_host_command, make_output) = (
+                    "per-host-thresholds.yaml.sh",
+                    "per-host-thresholds.yaml.sh %s" % new_hostname,
+                    make_per_host_thresholds_yaml)
+            (old_line, new_line) = ("  %s: %s\n" % (sensor_names[0], sensor_threshold(0)),
+                                    "  %s: %s\n" % (sensor_names[0], sensor_threshold(0) + 1))
+        else:
+            (command, new_host_command, make_output) = (
+                    "qconf -sq *@*",
+                    "qconf -sq *@%s" % new_hostname,
+                    make_qconf_sq)
+            (old_line, new_line) = (" %s=%s," % (sensor_names[0], sensor_threshold(0)),
+                                    " %s=%s," % (sensor_names[0], sensor_threshold(0) + 1))
+        thresholds_output = make_output(hostnames, sensor_names)
+        outputs = { "threshold_comparators.sh": make_threshold_comparators(sensor_names),
+                    command: thresholds_output,
+                    new_host_command: make_output([new_hostname], sensor_names) }
+        print "  %s:" % source
+        with CannedCommands(outputs):
+            time_start = time.time()
+            message_maker = sge_to_icinga_d.MessageMaker("native", threshold_source=source)
+            print "    %-22s %8.3f s" % ("first load", time.time() - time_start)
+
+            time_start = time.time()
+            message_maker.reload()
+            print "    %-22s %8.3f s" % ("unchanged", time.time() - time_start)
+
+            outputs[command] = thresholds_output.replace(old_line, new_line, 1)
+            time_start = time.time()
+            message_maker.reload()
+            print "    %-22s %8.3f s" % ("one threshold changed", time.time() - time_start)
+
+            time_start = time.time()
+            message_maker.refresh_hosts([ new_hostname ])
+            print "    %-22s %8.3f s" % ("one new host", time.time() - time_start)
+
+class CountingMessageMaker:
+    """ Stands in for a MessageMaker in collect_loop, counting the cycles
+    it's asked for.
+    """
+    def __init__(self, message_maker):
+        self.message_maker = message_maker
+        self.scheduler = None
+        self.cycles = 0
+
+    def iter_make(self, hostnames=None, deadline=None):
+        self.cycles += 1
+        return self.message_maker.iter_make(hostnames, deadline)
+
+    @property
+    def cycle_stats(self):
+        return self.message_maker.cycle_stats
+
+def count_processes(pattern):
+    return len(subprocess.Popen(["pgrep", "-f", pattern],
+                                stdout=subprocess.PIPE).communicate()[0].split())
+
+def bench_deadlines(args):
+    """ That a hung dependency is cut off at its deadline, rather than
+    holding the daemon up indefinitely: a qhost that never finishes (on its
+    own, in a cycle, and in a collect loop cycle whose cycle_deadline is
+    much shorter than command_timeout), a qhost that fails part-way (whose cycle
+    mustn't look finished), a sending thread that's stopped taking results
+    (which collection should carry on regardless of), an Icinga API that
+    never answers, and an NSCA daemon that never sends its init packet.
+    Each should take about the deadline, and leave nothing running.
+    """
+    deadline = args.deadline
+    sensor_names = make_sensor_names(args.sensors)
+    hostnames = make_hostnames(args.hosts)
+    outputs = { "qhost-F": make_qhost_F(hostnames, sensor_names),
+                "qhost-xml": make_qhost_xml(hostnames, sensor_names),
+                "qconf-sc": make_qconf_sc(sensor_names),
+                "qconf-sq": make_qconf_sq(hostnames, sensor_names) }
+    logger = logging.getLogger("SGE2NSCA")
+    old_command_timeout = sge_to_icinga_d.command_timeout
+    sge_to_icinga_d.command_timeout = deadline
+    print "deadlines: %.1f s, %d hosts x %d sensors" % (deadline, args.hosts, args.sensors)
+
+    slack = max(1.0, 0.5 * deadline)
+    # ^-- for process start-up, thread scheduling and a slow box
+
+    def report(name, time_start, outcome):
+        seconds = time.time() - time_start
+        print "  %-24s %8.3f s: %s" % (name, seconds, outcome)
+        return seconds
+
+    with FakeSGE(outputs, hung=("qhost",)):
+        time_start = time.time()
+        timed_out = False
+        try:
+            list(sge_to_icinga_d.get_command_output_lines(["qhost", "-F"]))
+            outcome = "finished"
+        except sge_to_icinga_d.CommandTimeout, e:
+            timed_out = True
+            outcome = "%s, %d left running" % (e, count_processes("^sleep 3600$"))
+        seconds = report("hung qhost", time_start, outcome)
+        check(timed_out and seconds <= deadline + slack,
+              "hung qhost: %s after %.3f s, for a %.1f s deadline" % (outcome, seconds, deadline))
+        check(count_processes("^sleep 3600$") == 0,
+              "hung qhost: %d processes left running" % count_processes("^sleep 3600$"))
+
+        message_maker = sge_to_icinga_d.MessageMaker("native")
+        time_start = time.time()
+        timed_out = False
+        try:
+            list(message_maker.iter_make())
+            outcome = "finished"
+        except sge_to_icinga_d.CommandTimeout, e:
+            timed_out = True
+            outcome = "cycle failed with %s" % e.__class__.__name__
+        seconds = report("cycle, hung qhost", time_start, outcome)
+        check(timed_out and seconds <= deadline + slack,
+              "cycle, hung qhost: %s after %.3f s, for a %.1f s deadline" % (outcome, seconds,
+                                                                            deadline))
+        check(count_processes("^sleep 3600$") == 0,
+              "cycle, hung qhost: %d processes left running" % count_processes("^sleep 3600$"))
+
+        sge_to_icinga_d.command_timeout = 100
+        # ^-- the daemon's default: the cycle's deadline has to cut it short
+        counting_maker = CountingMessageMaker(message_maker)
+        hand_off = Queue.Queue()
+        stop = threading.Event()
+        collector = threading.Thread(target=sge_to_icinga_d.collect_loop,
+                                     args=(counting_maker, 3600, 0, hand_off, deadline),
+                                     kwargs={ "stop": stop })
+        time_start = time.time()
+        collector.start()
+        while counting_maker.cycles == 0 and collector.is_alive():
+            time.sleep(0.01)
+        stop.set()
+        # ^-- just the one cycle
+        collector.join(deadline + 100)
+        seconds = report("collect loop, hung qhost", time_start,
+                         "cycle over, %d left running" % count_processes("^sleep 3600$"))
+        sge_to_icinga_d.command_timeout = deadline
+        check(not collector.is_alive() and seconds <= deadline + slack,
+              "collect loop, hung qhost: cycle took %.3f s, for a %.1f s cycle_deadline "
+              "and a 100 s command_timeout" % (seconds, deadline))
+        check(count_processes("^sleep 3600$") == 0,
+              "collect loop, hung qhost: %d processes left running" %
+              count_processes("^sleep 3600$"))
+
+    with FakeSGE(outputs, failing=("qhost",)):
+        counting_maker = CountingMessageMaker(sge_to_icinga_d.MessageMaker("native"))
+        hand_off = Queue.Queue()
+        stop = threading.Event()
+        collector = threading.Thread(target=sge_to_icinga_d.collect_loop,
+                                     args=(counting_maker, 3600, 0, hand_off),
+                                     kwargs={ "stop": stop })
+        time_start = time.time()
+        collector.start()
+        while counting_maker.cycles == 0:
+            time.sleep(0.01)
+        stop.set()
+        # ^-- the cycle under way finishes, and then there are no more
+        collector.join()
+        items = list()
+        while not hand_off.empty():
+            items.append(hand_off.get())
+        hosts = sum([ len(x[3]) for x in items if isinstance(x[3], list) ])
+        end_markers = len([ x for x in items if isinstance(x[3], dict) ])
+        report("failing qhost", time_start, "%d hosts passed on, %d end of cycle markers" %
+                                            (hosts, end_markers))
+        check(end_markers == 0,
+              "failing qhost: the cycle still ended with an end of cycle marker, "
+              "so the hosts would be reconciled against %d of %d" % (hosts, args.hosts))
+
+    with FakeSGE(outputs):
+        counting_maker = CountingMessageMaker(sge_to_icinga_d.MessageMaker("native"))
+        hand_off = Queue.Queue(maxsize=1)
+        # ^-- which nothing takes from
+        stop = threading.Event()
+        collector = threading.Thread(target=sge_to_icinga_d.collect_loop,
+                                     args=(counting_maker, deadline, 0, hand_off),
+                                     kwargs={ "stop": stop })
+        time_start = time.time()
+        collector.start()
+        time.sleep(3.5 * deadline)
+        stop.set()
+        collector.join()
+        report("stalled sender", time_start, "%d cycles started, one due every %.1f s" %
+                                             (counting_maker.cycles, deadline))
+        # ^-- each cycle given up on at the default deadline, most of the interval
+        check(counting_maker.cycles >= 3,
+              "stalled sender: %d cycles started in %.1f s, one due every %.1f s" % (
+                  counting_maker.cycles, 3.5 * deadline, deadline))
+
+    import IcingaService
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    # ^-- connections are queued, but never accepted or answered
+    time_start = time.time()
+    gave_up = False
+    try:
+        IcingaService.IcingaServiceQuerier("http://127.0.0.1:%d" % listener.getsockname()[1],
+                                           "icinga", "icinga", logger, timeout=deadline)
+        outcome = "answered"
+    except Exception, e:
+        gave_up = True
+        outcome = "gave up with %s" % e.__class__.__name__
+    seconds = report("hung Icinga API", time_start, outcome)
+    check(gave_up and seconds <= deadline + slack,
+          "hung Icinga API: %s after %.3f s, for a %.1f s deadline" % (outcome, seconds, deadline))
+
+    config = { "nsca_dest_host": "127.0.0.1",
+               "nsca_port": listener.getsockname()[1],
+               "nsca_password": "",
+               "nsca_encryption": 0,
+               "nsca_timeout": deadline,
+               "nsca_max_output_length": 512 }
+    device = NSCAProtocolMessageDevice.MessageDevice(config, logger)
+    quads = make_message_quads(hostnames[:10], sensor_names)
+    undelivered = list()
+    time_start = time.time()
+    device.send_message_quads(quads, undelivered.extend)
+    seconds = report("hung NSCA daemon", time_start, "%d results handed back undelivered, "
+                                                     "after connecting twice" % len(undelivered))
+    check(len(undelivered) == len(quads),
+          "hung NSCA daemon: %d of %d results handed back undelivered" % (len(undelivered),
+                                                                         len(quads)))
+    check(seconds <= 2 * deadline + slack,
+          "hung NSCA daemon: gave up after %.3f s, for a %.1f s deadline on each of two "
+          "connections" % (seconds, deadline))
+    listener.close()
+    sge_to_icinga_d.command_timeout = old_command_timeout
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the SGE to Icinga daemon.')
+    parser.add_argument("--hosts", type=int, default=10000, help="Number of fake hosts to generate")
+    parser.add_argument("--sensors", type=int, default=30, help="Number of fake sensors per host to generate")
+    parser.add_argument("--qhost-F", metavar="file", dest="qhost_F", default=None, help="Use captured qhost -F output instead of generating it")
+    parser.add_argument("--qhost-xml", metavar="file", dest="qhost_xml", default=None, help="Use captured qhost -xml -F output instead of generating it")
+    parser.add_argument("--collectors", nargs="+", default=["yaml", "native", "xml"], help="Collectors to compare (the pipeline uses the last one)")
+    parser.add_argument("--stages", nargs="+", default=["collectors", "compare", "nsca", "pipeline"], help="Benchmarks to run")
+    parser.add_argument("--pipeline-sizes", nargs="+", dest="pipeline_sizes", default=["100x10", "1000x30", "10000x30"], metavar="HOSTSxSENSORS", help="Cluster sizes to run the whole pipeline at")
+    parser.add_argument("--command-wait", type=float, dest="command_wait", default=1.0, help="Seconds the canned qhost and qstat wait before their output, for the queue_states stage")
+    parser.add_argument("--deadline", type=float, default=2.0, help="Seconds each hung dependency is given, for the deadlines stage")
+    parser.add_argument("--rollup-budget", type=float, dest="rollup_budget", default=5.0, help="Milliseconds a cycle's rollup may take, for the rollup stage")
+    parser.add_argument("--rollup-sample-hosts", type=int, dest="rollup_sample_hosts", default=0, help="Hosts the rollup stage works the min/percentiles/max out over; 0 for every host, as the daemon does by default")
+    parser.add_argument("--send-nsca", metavar="file", dest="send_nsca", default=None, help="send_nsca binary to compare the built-in NSCA client with")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    # ^-- the daemon runs its helper scripts from the current directory
+    logging.basicConfig(level=logging.WARNING)
+    sge_to_icinga_d.logger = logging.getLogger("SGE2NSCA")
+    benchmarks = { "collectors": bench_collectors,
+                   "compare": bench_compare,
+                   "nsca": bench_nsca,
+                   "api": bench_api,
+                   "delta": bench_delta,
+                   "pipeline": bench_pipeline,
+                   "metrics": bench_metrics,
+                   "rollup": bench_rollup,
+                   "thresholds": bench_thresholds,
+                   "queue_states": bench_queue_states,
+                   "reload": bench_reload,
+                   "deadlines": bench_deadlines }
+    for stage in args.stages:
+        benchmarks[stage](args)
+    if failures:
+        print "%d check(s) failed:" % len(failures)
+        for message in failures:
+            print "  %s" % message
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 #!/usr/bin/env bash
+set -o pipefail
+# ^-- so a qhost that fails fails the script, rather than passing on
+#     whatever it printed before it did
 
 
 sensor_searches="$( qconf -sc \
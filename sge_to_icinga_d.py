@@ -1,17 +1,44 @@
 #!/usr/bin/env python
 
+import Queue
 import argparse
 import daemon
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import operator
+import os
 import re
+import signal
 import subprocess
 import sys
+import threading
 import time
-import yaml
+import xml.etree.cElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
 
-from NSCAMessageDevice import MessageDevice
+import Metrics
+import SpoolMessageDevice
+from CaptureStore import CaptureStore
+from CheckResult import HostResults
 from IcingaService import IcingaService
+from PollScheduler import PollScheduler
+from Snapshot import Snapshot
+from Rollup import Rollup
+from NSCAProtocolMessageDevice import NSCA_ENCRYPTION_METHODS
+
+message_device_modules = { "send_nsca": "NSCAMessageDevice",
+                           "nsca": "NSCAProtocolMessageDevice",
+                           "icinga_api": "IcingaAPIMessageDevice",
+                           "dummy": "DummyMessageDevice" }
+
+def get_message_device_class(device_name):
+    """ Gets the MessageDevice class for one of the message_device config
+    options: each lives in its own module.
+    """
+    module = __import__(message_device_modules[device_name])
+    return module.MessageDevice
 
 def timeit(method):
     """ Decorator, for timing individual function calls if you want to do that
@@ -26,23 +53,108 @@ def timeit(method):
         return result
     return timed
 
-def get_command_output(command):
+command_timeout = 100
+# ^-- seconds a command gets before it's killed (0 for no limit): set from
+#     the config at startup
+
+class CommandFailed(Exception):
+    """ Raised when a command exits with a non-zero status, so that
+    whatever it did print isn't taken for its whole output: a qhost that
+    fails part-way (the qmaster going down, or failing over) would
+    otherwise look like a cluster with fewer hosts.
+    """
+    pass
+
+class CommandTimeout(CommandFailed):
+    """ Raised when a command had to be killed for taking longer than
+    command_timeout, or for running past its deadline.
+    """
+    pass
+
+def start_command(command_args, bufsize=0, deadline=None):
+    """ Starts a command in its own process group, with a timer set to kill
+    the whole group (the command, and anything it's started, as the helper
+    scripts' pipelines do) after command_timeout seconds, or at deadline (a
+    time.time()) if that's sooner. Returns (process, timer); the timer
+    needs cancelling once the command's finished.
+    """
+    process = subprocess.Popen(command_args,
+                               stdout = subprocess.PIPE,
+                               bufsize = bufsize,
+                               preexec_fn = os.setsid)
+    process.timed_out = False
+    process.timeout = command_timeout
+    if deadline is not None and (command_timeout <= 0 or
+                                 deadline - time.time() < command_timeout):
+        process.timeout = max(0, deadline - time.time())
+        # ^-- a cycle's commands mustn't outlast the cycle
+    killer = threading.Timer(process.timeout, kill_command, (process, True))
+    killer.daemon = True
+    if command_timeout > 0 or deadline is not None:
+        killer.start()
+    return (process, killer)
+
+def kill_command(process, timed_out=False):
+    process.timed_out = timed_out
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+        # ^-- it finished just in time
+
+def get_command_output(command, args=(), deadline=None):
     """ Runs a command from the command_root, returns the output as a string.
     """
     command_root = "."
-    process = subprocess.Popen(
-            "%s/%s" % (command_root, command),
-            stdout = subprocess.PIPE
-            )
-    (process_stdout, _) = process.communicate()
+    command_args = [ "%s/%s" % (command_root, command) ] + list(args)
+    (process, killer) = start_command(command_args, deadline=deadline)
+    try:
+        (process_stdout, _) = process.communicate()
+    finally:
+        killer.cancel()
+    if process.timed_out:
+        raise CommandTimeout("%s killed after %.0f s" % (" ".join(command_args), process.timeout))
+    if process.returncode != 0:
+        raise CommandFailed("%s exited with status %d" % (" ".join(command_args),
+                                                          process.returncode))
     return process_stdout
 
+def get_command_output_lines(command_args, deadline=None):
+    """ Runs a command from the PATH (not the command_root), yielding the
+    output a line at a time so that it never has to be held in memory whole.
+    As with start_command, it's killed at deadline if that's given.
+
+    If the output isn't read to the end (the cycle's been given up on),
+    the command's killed rather than waited for. If it is, and the command
+    then exits with a non-zero status, CommandFailed is raised after the
+    last line.
+    """
+    (process, killer) = start_command(command_args, bufsize = -1, deadline = deadline)
+    finished = False
+    try:
+        for line in iter(process.stdout.readline, ""):
+            yield line
+        finished = True
+    finally:
+        killer.cancel()
+        if not finished:
+            kill_command(process)
+        process.stdout.close()
+        process.wait()
+    if process.timed_out:
+        raise CommandTimeout("%s killed after %.0f s" % (" ".join(command_args), process.timeout))
+    if process.returncode != 0:
+        raise CommandFailed("%s exited with status %d" % (" ".join(command_args),
+                                                          process.returncode))
+
 def get_sensor_comparator_dict():
     """ Takes a space-separated list of sensor names and operators from
     script, and converts into a dict { sensor_name: (<operator function>,type) }.
     """
     logger.info("getting sensor value operators.")
-    thresholds = get_command_output("threshold_comparators.sh")
+    return parse_sensor_comparators(get_command_output("threshold_comparators.sh"))
+
+def parse_sensor_comparators(thresholds):
     ops_dict = dict()
     for line in thresholds.split("\n"):
         line_elements = line.split()
@@ -50,18 +162,539 @@ def get_sensor_comparator_dict():
             ops_dict[line_elements[0]] = (cmp_op_from_string(line_elements[1]), line_elements[2])
     return ops_dict
 
-def get_threshold_dict():
+def get_threshold_dict(hostname=None):
     """ Runs the script to get the thresholds, transforms it slightly
-    into a dict with hostname keys.
+    into a dict with hostname keys. With a hostname, just gets that host's.
 
     You could move this transformation into the script if it takes too long,
     I think.
     """
-    logger.info("getting per-host threshold information.")
-    thresholds_text = get_command_output("per-host-thresholds.yaml.sh")
-    thresholds_list = list(yaml.load(thresholds_text))
+    if hostname is None:
+        logger.info("getting per-host threshold information.")
+        thresholds_text = get_command_output("per-host-thresholds.yaml.sh")
+    else:
+        thresholds_text = get_command_output("per-host-thresholds.yaml.sh", [hostname])
+    return parse_threshold_dict(thresholds_text)
+
+def parse_threshold_dict(thresholds_text):
+    import yaml
+    # ^-- only imported where it's needed, since it's slow to import
+    thresholds_list = list(yaml.load(thresholds_text) or [])
     return { x["hostname"]: x for x in thresholds_list }
 
+def fingerprint(text):
+    """ Short digest of a script's output, to tell whether it's changed.
+    """
+    return hashlib.sha1(text).hexdigest()
+
+def iter_queue_instances(lines, wanted=("qname", "hostname", "load_thresholds")):
+    """ Parses qconf -sq output as it streams in, yielding a dict of the
+    wanted attributes of each queue instance: every instance starts with
+    its qname line.
+
+    Copes with long values either on one line (SGE_SINGLE_LINE set) or
+    continued over several, each ending in a backslash. Continuation lines
+    are indented, so the ones belonging to attributes that aren't wanted
+    are skipped along with everything else that doesn't start with a
+    wanted attribute's name.
+    """
+    queue = None
+    key = None
+    continued = None
+    for line in lines:
+        if continued is not None:
+            continued += line.strip()
+            if continued.endswith("\\"):
+                continued = continued[:-1]
+            else:
+                queue[key] = continued
+                continued = None
+            continue
+        if not line.startswith(wanted):
+            continue
+        fields = line.split(None, 1)
+        key = fields[0]
+        if not key in wanted:
+            continue
+        if key == "qname":
+            if queue is not None:
+                yield queue
+            queue = dict()
+        elif queue is None:
+            continue
+        if len(fields) == 2:
+            value = fields[1].strip()
+        else:
+            value = ""
+        if value.endswith("\\"):
+            continued = value[:-1]
+        else:
+            queue[key] = value
+    if queue is not None:
+        yield queue
+
+def parse_load_thresholds(text):
+    """ Turns a load_thresholds value, "name=value,name=value" or NONE, into
+    a dict, with the values typed the way the YAML route typed them.
+    """
+    thresholds = dict()
+    if text in ("", "NONE"):
+        return thresholds
+    for item in text.split(","):
+        (name, _, value) = item.strip().partition("=")
+        if name and value:
+            thresholds[name] = convert_sensor_value(value)
+    return thresholds
+
+def threshold_magnitude(value, sensor_type):
+    """ A threshold as a number, for comparing thresholds with each other;
+    None if it isn't one.
+    """
+    if sensor_type == "MEMORY" and isinstance(value, basestring):
+        if value[-1:] in "KMGT":
+            try:
+                return size_conv(value)
+            except Exception:
+                return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def merge_queue_thresholds(hostname, queues, policy, comparators):
+    """ Makes one host's thresholds from those of all its queue instances,
+    given as a list of (queue instance name, thresholds dict):
+
+     * most:      the queue with the most thresholds (what
+                  per-host-thresholds.yaml.sh does: more checks is best checks)
+     * union:     every threshold from every queue
+     * strictest: every threshold from every queue, and where queues
+                  disagree, the one that alarms soonest for the sensor's
+                  comparator
+
+    Ties go to the queue whose name sorts first.
+    """
+    queues = sorted(queues)
+    if policy == "most":
+        (qname, chosen) = queues[0]
+        for (name, thresholds) in queues[1:]:
+            if len(thresholds) > len(chosen):
+                (qname, chosen) = (name, thresholds)
+        merged = dict(chosen)
+    else:
+        qname = ",".join([ x[0] for x in queues ])
+        merged = dict()
+        for (_, thresholds) in queues:
+            for (name, value) in thresholds.items():
+                if not name in merged:
+                    merged[name] = value
+                elif policy == "strictest" and name in comparators:
+                    (operator_function, sensor_type) = comparators[name]
+                    current = threshold_magnitude(merged[name], sensor_type)
+                    candidate = threshold_magnitude(value, sensor_type)
+                    if current is None or candidate is None:
+                        continue
+                    if ((operator_function in (operator.ge, operator.gt) and candidate < current) or
+                        (operator_function in (operator.le, operator.lt) and candidate > current)):
+                        merged[name] = value
+    merged["hostname"] = hostname
+    merged["qname"] = qname
+    return merged
+
+def build_threshold_dict(lines, comparators, policy="most"):
+    """ Builds the same { hostname: thresholds } dict as get_threshold_dict,
+    straight from qconf -sq output, merging each host's queue instances
+    with merge_queue_thresholds.
+    """
+    queues_by_host = dict()
+    parsed = dict()
+    # ^-- { load_thresholds text: its dict }, since a cluster queue's
+    #     instances mostly all have the same thresholds; the merge copies
+    #     them, so they can be shared until then
+    for queue in iter_queue_instances(lines):
+        hostname = queue.get("hostname")
+        if not hostname:
+            continue
+        text = queue.get("load_thresholds", "")
+        thresholds = parsed.get(text)
+        if thresholds is None:
+            thresholds = parse_load_thresholds(text)
+            parsed[text] = thresholds
+        queues_by_host.setdefault(hostname, list()).append(
+            ("%s@%s" % (queue.get("qname", ""), hostname), thresholds))
+    return { hostname: merge_queue_thresholds(hostname, queues, policy, comparators)
+             for (hostname, queues) in queues_by_host.items() }
+
+def digesting(lines, digest):
+    """ Passes lines on, adding each to a hashlib digest on the way.
+    """
+    for line in lines:
+        digest.update(line)
+        yield line
+
+def get_queue_threshold_dict(comparators, policy="most", hostname=None, digest=None):
+    """ Gets the per-host thresholds with qconf -sq, for every queue
+    instance or just hostname's, without going through
+    per-host-thresholds.yaml.sh and YAML. If digest is given, the output
+    is fed into it as well.
+    """
+    if hostname is None:
+        queue_pattern = "*@*"
+    else:
+        queue_pattern = "*@%s" % hostname
+    lines = get_command_output_lines(["qconf", "-sq", queue_pattern])
+    if digest is not None:
+        lines = digesting(lines, digest)
+    try:
+        return build_threshold_dict(lines, comparators, policy)
+    except CommandTimeout:
+        raise
+    except CommandFailed:
+        if hostname is None:
+            raise
+        return dict()
+        # ^-- qconf fails for a host with no queue instances, which is
+        #     just a host without thresholds
+
+class LineIteratorFile:
+    """ Minimal read()-able wrapper around an iterable of lines, so that
+    output from get_command_output_lines can be fed to parsers that want
+    a file object.
+    """
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        chunks = [ self.buffer ]
+        length = len(self.buffer)
+        while (size < 0) or (length < size):
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = length
+        self.buffer = data[size:]
+        return data[:size]
+
+def get_nagtxt_sensor_names(comparators):
+    """ Picks out the sensors that have a matching _nagtxt complex, and the
+    _nagtxt complexes themselves: these are the only values worth keeping
+    from qhost.
+
+    Same selection as the qconf -sc | grep '_nagtxt' in qhost-F.yaml.sh,
+    but reuses the comparator dict rather than running qconf again.
+    """
+    sensor_names = set()
+    for k in comparators.keys():
+        if k[-7:] == "_nagtxt":
+            sensor_names.add(k)
+            sensor_names.add(k[:-7])
+    return sensor_names
+
+def convert_sensor_value(value):
+    """ Types a raw sensor value the way it used to come out of the
+    qhost-F.yaml.sh -> yaml.load_all route, so the comparisons don't change:
+    numbers become numbers, bare YAML words become booleans or None, and
+    anything with spaces or colons (which the script quoted) stays a string.
+    """
+    if value == "":
+        return None
+    if (" " in value) or (":" in value):
+        return value
+    if value[0] in "0123456789.-+":
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    if value in ("yes", "Yes", "YES", "true", "True", "TRUE",
+                 "on", "On", "ON"):
+        return True
+    if value in ("no", "No", "NO", "false", "False", "FALSE",
+                 "off", "Off", "OFF"):
+        return False
+    if value in ("~", "null", "Null", "NULL"):
+        return None
+    return value
+
+def parse_qhost_F(lines, sensor_names):
+    """ Streaming parser for the output of `qhost -F`, a replacement for the
+    grep/sed in qhost-F.yaml.sh and the yaml.load_all afterwards.
+
+    Yields one dict per host, as soon as that host's resource lines are
+    finished, with the same keys the script produces: hostname,
+    uncontactable ("y"/"n") and any of sensor_names reported for the host.
+    Only one host's worth of data is held at a time.
+    """
+    host_data = None
+    for line in lines:
+        if line[:1] in (" ", "\t"):
+            # Resource line, e.g. "   hl:micproblems=0"
+            if host_data is None:
+                continue
+            (_, _, assignment) = line.strip().partition(":")
+            (name, equals, value) = assignment.partition("=")
+            if equals and (name in sensor_names):
+                host_data[name] = convert_sensor_value(value)
+        else:
+            # Host line, header line, or the ---- underline
+            fields = line.split()
+            if ((len(fields) < 2) or
+                (fields[0] == "HOSTNAME") or
+                (fields[0][0] == "-")):
+                continue
+            if host_data is not None:
+                yield host_data
+            if fields[1] == "-":
+                # execd not reporting: the global pseudo-host always looks like this
+                uncontactable = "y"
+            else:
+                uncontactable = "n"
+            host_data = { "hostname": fields[0],
+                          "uncontactable": uncontactable }
+    if host_data is not None:
+        yield host_data
+
+def parse_qhost_xml(xml_file, sensor_names):
+    """ Incremental parser for the output of `qhost -xml -F`.
+
+    Yields the same per-host dicts as parse_qhost_F, but doesn't care what
+    the hostnames look like or how the columns are laid out. Each <host>
+    element is cleared once it's been turned into a dict, so the tree
+    never grows past one host.
+    """
+    root = None
+    for (event, element) in ElementTree.iterparse(xml_file, events=("start", "end")):
+        if root is None:
+            root = element
+        if event != "end" or element.tag.rpartition("}")[2] != "host":
+            continue
+
+        host_data = { "hostname": element.get("name"),
+                      "uncontactable": "n" }
+        for child in element:
+            tag = child.tag.rpartition("}")[2]
+            name = child.get("name")
+            if tag == "hostvalue":
+                if name == "arch_string" and child.text in (None, "-"):
+                    # execd not reporting: the global pseudo-host always looks like this
+                    host_data["uncontactable"] = "y"
+            elif tag == "resourcevalue" and (name in sensor_names):
+                host_data[name] = convert_sensor_value((child.text or "").strip())
+        element.clear()
+        root.clear()
+        yield host_data
+
+def get_host_data_generator(comparators, collector="native", deadline=None):
+    """ Gets the per-host sensor data from SGE, as an iterable of dicts.
+
+    The "native" collector parses qhost -F as it streams in, the "xml"
+    collector does the same with qhost -xml -F, and the "yaml" collector is
+    the original qhost-F.yaml.sh route, kept as a fallback. qhost is killed
+    at deadline, if that's given.
+    """
+    if collector == "yaml":
+        import yaml
+        host_data_text = get_command_output("qhost-F.yaml.sh", deadline=deadline)
+        return yaml.load_all(host_data_text)
+    elif collector == "xml":
+        return parse_qhost_xml(
+                LineIteratorFile(get_command_output_lines(["qhost", "-xml", "-F"], deadline)),
+                get_nagtxt_sensor_names(comparators))
+    else:
+        return parse_qhost_F(get_command_output_lines(["qhost", "-F"], deadline),
+                             get_nagtxt_sensor_names(comparators))
+
+queue_state_severities = { "u": 2, "E": 2,
+                           "a": 1, "A": 1, "c": 1, "o": 1,
+                           "s": 1, "S": 1, "C": 1, "P": 1,
+                           "d": 0, "D": 0 }
+# ^-- unknown execds and queues in error are critical; alarms, suspensions
+#     and oddities are warnings; disabling a queue is an admin's choice
+queue_state_names = { "u": "unknown",
+                      "a": "load alarm",
+                      "A": "suspend alarm",
+                      "C": "calendar suspended",
+                      "s": "suspended",
+                      "S": "subordinate",
+                      "d": "disabled",
+                      "D": "calendar disabled",
+                      "E": "error",
+                      "c": "configuration ambiguous",
+                      "o": "orphaned",
+                      "P": "preempted" }
+
+def parse_qstat_explain(lines):
+    """ Streaming parser for the output of `qstat -explain aAcE -F ...`,
+    a replacement for the grep/sed/awk in qstat-explain.yaml.sh.
+
+    Returns an index of each host's queue instances, { hostname: [ queue,
+    ... ] }, where each queue is a dict of its qname, its states (some of
+    uaACsSdDEcoP, or ""), and lists of the alarms, errors and any other
+    explanation lines qstat gave for it. Hosts are indexed under their
+    short names as well, so the index joins onto qhost's hosts whichever
+    form each uses. The resource lines -F adds are skipped, as are jobs.
+    """
+    index = dict()
+    queue = None
+    for line in lines:
+        if line[3:4] == ":":
+            continue
+            # ^-- a resource value, e.g. "\thl:np_load_avg=0.01": most of
+            #     the lines, so they're got out of the way first
+        if line[:1] == "\t":
+            if queue is None:
+                continue
+            text = line.strip()
+            if text.startswith("alarm "):
+                alarm = text[6:]
+                if alarm[2:3] == ":":
+                    alarm = alarm[3:]
+                    # ^-- the hl:/qf: source of the value
+                queue["alarms"].append(alarm)
+            elif text.startswith("error"):
+                queue["errors"].append(text[5:].lstrip(": "))
+            else:
+                queue["explanations"].append(text)
+        elif line[:1] in (" ", "-", "#", "\n", ""):
+            # Job lines, separators, the pending jobs section
+            if line[:1] == "#":
+                queue = None
+            continue
+        else:
+            fields = line.split()
+            if (len(fields) < 5) or not ("@" in fields[0]):
+                queue = None
+                # ^-- the header line
+                continue
+            (qname, _, hostname) = fields[0].partition("@")
+            if len(fields) > 5:
+                states = fields[5]
+            else:
+                states = ""
+            queue = { "qname": qname,
+                      "states": states,
+                      "alarms": list(),
+                      "errors": list(),
+                      "explanations": list() }
+            queues = index.setdefault(hostname, list())
+            queues.append(queue)
+            short_hostname = hostname.split(".", 1)[0]
+            if short_hostname != hostname:
+                index.setdefault(short_hostname, queues)
+    return index
+
+def get_queue_state_index(sensor_names, hostnames=None, deadline=None):
+    """ Runs qstat -explain once, for every queue instance or just those on
+    hostnames, and parses it into parse_qstat_explain's index. Asks -F for
+    just the checked sensors, since that's where the per-sensor errors
+    come from: all the resources would be everything qhost -F has
+    already said, once per queue.
+    """
+    command_args = [ "qstat", "-explain", "aAcE" ]
+    if sensor_names:
+        command_args += [ "-F", ",".join(sorted(sensor_names)) ]
+    if hostnames is not None:
+        command_args += [ "-q", ",".join([ "*@%s" % x for x in hostnames ]) ]
+    time_start = time.time()
+    index = parse_qstat_explain(get_command_output_lines(command_args, deadline))
+    logger.info("got queue states for %d hosts from qstat in %.1f s." %
+                (len(index), time.time() - time_start))
+    return index
+
+def join_queue_states(host_docs, queue_state_result):
+    """ Adds each host's queue instances ("queues"), and all their errors
+    ("errors"), from the queue state index to the host docs as they go by.
+
+    queue_state_result is the AsyncResult of get_queue_state_index running
+    alongside the collector. It's only waited for once the first host doc
+    is in, so that qstat and qhost are both waiting on the qmaster at the
+    same time rather than one after the other. If qstat fails, the hosts
+    go through without their queue states.
+    """
+    host_docs = iter(host_docs)
+    host_data = next(host_docs, None)
+    try:
+        index = queue_state_result.get()
+    except Exception:
+        logger.exception("could not get queue states.")
+        index = dict()
+    while host_data is not None:
+        hostname = str(host_data["hostname"])
+        queues = index.get(hostname)
+        if queues is None:
+            queues = index.get(hostname.split(".", 1)[0])
+        if queues:
+            host_data["queues"] = queues
+            errors = [ error for queue in queues for error in queue["errors"] ]
+            if errors:
+                host_data["errors"] = list(host_data.get("errors", ())) + errors
+        yield host_data
+        host_data = next(host_docs, None)
+
+def split_into_shards(hostnames, n_shards, max_shard_chars=100000):
+    """ Splits a collection of hostnames into n_shards lists of neighbouring
+    hosts, or more if that's needed to keep each comma-joined list short
+    enough to pass to qhost -h as one argument.
+    """
+    hostnames = sorted(hostnames)
+    total_chars = sum([ len(x) + 1 for x in hostnames ])
+    n_shards = max(n_shards, (total_chars / max_shard_chars) + 1)
+    shard_size = max(1, -(-len(hostnames) / n_shards))
+    return [ hostnames[i:i + shard_size]
+             for i in range(0, len(hostnames), shard_size) ]
+
+def collect_shard(shard_job):
+    """ Runs qhost for one shard of hosts, returning the list of per-host
+    dicts. Intended to be run in a worker pool by
+    get_sharded_host_data_generator.
+    """
+    (index, shard, collector, sensor_names, start_at, deadline) = shard_job
+    if start_at > time.time():
+        time.sleep(start_at - time.time())
+    time_start = time.time()
+    host_list = ",".join(shard)
+    if collector == "xml":
+        host_docs = list(parse_qhost_xml(
+            LineIteratorFile(get_command_output_lines(["qhost", "-xml", "-F", "-h", host_list],
+                                                      deadline)),
+            sensor_names))
+    else:
+        host_docs = list(parse_qhost_F(
+            get_command_output_lines(["qhost", "-F", "-h", host_list], deadline),
+            sensor_names))
+    logger.info("shard %d: got %d of %d hosts from qhost in %.1f s." %
+                (index, len(host_docs), len(shard), time.time() - time_start))
+    return host_docs
+
+def get_sharded_host_data_generator(hostnames, comparators, collector, n_shards, pool, stagger=0,
+                                    deadline=None):
+    """ Gets the per-host sensor data from SGE by splitting the hosts into
+    shards, running one qhost per shard through the worker pool, and
+    merging the results into one stream as each shard finishes.
+
+    If stagger is set, the shards' starts are spread evenly over that many
+    seconds, to smooth out the load on the qmaster. Every shard's qhost is
+    killed at deadline, if that's given.
+    """
+    shards = split_into_shards(hostnames, n_shards)
+    sensor_names = get_nagtxt_sensor_names(comparators)
+    time_start = time.time()
+    shard_jobs = [ (i, shard, collector, sensor_names,
+                    time_start + (i * float(stagger) / len(shards)), deadline)
+                   for (i, shard) in enumerate(shards) ]
+    for host_docs in pool.imap_unordered(collect_shard, shard_jobs):
+        for host_data in host_docs:
+            yield host_data
+
 def cmp_op_from_string(operator_string):
     """ Takes a string containing an operator and returns the function that
     performs that operation.
@@ -115,171 +748,1289 @@ def compare_datum(datum, threshold, operator_tuple):
         result = 0
     return result
 
-def transform_errors_to_dict(error_list):
-    """ The errors come out of the qstat wrap as a list: this tries to
-    transform them into a dictionary with the keys being the sensor_name
-    referenced.
+sensor_error_re = re.compile("^(?:no value for \"(?P<quoted_name>[^\"]*)\"|"
+                             "no complex attribute for threshold (?P<name>\\S+))")
+#   error: no value for "micproblems" because execd is in unknown state
+#   error: no complex attribute for threshold micproblems
 
-    It has a limited knowledge of the possible errors though.
-    """
+def classify_errors(error_list):
+    """ Sorts the errors qstat gives for a host into those about a
+    particular sensor, as a dict with the sensor names as keys, and the
+    rest, as a list: returns (sensor errors, other errors).
 
-    error_dict = dict()
-    #   error: no complex attribute for threshold micproblems
-    #   error: no value for "micproblems" because execd is in unknown state
-    execd_broke_re = re.compile("^no value for \"(?P<sensor_name>[^\"]*)\" because execd is in unknown state$")
-    no_attribute_re = re.compile("^no complex attribute for threshold (?P<sensor_name>.*)$")
+    Errors it doesn't recognise just end up in the other list.
+    """
+    sensor_errors = dict()
+    other_errors = list()
     for error in error_list:
-        match = execd_broke_re.match(error)
+        match = sensor_error_re.match(error)
         if match is None:
-            match = no_attribute_re.match(error)
-        if match is None:
-            logger.warn("could not pattern match error: %s" % error)
-        sensor_name = match.group("sensor_name")
-        error_dict[sensor_name] = error
-    return error_dict
+            other_errors.append(error)
+            continue
+        sensor_errors[match.group("quoted_name") or match.group("name")] = error
+    return (sensor_errors, other_errors)
+
+def evaluate_queue(queue):
+    """ Works out the state and output text for a queue instance's state
+    service, from its qstat states and explanations.
+    """
+    state = 0
+    for letter in queue["states"]:
+        state = max(state, queue_state_severities.get(letter, 3))
+    if queue["states"]:
+        text = "%s: %s" % (queue["states"],
+                           ", ".join([ queue_state_names.get(x, x) for x in queue["states"] ]))
+    else:
+        text = "ok"
+    details = (queue["alarms"] +
+               classify_errors(queue["errors"])[1] +
+               queue["explanations"])
+    if details:
+        text = "%s; %s" % (text, "; ".join(details))
+    return (state, text.replace("|", "/"))
+    # ^-- anything after a | would be taken for perfdata
+
+queue_state_plans = dict()
+# ^-- { (id(plan), qnames): (plan, plan with the queue state services added) }
+
+def add_queue_state_plan(plan, queues):
+    """ Returns the plan with entries for the queues' state services added
+    on the end, shared between all the hosts with the same plan and queues.
+    """
+    qnames = tuple([ x["qname"] for x in queues ])
+    key = (id(plan), qnames)
+    cached = queue_state_plans.get(key)
+    if (cached is not None) and (cached[0] is plan):
+        return cached[1]
+    if len(queue_state_plans) > 10000:
+        queue_state_plans.clear()
+        # ^-- old plans pile up here over reloads otherwise
+    combined = plan + tuple([ (intern("queue_%s" % x), None, None, None, False, "")
+                              for x in qnames ])
+    queue_state_plans[key] = (plan, combined)
+    return combined
+
+def compile_evaluation_plans(thresholds, comparators):
+    """ Works out, once per threshold/comparator load, everything about the
+    comparisons that doesn't depend on the sensor data itself.
 
-def check_data_against_thresholds(thresholds, comparators):
+    Returns a dict { hostname: plan }, where a plan is a tuple of
+    (sensor_name, nagtxt_name, threshold, operator, is_memory, unit) for
+    each sensor with a _nagtxt partner. MEMORY thresholds are already
+    converted to numbers. Sensors the host has no threshold for (or whose
+    relop we don't understand) get an operator of None, and are reported
+    without being compared, as before.
+
+    Hosts with identical thresholds share one plan object.
+    """
+    sensors = list()
+    for k in comparators.keys():
+        if ((k[-7:] != "_nagtxt") and
+            comparators.has_key("%s_nagtxt" % k) and
+            not k in ["hostname","qname"]):
+            sensors.append((intern(str(k)), "%s_nagtxt" % k) + comparators[k])
+            # ^-- interned, since every result for the sensor refers to it
+
+    plans = dict()
+    shared_plans = dict()
+    for (hostname, host_thresholds) in thresholds.items():
+        plan = list()
+        for (k, nagtxt_k, operator_function, sge_type) in sensors:
+            is_memory = (sge_type == "MEMORY")
+            if host_thresholds.has_key(k):
+                threshold = host_thresholds[k]
+                if is_memory:
+                    threshold = size_conv(threshold)
+            else:
+                threshold = None
+                operator_function = None
+
+            # To make Nagios perfdata understand the type, see: https://nagios-plugins.org/doc/guidelines.html#AEN200
+            if is_memory:
+                unit = "B"
+            else:
+                unit = ""
+            plan.append((k, nagtxt_k, threshold, operator_function, is_memory, unit))
+        plan = tuple(plan)
+        plans[hostname] = shared_plans.setdefault(plan, plan)
+    return plans
+
+def evaluate_host(hostname, host_data, plan):
+    """ Applies a host's evaluation plan to its sensor data, returning the
+    HostResults for that host. If the host data has its queue states
+    joined on, each queue's state service follows the sensors.
+    """
+    if host_data.has_key("errors"):
+        (errors, _) = classify_errors(host_data["errors"])
+    else:
+        errors = dict()
+
+    states = list()
+    values = list()
+    texts = list()
+    for (k, nagtxt_k, threshold, operator_function, is_memory, unit) in plan:
+        if k in host_data:
+            datum = host_data[k]
+            if operator_function is None:
+                result = 0
+            else:
+                if is_memory:
+                    if operator_function(size_conv(datum), threshold):
+                        result = 2
+                    else:
+                        result = 0
+                elif operator_function(datum, threshold):
+                    result = 2
+                else:
+                    result = 0
+            states.append(result)
+            values.append(datum)
+            texts.append(host_data.get(nagtxt_k))
+        elif k in errors:
+            states.append(2)
+            values.append(None)
+            texts.append(errors[k])
+        else:
+            states.append(0)
+            values.append(None)
+            texts.append("0")
+    queues = host_data.get("queues")
+    if queues:
+        plan = add_queue_state_plan(plan, queues)
+        for queue in queues:
+            (state, text) = evaluate_queue(queue)
+            states.append(state)
+            values.append(None)
+            texts.append(text)
+    return HostResults(hostname, plan, states, values, texts,
+                       host_data.get("uncontactable") == "y")
+
+def iter_host_messages(plans, host_doc_generator, count_hosts=True, unknown_hosts=None,
+                       stats=None):
     """ Main comparison routine, where the daemon will spend its non-sleep
     time.
 
-    Tries to avoid storing more than one host's worth of data, to keep
-    memory usage down.
+    Yields each host's HostResults as soon as that host's data
+    has been read and compared, to avoid storing more than one host's
+    worth of data: host_doc_generator should be one of the collectors'
+    generators, and the collection mostly happens as this loop goes.
 
-    It's kind of fiddly because this whole thing is a disgusting hack.
+    All the per-sensor decisions that don't depend on the data are made
+    in advance by compile_evaluation_plans, so this just fetches the data
+    and applies each host's plan.
 
-    Such a disgusting inelegant hack that requires other disgusting inelegant hacks that it makes me angry.
+    The host count metrics are only set if count_hosts is, since they're
+    meant to describe the whole cluster. Hosts without a plan are added to
+    unknown_hosts, if it's given. The timings and counts go in stats, if
+    it's given, for the caller to record, and straight into the metrics
+    if not.
     """
 
-    logger.info("getting sensor data from qstat.")
-    time_start = time.time()
-    #host_data_text = get_command_output("qstat-explain.yaml.sh")
-    host_data_text = get_command_output("qhost-F.yaml.sh")
-    time_stop = time.time()
-    logger.info("got sensor data from qstat in %d s." % (time_stop - time_start))
-
     logger.info("comparing data to thresholds.")
     time_start = time.time()
 
-    host_doc_generator = yaml.load_all(host_data_text)
-
-    messages = list()
-    for host_data in host_doc_generator:
-        hostname = host_data["hostname"]
+    collect_seconds = 0.0
+    hosts_seen = 0
+    hosts_skipped = 0
+    hosts_uncontactable = 0
+    host_docs = iter(host_doc_generator)
+    while True:
+        time_waiting = time.time()
+        host_data = next(host_docs, None)
+        collect_seconds += time.time() - time_waiting
+        # ^-- time spent in the collector, reading and parsing qhost output
+        if host_data is None:
+            break
+        hostname = intern(str(host_data["hostname"]))
+        # ^-- interned, since every result for the host refers to it
         if hostname == "global":
             # Skip global because there's no threshold data for it
             #  and getting it at all is just a by-product
             continue
-        if not thresholds.has_key(hostname):
+        hosts_seen += 1
+        if host_data.get("uncontactable") == "y":
+            hosts_uncontactable += 1
+        plan = plans.get(hostname)
+        if plan is None:
             # Then there's nothing useful we can do here.
             # Occurs when hosts are down or have no queues defined.
+            hosts_skipped += 1
+            if unknown_hosts is not None:
+                unknown_hosts.append(hostname)
             continue
-
-        if host_data.has_key("errors"):
-            host_data["errors"] = transform_errors_to_dict(host_data["errors"])
-        else:
-            host_data["errors"] = dict()
-            # ^-- adding an empty dict makes life easier for checking
-        for k in comparators.keys():
-            if ((k[-7:] != "_nagtxt") and
-                comparators.has_key("%s_nagtxt" % k) and
-                not k in ["hostname","qname"]):
-                
-                if thresholds[hostname].has_key(k) and host_data.has_key(k):
-                    result = compare_datum(host_data[k], thresholds[hostname][k], comparators[k])
-                else:
-                    result = 0
-
-                # To make Nagios perfdata understand the type, see: https://nagios-plugins.org/doc/guidelines.html#AEN200
-                if comparators[k][1] == "MEMORY":
-                    append_to_value = "B"
-                else: 
-                    append_to_value = ""
-
-                if host_data.has_key("%s_nagtxt" % k) and host_data.has_key(k):
-                    data_string = "%s|%s=%s%s" % (host_data["%s_nagtxt" % k], k, str(host_data[k]), append_to_value)
-                elif host_data.has_key(k):
-                    data_string = "%s%s|%s=%s%s" % (host_data[k], append_to_value, k, str(host_data[k]), append_to_value)
-                elif host_data["errors"].has_key(k):
-                    result = 2
-                    data_string = host_data["errors"][k]
-                else:
-                    data_string = "0"
-                messages.append((hostname, k, result, data_string))
+        yield evaluate_host(hostname, host_data, plan)
 
     time_stop = time.time()
-    logger.info("prepared message quads from data comparison in %d s." % (time_stop - time_start))
+    cycle_stats = { "collect": collect_seconds,
+                    "compare": time_stop - time_start - collect_seconds }
+    if count_hosts:
+        cycle_stats["hosts"] = { "seen": hosts_seen,
+                                 "skipped": hosts_skipped,
+                                 "uncontactable": hosts_uncontactable }
+    if stats is None:
+        Metrics.record_cycle(cycle_stats)
+    else:
+        stats.update(cycle_stats)
+    logger.info("prepared check results from data comparison in %d s (%d s of it collecting)." %
+                (time_stop - time_start, collect_seconds))
+
+def check_data_against_thresholds(plans, host_doc_generator):
+    """ The whole of iter_host_messages' output, as one list of HostResults.
+    """
+    messages = list()
+    for host_messages in iter_host_messages(plans, host_doc_generator):
+        messages.append(host_messages)
     return messages
 
 def size_of_messages(messages):
-    """ Gets the size of a container of containers of things.
+    """ Gets the size of a container of messages, and of everything they
+    hold, counting each object only once however many messages share it.
+    Messages can be tuples, or HostResults, whose columns are counted
+    instead.
 
     Used for printing out how much RAM the messages list is using.
     """
     s = sys.getsizeof
 
-    return (s(messages) + 
-            sum( [ s(x) for x in messages ] ) +
-            sum( [ sum([s(y) for y in x]) for x in messages] )
-            ) 
+    seen = set()
+    total = s(messages)
+    for x in messages:
+        total += s(x)
+        if isinstance(x, HostResults):
+            total += s(x.states) + s(x.values) + s(x.texts)
+            fields = (x.hostname,) + x.values + x.texts
+        else:
+            fields = x
+        for y in fields:
+            if id(y) not in seen:
+                seen.add(id(y))
+                total += s(y)
+    return total
 
 def make_hosts_services_dict(messages):
     """Makes a dict containing which services each host needs on the monitoring
     platform: intended to be used to generate Icinga calls.
+
+    Takes a list of HostResults, as check_data_against_thresholds makes.
     """
 
-    hosts_services_dict = { x[0]: [y[1] for y in messages if y[0]==x[0] ] for x in messages }
+    hosts_services_dict = dict()
+    for host_results in messages:
+        hosts_services_dict[host_results.hostname] = host_results.services()
     return hosts_services_dict
 
 class MessageMaker:
     """ Brings all of the above together into one thing that makes the NSCA
     messages.
+
+    The comparators, thresholds and plans compiled from them are kept
+    together in one tuple, self.loaded, which is only ever replaced whole,
+    never changed in place: each cycle takes it once at the start, so a
+    refresh from another thread can't leave a cycle with half of one load
+    and half of another.
     """
-    def __init__(self):
-        self.comparators = get_sensor_comparator_dict()
-        self.thresholds = get_threshold_dict()
+    def __init__(self, collector="native", shards=1, concurrency=4, stagger=0,
+                 scheduler=None, rollup=None, threshold_source="native",
+                 threshold_merge="most", queue_states=False, warm_start=None):
+        self.collector = collector
+        self.queue_states = queue_states
+        self.queue_state_pool = None
+        self.threshold_source = threshold_source
+        self.threshold_merge = threshold_merge
+        self.shards = shards
+        self.stagger = stagger
+        self.scheduler = scheduler
+        self.rollup = rollup
+        self.concurrency = concurrency
+        self.pool = None
+        # ^-- for sharded collection: made on first use rather than here,
+        #     since daemonising happens in between and threads don't survive it
+        self.loaded = (dict(), dict(), dict())
+        # ^-- (comparators, thresholds, plans)
+        self.fingerprints = (None, None)
+        self.scheduled = None
+        # ^-- the self.loaded the scheduler's hosts were last set from
+        self.unknown_hosts = None
+        # ^-- a Queue for hosts with no thresholds, if they're being looked up
+        self.tried_hosts = set()
+        self.cycle_stats = dict()
+        # ^-- the last finished cycle's stats, as passed to Metrics.record_cycle
+        if warm_start is None:
+            self.reload()
+        else:
+            (self.loaded, self.fingerprints) = warm_start
+            logger.info("warm start: thresholds for %d hosts from the snapshot." %
+                        len(self.loaded[2]))
         # set up the sender process here?
 
+    def reload(self):
+        """ (Re)reads the comparators and thresholds, and if either's changed
+        since the last time, compiles them into per-host evaluation plans
+        and swaps those in. Returns whether anything changed.
+
+        The thresholds come from qconf -sq directly if threshold_source is
+        "native", merging each host's queues by threshold_merge, or from
+        per-host-thresholds.yaml.sh if it's "script". The native parser
+        is cheap enough to just run each time, while the script's output
+        is only parsed if it's changed.
+        """
+        logger.info("getting sensor value operators.")
+        comparators_text = get_command_output("threshold_comparators.sh")
+        comparators_fingerprint = fingerprint(comparators_text)
+        (comparators, thresholds, _) = self.loaded
+        if comparators_fingerprint != self.fingerprints[0]:
+            comparators = parse_sensor_comparators(comparators_text)
+            if len(comparators) == 0 and len(self.loaded[0]) > 0:
+                # As for the thresholds below: every plan would be compiled
+                # with no sensors in it.
+                logger.warn("got no comparators at all: keeping the load already in use.")
+                return False
+
+        logger.info("getting per-host threshold information (%s)." % self.threshold_source)
+        time_start = time.time()
+        if self.threshold_source == "script":
+            thresholds_text = get_command_output("per-host-thresholds.yaml.sh")
+            thresholds_fingerprint = fingerprint(thresholds_text)
+            if thresholds_fingerprint != self.fingerprints[1]:
+                thresholds = parse_threshold_dict(thresholds_text)
+        else:
+            digest = hashlib.sha1()
+            thresholds = get_queue_threshold_dict(comparators, self.threshold_merge,
+                                                  digest=digest)
+            thresholds_fingerprint = digest.hexdigest()
+        logger.info("got thresholds for %d hosts in %.3f s." %
+                    (len(thresholds), time.time() - time_start))
+
+        fingerprints = (comparators_fingerprint, thresholds_fingerprint)
+        if fingerprints == self.fingerprints:
+            logger.info("thresholds and comparators unchanged.")
+            return False
+        if len(thresholds) == 0 and len(self.loaded[1]) > 0:
+            # More likely qconf failing than every queue going at once.
+            logger.warn("got no thresholds at all: keeping the ones already loaded.")
+            return False
+        time_start = time.time()
+        plans = compile_evaluation_plans(thresholds, comparators)
+        logger.info("compiled evaluation plans for %d hosts in %.3f s." %
+                    (len(plans), time.time() - time_start))
+        self.loaded = (comparators, thresholds, plans)
+        self.fingerprints = fingerprints
+        self.tried_hosts = set()
+        return True
+
+    def refresh_hosts(self, hostnames):
+        """ Gets the thresholds for just the given hosts, and swaps in a
+        load with their plans added. Returns how many were found.
+        """
+        logger.info("getting threshold information for %d new hosts." % len(hostnames))
+        (comparators, thresholds, plans) = self.loaded
+        found = dict()
+        for hostname in hostnames:
+            if self.threshold_source == "script":
+                found.update(get_threshold_dict(hostname))
+            else:
+                found.update(get_queue_threshold_dict(comparators, self.threshold_merge,
+                                                      hostname))
+        if len(found) == 0:
+            logger.info("no thresholds for %d new hosts." % len(hostnames))
+            return 0
+        thresholds = dict(thresholds)
+        thresholds.update(found)
+        plans = dict(plans)
+        plans.update(compile_evaluation_plans(found, comparators))
+        self.loaded = (comparators, thresholds, plans)
+        logger.info("added thresholds for %d new hosts." % len(found))
+        return len(found)
+
+    def start_refresher(self, interval, unknown_hosts=True, reload_now=False):
+        """ Starts a thread that reloads the thresholds and comparators every
+        interval seconds (if interval's more than 0), and, if unknown_hosts
+        is set, looks up the thresholds for hosts that turn up in the
+        collected data without any, as they turn up. With reload_now, the
+        first reload is straight away, as after a warm start.
+
+        Only unsharded collection ever sees unknown hosts, since sharded
+        collection asks qhost for the hosts it already knows about.
+        """
+        if unknown_hosts:
+            self.unknown_hosts = Queue.Queue()
+        refresher = threading.Thread(target=self.refresh_loop, args=(interval, reload_now),
+                                     name="threshold-refresh")
+        refresher.daemon = True
+        refresher.start()
+
+    def refresh_loop(self, interval, reload_now=False):
+        if reload_now:
+            next_reload = time.time()
+        else:
+            next_reload = time.time() + interval
+        while True:
+            hostnames = None
+            reload_due = reload_now or (interval > 0)
+            if self.unknown_hosts is not None:
+                if reload_due:
+                    timeout = max(0, next_reload - time.time())
+                else:
+                    timeout = None
+                try:
+                    hostnames = self.unknown_hosts.get(True, timeout)
+                except Queue.Empty:
+                    pass
+            elif reload_due:
+                time.sleep(max(0, next_reload - time.time()))
+            else:
+                return
+            try:
+                if hostnames is not None:
+                    self.refresh_hosts(hostnames)
+                else:
+                    reload_now = False
+                    next_reload = max(next_reload + interval, time.time())
+                    self.reload()
+            except Exception:
+                logger.exception("could not refresh thresholds.")
+
+    def get_host_data_generator(self, hostnames=None, loaded=None, deadline=None):
+        """ Gets the host data for a cycle, with the queue states joined on
+        if queue_states is set: qstat runs in its own thread, alongside
+        the collector. The commands are killed at deadline, if that's given.
+        """
+        if loaded is None:
+            loaded = self.loaded
+        (comparators, thresholds, _) = loaded
+        if self.queue_states:
+            if self.queue_state_pool is None:
+                self.queue_state_pool = ThreadPool(1)
+                # ^-- made on first use rather than in __init__, since
+                #     daemonising happens in between and threads don't survive it
+            sensor_names = [ x for x in comparators.keys()
+                             if comparators.has_key("%s_nagtxt" % x) ]
+            queue_state_result = self.queue_state_pool.apply_async(get_queue_state_index,
+                                                                   (sensor_names, hostnames, deadline))
+        if hostnames is not None:
+            host_docs = self.get_targeted_host_data_generator(hostnames, comparators, deadline)
+        elif self.shards > 1 and self.collector != "yaml":
+            if self.pool is None:
+                self.pool = ThreadPool(self.concurrency)
+            logger.info("getting sensor data from qhost (%s collector, %d shards)." %
+                        (self.collector, self.shards))
+            host_docs = get_sharded_host_data_generator(thresholds.keys(),
+                                                        comparators,
+                                                        self.collector,
+                                                        self.shards,
+                                                        self.pool,
+                                                        self.stagger,
+                                                        deadline)
+        else:
+            logger.info("getting sensor data from qhost (%s collector)." % self.collector)
+            host_docs = get_host_data_generator(comparators, self.collector, deadline)
+        if self.queue_states:
+            return join_queue_states(host_docs, queue_state_result)
+        return host_docs
+
+    def get_targeted_host_data_generator(self, hostnames, comparators, deadline=None):
+        """ Gets the sensor data for just the given hosts, with qhost -h.
+        """
+        if self.collector == "yaml":
+            collector = "native"
+        else:
+            collector = self.collector
+        logger.info("getting sensor data from qhost for %d hosts." % len(hostnames))
+        sensor_names = get_nagtxt_sensor_names(comparators)
+        for (i, shard) in enumerate(split_into_shards(hostnames, 1)):
+            for host_data in collect_shard((i, shard, collector, sensor_names, 0, deadline)):
+                yield host_data
+
+    def iter_make(self, hostnames=None, deadline=None):
+        """ Makes the messages one host at a time, yielding each host's list
+        of HostResults: for every host, or just for hostnames if that's
+        given. The cycle's commands are killed at deadline (a time.time()),
+        if that's given, rather than after command_timeout.
+
+        Since no more than a host's worth is held here, what's reported
+        through size_of_messages is the largest of those lists.
+
+        Full cycles finish with the cluster rollup's HostResults, if
+        there's a rollup.
+
+        Once it's finished, the cycle's timings and counts are recorded in
+        the metrics, and left in cycle_stats.
+        """
+        loaded = self.loaded
+        (_, thresholds, plans) = loaded
+        if self.scheduler is not None and self.scheduled is not loaded:
+            self.scheduler.set_hosts(thresholds.keys())
+            self.scheduled = loaded
+        state_counts = dict()
+        largest_length = 0
+        largest_bytes = 0
+        fast_hosts = 0
+        unknown_hosts = list()
+        stats = dict()
+        rollup = None
+        if hostnames is None:
+            rollup = self.rollup
+        host_messages_iter = iter_host_messages(plans,
+                                                self.get_host_data_generator(hostnames, loaded,
+                                                                             deadline),
+                                                hostnames is None,
+                                                unknown_hosts,
+                                                stats)
+        if rollup is not None:
+            rollup.begin(len(plans))
+            host_messages_iter = rollup.watch(host_messages_iter)
+        for host_messages in host_messages_iter:
+            if self.scheduler is not None:
+                if self.scheduler.observe(host_messages, time.time()):
+                    fast_hosts += 1
+            for state in host_messages.states:
+                state_counts[state] = state_counts.get(state, 0) + 1
+            if len(host_messages) > largest_length:
+                largest_length = len(host_messages)
+                largest_bytes = size_of_messages([host_messages])
+            yield host_messages
+        logger.info("holding at most %d bytes of check results per host." % largest_bytes)
+        if self.scheduler is not None:
+            logger.info("%d hosts on the fast polling schedule." % fast_hosts)
+        if self.unknown_hosts is not None:
+            tried_hosts = self.tried_hosts
+            unknown_hosts = [ x for x in unknown_hosts if x not in tried_hosts ]
+            if unknown_hosts:
+                tried_hosts.update(unknown_hosts)
+                # ^-- only looked up once each until the next full reload
+                self.unknown_hosts.put(unknown_hosts)
+                logger.info("looking up thresholds for %d new hosts." % len(unknown_hosts))
+        if hostnames is not None:
+            Metrics.record_cycle(stats)
+            self.cycle_stats = stats
+            return
+        if rollup is not None:
+            time_start = time.time()
+            rollup_results = rollup.finish()
+            logger.info("worked out %d cluster rollup services over %d hosts in %.3f s." %
+                        (len(rollup_results), rollup.n_hosts, time.time() - time_start))
+            yield rollup_results
+        stats["message_bytes"] = largest_bytes
+        stats["results"] = dict([ (state, state_counts.get(state, 0)) for state in (0, 1, 2, 3) ])
+        Metrics.record_cycle(stats)
+        self.cycle_stats = stats
+
     def make(self):
-        messages = check_data_against_thresholds(self.thresholds, self.comparators)
-        logger.info("holding message quad list in %d bytes." % 
+        loaded = self.loaded
+        messages = check_data_against_thresholds(loaded[2],
+                                                 self.get_host_data_generator(None, loaded))
+        logger.info("holding check result list in %d bytes." % 
                     size_of_messages(messages))
         return messages 
 
 
+class ResultCache:
+    """ Remembers the last state and status text sent for each
+    (hostname, service), so that unchanged results are only re-sent often
+    enough to keep Icinga's freshness checking happy.
+
+    Results only stay remembered once they've been delivered: the keys
+    filter passes on are held as pending until the send is committed, and
+    the device hands undelivered results back so they're forgotten, and so
+    sent again next cycle.
+    """
+    def __init__(self, heartbeat_age):
+        self.heartbeat_age = heartbeat_age
+        self.last_sent = dict()
+        # ^-- (hostname, service): (state, hash of status text, time sent)
+        self.pending = list()
+
+    def filter(self, messages, now=None):
+        """ Passes on the messages that need sending: those whose state or
+        status text has changed, or that haven't been sent for
+        heartbeat_age seconds. The datum and perfdata changing don't count
+        as a change on their own: they go with the heartbeat.
+
+        This is a generator, so it can sit in a stream of messages; the
+        counts are logged once the stream is finished.
+        """
+        if now is None:
+            now = time.time()
+        sent = 0
+        suppressed = 0
+        for message in messages:
+            key = (message.hostname, message.service)
+            text_hash = hash(message.status_text)
+            previous = self.last_sent.get(key)
+            if ((previous is None) or
+                (previous[0] != message.state) or
+                (previous[1] != text_hash) or
+                (now - previous[2] >= self.heartbeat_age)):
+                self.last_sent[key] = (message.state, text_hash, now)
+                self.pending.append(key)
+                sent += 1
+                yield message
+            else:
+                suppressed += 1
+        logger.info("sending %d results, suppressed %d unchanged (%.1f%%)." %
+                    (sent, suppressed, 100.0 * suppressed / max(sent + suppressed, 1)))
+
+    def undelivered(self, results):
+        """ For a message device's undelivered callback: forgets results
+        that couldn't be sent.
+        """
+        for result in results:
+            self.last_sent.pop((result[0], result[1]), None)
+
+    def commit(self):
+        """ The send finished: what was passed on stays remembered. """
+        self.pending = list()
+
+    def rollback(self):
+        """ The send failed part way: forgets everything passed on since the
+        last commit.
+        """
+        for key in self.pending:
+            self.last_sent.pop(key, None)
+        self.pending = list()
+
+
+def make_message_maker(settings, warm_start=None):
+    """ Makes a MessageMaker, with its poll scheduler and rollup, from the
+    collection and threshold settings in settings: the config, or one of
+    its cells.
+    """
+    if settings["poll_fast_interval"] > 0:
+        scheduler = PollScheduler(settings["check_interval"],
+                                  settings["poll_fast_interval"],
+                                  settings["poll_flap_window"])
+    else:
+        scheduler = None
+    if settings["rollup_host"]:
+        rollup = Rollup(settings["rollup_host"], settings["rollup_thresholds"],
+                        cmp_op_from_string, sample_hosts=settings["rollup_sample_hosts"])
+    else:
+        rollup = None
+    return MessageMaker(settings["collector"],
+                        settings["collector_shards"],
+                        settings["collector_concurrency"],
+                        settings["collector_stagger"],
+                        scheduler,
+                        rollup,
+                        settings["threshold_source"],
+                        settings["threshold_merge"],
+                        settings["queue_states"],
+                        warm_start)
+
+def collect_loop(message_maker, interval, fast_interval, hand_off, cycle_deadline=0,
+                 cell=None, batch_hosts=1, capture_store=None, stop=None):
+    """ Runs collection and comparison on a fixed-rate schedule, starting
+    each cycle at a wall-clock tick rather than interval seconds after the
+    last one finished, so the period doesn't drift.
+
+    If fast_interval is set, then in between the full cycles, every
+    fast_interval seconds, the hosts the scheduler has due (the ones in
+    trouble) are polled on their own.
+
+    The HostResults are put on hand_off as (cell, tick, full cycle, list of
+    up to batch_hosts HostResults) items, and each cycle that gets all the
+    way through ends with a (cell, tick, full cycle, stats) item, stats
+    being the message maker's cycle_stats dict for it: a cell worker's
+    metrics are recorded from those by the process doing the sending.
+
+    Each cycle has cycle_deadline seconds from its tick (or, if that's 0,
+    most of the interval, leaving time to wind it up before the next tick).
+    A cycle that's still going then, whether the commands are
+    slow or hand_off's been full for that long because sending's stuck,
+    is given up on: the rest of its results are dropped and its commands
+    killed, and the next cycle starts on time. A command that's hung, with
+    no output to wake the loop up, is killed at the deadline too, however
+    long command_timeout is.
+
+    Runs for ever, or until stop (an Event) is set, if it's given.
+    """
+    if cycle_deadline <= 0:
+        cycle_deadline = 0.9 * interval
+    scheduler = message_maker.scheduler
+    next_full_tick = time.time()
+    next_tick = next_full_tick
+    while (stop is None) or (not stop.is_set()):
+        full_cycle = (next_tick >= next_full_tick)
+        if full_cycle:
+            hostnames = None
+        else:
+            hostnames = scheduler.pop_due(next_tick)
+        time_start = time.time()
+        deadline = next_tick + cycle_deadline
+        if full_cycle or hostnames:
+            cycle = message_maker.iter_make(hostnames, deadline)
+            batch = list()
+            complete = False
+            try:
+                for host_messages in cycle:
+                    batch.append(host_messages)
+                    if len(batch) >= batch_hosts:
+                        hand_off.put((cell, next_tick, full_cycle, batch),
+                                     True, max(0, deadline - time.time()))
+                        batch = list()
+                    if time.time() > deadline:
+                        logger.warn("cycle passed its %.0f s deadline, giving up on the rest of it." %
+                                    cycle_deadline)
+                        break
+                else:
+                    complete = True
+                if batch:
+                    hand_off.put((cell, next_tick, full_cycle, batch),
+                                 True, max(0, deadline - time.time()))
+                if complete:
+                    hand_off.put((cell, next_tick, full_cycle, message_maker.cycle_stats),
+                                 True, max(0, deadline - time.time()))
+                    # ^-- end of cycle marker: only for whole cycles, as the
+                    #     sending thread reconciles hosts on them, and a
+                    #     cycle without one is just sent
+            except Queue.Full:
+                logger.warn("sending hasn't kept up, dropping the rest of the cycle at its %.0f s deadline." %
+                            cycle_deadline)
+            except CommandFailed, e:
+                logger.error("collect stage failed: %s" % e)
+            except Exception:
+                logger.exception("collect stage failed.")
+            finally:
+                cycle.close()
+                # ^-- so any commands still running are killed now
+            if capture_store is not None:
+                if full_cycle:
+                    capture_store.record("cycle", "full", "")
+                else:
+                    capture_store.record("cycle", "fast", "\n".join(hostnames))
+        time_stop = time.time()
+        if full_cycle:
+            if scheduler is not None:
+                scheduler.compact()
+            logger.info("collect stage: started %.1f s after its tick, took %.1f s." %
+                        (time_start - next_tick, time_stop - time_start))
+
+            next_full_tick += interval
+            if time_stop > next_full_tick:
+                # Overran: skip the ticks we've missed instead of running
+                #  them back-to-back to catch up.
+                missed = int((time_stop - next_full_tick) / interval) + 1
+                next_full_tick += missed * interval
+                logger.warn("collect stage overran the check interval, skipping %d cycle(s)." % missed)
+        elif hostnames:
+            logger.info("fast poll of %d hosts: started %.1f s after its tick, took %.1f s." %
+                        (len(hostnames), time_start - next_tick, time_stop - time_start))
+
+        if fast_interval > 0:
+            next_tick = min(max(next_tick + fast_interval, time_stop), next_full_tick)
+        else:
+            next_tick = next_full_tick
+        logger.info("sleeping for %.1f seconds..." % (next_tick - time.time()))
+        if stop is None:
+            time.sleep(max(0, next_tick - time.time()))
+        else:
+            stop.wait(max(0, next_tick - time.time()))
+
 class MessageMakerDaemon:
     """ Wraps a MessageMaker instance into a daemon.
+
+    If the config lists cells, there's instead one MessageMaker per cell,
+    each in its own worker process (see run_cell), all feeding the one
+    sending thread, Icinga service and message device here.
     """
-    def __init__(self, config, log_file_handle):
-        self.message_maker = MessageMaker()
+
+    cell_batch_hosts = 64
+    # ^-- hosts per hand-off from a cell worker, to keep pickling overhead down
+    cell_stall_intervals = 3
+    # ^-- a cell worker that's sent nothing for this many of its check
+    #     intervals is taken to be hung, and restarted
+    def __init__(self, config, log_file_handle, capture_store=None):
+        self.capture_store = capture_store
+        state = None
+        if config["snapshot_file"]:
+            self.snapshot = Snapshot(config["snapshot_file"], logger)
+            state = self.snapshot.load(self.snapshot_settings(config))
+        else:
+            self.snapshot = None
+        self.warm = (state is not None)
+        self.snapshot_saved = (None, False, time.time())
+        # ^-- (loaded, connected to Icinga, time) as of the last save
+        self.cells = config["cells"]
+        if self.cells:
+            self.message_maker = None
+            # ^-- made in each cell's worker instead
+        else:
+            self.message_maker = make_message_maker(
+                config, (state["loaded"], state["fingerprints"]) if self.warm else None)
+        self.cell_workers = dict()
+        # ^-- cell name: (worker process, its queue)
+        self.cell_waiting = dict()
+        # ^-- cell name: when its forwarder started waiting on the worker
+        self.open_cycles = dict()
+        # ^-- cell name (None with no cells): (tick, { hostname: services })
+        #     of the cycle being sent
+        self.cell_services = dict()
+        # ^-- cell name: { hostname: services } from its last full cycle
         self.log_file_handle = log_file_handle
         self.config = config
-        self.icinga_service = IcingaService(config, logger)
-        self.message_device = MessageDevice(config, logger)
+        self.icinga_service = IcingaService(config, logger,
+                                            state["hostnames"] if self.warm else None)
+        self.message_device = get_message_device_class(config["message_device"])(config, logger)
+        if config["spool_directory"]:
+            self.message_device = SpoolMessageDevice.MessageDevice(config, logger,
+                                                                   self.message_device)
+        if config["delta_only"]:
+            self.result_cache = ResultCache(config["freshness_threshold"] *
+                                            config["heartbeat_fraction"])
+            if self.warm:
+                self.result_cache.last_sent = state["last_sent"]
+        else:
+            self.result_cache = None
+
+    @staticmethod
+    def snapshot_settings(config):
+        """ The settings a snapshot has to have been made with to be used.
+        """
+        return (config["collector"], config["threshold_source"],
+                config["threshold_merge"], config["queue_states"])
+
+    def save_snapshot(self):
+        """ Saves a snapshot if the thresholds have been reloaded, the
+        connection to Icinga has come up, or it's been snapshot_interval
+        seconds, since the last one.
+
+        Only called from the sending thread, between cycles, as that's the
+        thread that changes the result cache and host set being saved.
+        """
+        if self.snapshot is None:
+            return
+        loaded = self.message_maker.loaded
+        connected = self.icinga_service.connected.is_set()
+        (saved_loaded, saved_connected, saved_time) = self.snapshot_saved
+        if not ((loaded is not saved_loaded) or
+                (connected != saved_connected) or
+                (time.time() - saved_time >= self.config["snapshot_interval"])):
+            return
+        if self.result_cache is not None:
+            last_sent = self.result_cache.last_sent
+        else:
+            last_sent = dict()
+        try:
+            self.snapshot.save(self.snapshot_settings(self.config),
+                               { "loaded": loaded,
+                                 "fingerprints": self.message_maker.fingerprints,
+                                 "hostnames": self.icinga_service.hostname_set,
+                                 "last_sent": last_sent })
+        except Exception:
+            logger.exception("could not save snapshot to %s." % self.config["snapshot_file"])
+        self.snapshot_saved = (loaded, connected, time.time())
+
+    def connect_icinga(self, retry_interval=30):
+        """ Connects to Icinga, retrying until it works, for after a warm
+        start, when there's no need to hold everything else up for it.
+        """
+        while True:
+            try:
+                self.icinga_service.connect()
+                logger.info("connected to Icinga.")
+                return
+            except Exception:
+                logger.exception("could not connect to Icinga, retrying in %d s." %
+                                 retry_interval)
+                time.sleep(retry_interval)
 
     def start(self, run_in_foreground):
         logger.info("starting daemon.")
         if run_in_foreground == False:
             self.context = daemon.DaemonContext()
-            self.context.files_preserve = [fh.stream]
+            self.context.files_preserve = [self.log_file_handle.stream]
             self.context.open()
 
             try:
                 self.loop(self.config["check_interval"])
             finally:
-                context.close()
+                self.context.close()
         else:
             self.loop(self.config["check_interval"])
         pass
 
     def loop(self, interval):
+        """ Runs collection and comparison on a fixed-rate schedule, each
+        cycle with a deadline (see collect_loop), here or, for each cell,
+        in a worker process.
+
+        Each host's messages are streamed through a bounded queue to a
+        separate sending thread (host creation, sending, and host
+        reconciliation at the end of a full cycle), so the next cycle's
+        collection can go ahead while the last of this one is still being
+        sent, and no more than the queue's worth of messages is ever held.
+        If sending falls behind, collection waits for it.
+
+        Thresholds are refreshed in the background meanwhile (see
+        MessageMaker.start_refresher), and picked up by the next cycle.
+
+        After a warm start from a snapshot, the first cycle runs on the
+        snapshot's thresholds and Icinga host list, while the connection to
+        Icinga and the first threshold reload happen in the background.
+        """
+        self.hand_off = Queue.Queue(maxsize=self.config["stream_queue_hosts"])
+        for cell in self.cells:
+            self.start_cell(cell)
+            # ^-- before the other threads are started, so there's less
+            #     for the forks to inherit
+
+        if self.config["metrics_port"]:
+            Metrics.start_metrics_server(self.config["metrics_address"],
+                                         self.config["metrics_port"])
+            logger.info("serving metrics on port %d." % self.config["metrics_port"])
+
+        if self.warm:
+            connector = threading.Thread(target=self.connect_icinga, name="icinga-connect")
+            connector.daemon = True
+            connector.start()
+        else:
+            self.icinga_service.connect()
+
+        sender = threading.Thread(target=self.send_loop, name="sender")
+        sender.daemon = True
+        sender.start()
+
+        if self.cells:
+            self.supervise_cells()
+        else:
+            if (self.config["threshold_refresh_interval"] > 0 or
+                self.config["threshold_refresh_unknown_hosts"] or
+                self.warm):
+                self.message_maker.start_refresher(self.config["threshold_refresh_interval"],
+                                                   self.config["threshold_refresh_unknown_hosts"],
+                                                   reload_now=self.warm)
+            collect_loop(self.message_maker, interval, self.config["poll_fast_interval"],
+                         self.hand_off, self.config["cycle_deadline"],
+                         capture_store=self.capture_store)
+
+    def start_cell(self, cell):
+        """ Starts a cell's worker process, with a fresh queue, and a thread
+        passing what it sends on to the sending thread.
+        """
+        cell_queue = multiprocessing.Queue(
+            maxsize=max(1, self.config["stream_queue_hosts"] // self.cell_batch_hosts))
+        worker = multiprocessing.Process(target=self.run_cell, args=(cell, cell_queue),
+                                         name="cell-%s" % cell["name"])
+        worker.daemon = True
+        worker.start()
+        self.cell_workers[cell["name"]] = (worker, cell_queue)
+        self.cell_waiting[cell["name"]] = time.time()
+        forwarder = threading.Thread(target=self.forward_cell,
+                                     args=(cell["name"], worker, cell_queue),
+                                     name="forward-%s" % cell["name"])
+        forwarder.daemon = True
+        forwarder.start()
+        logger.info("cell %s: started worker %d (SGE_ROOT %s, SGE_CELL %s)." %
+                    (cell["name"], worker.pid, cell["sge_root"], cell["sge_cell"]))
+
+    def run_cell(self, cell, cell_queue):
+        """ A cell worker process: collection and comparison for one cell,
+        with SGE_ROOT and SGE_CELL set for it, so that every SGE command
+        and threshold script it runs asks that cell's qmaster.
+        """
+        logging._lock = threading.RLock()
+        for handler in logger.handlers:
+            handler.createLock()
+        for metric in Metrics.REGISTRY.metrics:
+            metric.lock = threading.Lock()
+        # ^-- other threads of the parent's may have held these when it
+        #     forked, and they don't exist here to release them
+        for handler in logger.handlers:
+            handler.setFormatter(logging.Formatter(
+                '%(name)s - %(asctime)s - %(levelname)s: %(processName)s: %(message)s'))
+        os.environ["SGE_ROOT"] = cell["sge_root"]
+        os.environ["SGE_CELL"] = cell["sge_cell"]
+        global command_timeout
+        command_timeout = cell["command_timeout"]
+        message_maker = make_message_maker(cell)
+        if (cell["threshold_refresh_interval"] > 0 or
+            cell["threshold_refresh_unknown_hosts"]):
+            message_maker.start_refresher(cell["threshold_refresh_interval"],
+                                          cell["threshold_refresh_unknown_hosts"])
+        collect_loop(message_maker, cell["check_interval"], cell["poll_fast_interval"],
+                     cell_queue, cell["cycle_deadline"], cell["name"], self.cell_batch_hosts)
+
+    def forward_cell(self, name, worker, cell_queue, poll_interval=1):
+        """ Passes a cell worker's items on to the sending thread, until
+        the worker's replaced. Records when it started waiting for the
+        worker, for supervise_cells, so time spent waiting for the sending
+        thread doesn't count against the worker.
+        """
+        while self.cell_workers[name][0] is worker:
+            try:
+                item = cell_queue.get(True, poll_interval)
+            except Queue.Empty:
+                continue
+            self.cell_waiting[name] = None
+            self.hand_off.put(item)
+            self.cell_waiting[name] = time.time()
+
+    def supervise_cells(self, poll_interval=5):
+        """ Restarts cell workers that have died, or that have sent nothing
+        for cell_stall_intervals of their check intervals (as when their
+        qmaster's hung), without disturbing the other cells.
+        """
+        while True:
+            time.sleep(poll_interval)
+            for cell in self.cells:
+                name = cell["name"]
+                (worker, _) = self.cell_workers[name]
+                waiting_since = self.cell_waiting[name]
+                if worker.exitcode is not None:
+                    reason = "died"
+                    logger.error("cell %s: worker %d exited with %s, restarting it." %
+                                 (name, worker.pid, worker.exitcode))
+                elif ((waiting_since is not None) and
+                      (time.time() - waiting_since >
+                       self.cell_stall_intervals * cell["check_interval"])):
+                    reason = "stalled"
+                    logger.error("cell %s: nothing from worker %d for %.0f s, restarting it." %
+                                 (name, worker.pid, time.time() - waiting_since))
+                    worker.terminate()
+                    worker.join(poll_interval)
+                else:
+                    continue
+                Metrics.CELL_RESTARTS.inc(1, (name, reason))
+                self.start_cell(cell)
+
+    def iter_round_messages(self, first_item, finished, new_host_batch=32,
+                            idle_timeout=5):
+        """ Yields the messages for one send from the hand-off queue,
+        recording each host's services in its cycle's entry in open_cycles
+        as it goes, and the cycles whose end of cycle markers it passes in
+        finished.
+
+        With cells, their cycles are interleaved, and a send takes in all
+        the cycles that are going, until they've all ended and the queue
+        is empty. So that a hung cell doesn't hold up the others, a send
+        also ends when nothing's come for idle_timeout seconds; whichever
+        cycles are still going carry on into the next.
+
+        Hosts Icinga doesn't have yet are created before their messages are
+        passed on, a batch at a time so that they can be created
+        concurrently.
+        """
+        new_hosts = list()
+        item = first_item
         while True:
-            messages = self.message_maker.make()
-            hosts_services_dict = make_hosts_services_dict(messages)
-            self.icinga_service.ensure_hosts_exist(hosts_services_dict)
+            (cell, tick, full_cycle, batch) = item
+            if (cell not in self.open_cycles) or (self.open_cycles[cell][0] != tick):
+                self.open_cycles[cell] = (tick, dict())
+                # ^-- any cycle of this cell's that was going never finished
+            hosts_services_dict = self.open_cycles[cell][1]
+            if isinstance(batch, dict):
+                # ^-- an end of cycle marker, with the cycle's stats
+                if cell is not None:
+                    Metrics.record_cycle(batch, cell)
+                    # ^-- without cells, they were recorded in this process
+                del self.open_cycles[cell]
+                finished.append((cell, tick, full_cycle, hosts_services_dict))
+            else:
+                for host_messages in batch:
+                    if len(host_messages) == 0:
+                        continue
+                    hostname = host_messages.hostname
+                    hosts_services_dict[hostname] = host_messages.services()
+                    if self.icinga_service.has_host(hostname):
+                        for message in host_messages:
+                            yield message
+                    else:
+                        new_hosts.append((host_messages, hosts_services_dict))
+                        if len(new_hosts) >= new_host_batch:
+                            for message in self.create_hosts_for(new_hosts):
+                                yield message
+                            new_hosts = list()
+            try:
+                if self.open_cycles:
+                    item = self.hand_off.get(True, idle_timeout)
+                else:
+                    item = self.hand_off.get_nowait()
+            except Queue.Empty:
+                break
+        for message in self.create_hosts_for(new_hosts):
+            yield message
+
+    def create_hosts_for(self, new_hosts):
+        """ Creates the Icinga hosts for a list of (HostResults, services
+        dict) pairs, returning all their messages.
+        """
+        if len(new_hosts) == 0:
+            return list()
+        self.icinga_service.ensure_hosts_exist({ x.hostname: services[x.hostname]
+                                                 for (x, services) in new_hosts })
+        return [ message for (host_messages, _) in new_hosts for message in host_messages ]
+
+    def count_sent(self, messages):
+        for message in messages:
+            self.sent_count += 1
+            yield message
+
+    def send_loop(self):
+        cell_names = [ x["name"] for x in self.cells ] or [ None ]
+        while True:
+            first_item = self.hand_off.get()
+            tick = first_item[1]
+            time_start = time.time()
+            finished = list()
+            self.sent_count = 0
+            messages = self.iter_round_messages(first_item, finished)
+            try:
+                if self.result_cache is not None:
+                    filtered = self.result_cache.filter(messages)
+                else:
+                    filtered = messages
+                if self.result_cache is not None:
+                    self.message_device.send_message_quads(self.count_sent(filtered),
+                                                           self.result_cache.undelivered)
+                    self.result_cache.commit()
+                else:
+                    self.message_device.send_message_quads(self.count_sent(filtered))
+                time_sent = time.time()
+                Metrics.STAGE_SECONDS.observe(time_sent - time_start, ("send",))
+                Metrics.RESULTS_SENT.inc(self.sent_count)
+
+                full_cycles = [ x for x in finished if x[2] ]
+                for (cell, cell_tick, _, hosts_services_dict) in full_cycles:
+                    self.cell_services[cell] = hosts_services_dict
+                    if cell is not None:
+                        Metrics.CELL_CYCLE_SECONDS.observe(time_sent - cell_tick, (cell,))
+                if full_cycles and len(self.cell_services) == len(cell_names):
+                    merged_services = dict()
+                    for name in cell_names:
+                        merged_services.update(self.cell_services[name])
+                    self.icinga_service.reconcile_hosts(merged_services)
+                    Metrics.STAGE_SECONDS.observe(time.time() - time_sent, ("reconcile",))
+                    # ^-- only after full cycles: fast polls would make every
+                    #     other host look like it's gone. With cells, each
+                    #     cell's last full cycle stands for it, and nothing's
+                    #     reconciled until they've all had one.
+                    self.save_snapshot()
+            except Exception:
+                logger.exception("send stage failed.")
+                if self.result_cache is not None:
+                    self.result_cache.rollback()
+                for _ in messages:
+                    pass
+                    # ^-- throw away the rest of the send
+            logger.info("send stage: started %.1f s after its tick, took %.1f s." %
+                        (time_start - tick, time.time() - time_start))
+
+
+def record_commands(capture_store):
+    """ Swaps the command-running functions for ones that also save what
+    the commands output into capture_store, keyed by their command lines,
+    for --record.
+
+    Output that's normally streamed is held whole until the command
+    finishes, to be saved in one piece.
+    """
+    global get_command_output, get_command_output_lines
+    run_command = get_command_output
+    run_command_lines = get_command_output_lines
+
+    def recording_command_output(command, args=(), deadline=None):
+        output = run_command(command, args, deadline)
+        capture_store.record("output", " ".join([ command ] + list(args)), output)
+        return output
+
+    def recording_command_output_lines(command_args, deadline=None):
+        lines = list()
+        for line in run_command_lines(command_args, deadline):
+            lines.append(line)
+            yield line
+        capture_store.record("output", " ".join(command_args), "".join(lines))
+
+    get_command_output = recording_command_output
+    get_command_output_lines = recording_command_output_lines
 
-            self.message_device.send_message_quads(messages)
-            logger.info("sleeping for %d seconds..." % interval)
-            time.sleep(interval)
+def replay_captures(config, capture_store, start=None, stop=None, device_name=None):
+    """ Runs the cycles captured with --record through a MessageMaker and a
+    message device, as fast as they'll go, for the cycles that ended
+    between start and stop (seconds since the epoch; either can be None).
+
+    The commands are answered from the captures instead of being run, so
+    no SGE is needed, and the collector settings in config have to match
+    the ones the captures were recorded with, since sharded collection
+    asks qhost for different things. Thresholds are reloaded before any
+    cycle they were captured ahead of, just as the daemon would have.
+    Icinga isn't touched, apart from through the message device: the
+    dummy device sends nowhere.
+    """
+    entries = capture_store.read_index()
+    latest = dict()
+    # ^-- { command line: its latest CaptureEntry }
+
+    def replayed_output(command_line):
+        if not command_line in latest:
+            raise KeyError("no captured output for \"%s\": replay with the collector "
+                           "settings the captures were recorded with." % command_line[:80])
+        return capture_store.read(latest[command_line])
+
+    def replayed_command_output(command, args=(), deadline=None):
+        return replayed_output(" ".join([ command ] + list(args)))
+
+    def replayed_command_output_lines(command_args, deadline=None):
+        return iter(replayed_output(" ".join(command_args)).splitlines(True))
+
+    global get_command_output, get_command_output_lines
+    get_command_output = replayed_command_output
+    get_command_output_lines = replayed_command_output_lines
+
+    if device_name is None:
+        device_name = config["message_device"]
+    message_device = get_message_device_class(device_name)(config, logger)
+    message_maker = None
+    reload_due = False
+    new_hosts = list()
+    cycles = 0
+    time_start = time.time()
+    first = 0
+    if start is not None:
+        first = CaptureStore.first_index_at(entries, start)
+    for (i, entry) in enumerate(entries):
+        if entry.kind == "output":
+            latest[entry.command] = entry
+            if entry.command in ("threshold_comparators.sh",
+                                 "per-host-thresholds.yaml.sh",
+                                 "qconf -sq *@*"):
+                reload_due = True
+            elif entry.command.startswith("per-host-thresholds.yaml.sh "):
+                new_hosts.append(entry.command.split(" ", 1)[1])
+            elif entry.command.startswith("qconf -sq *@"):
+                new_hosts.append(entry.command.split("@", 1)[1])
+            continue
+        if i < first:
+            continue
+        if stop is not None and entry.timestamp > stop:
+            break
+        if message_maker is None:
+            message_maker = MessageMaker(config["collector"],
+                                         config["collector_shards"],
+                                         config["collector_concurrency"],
+                                         threshold_source=config["threshold_source"],
+                                         threshold_merge=config["threshold_merge"],
+                                         queue_states=config["queue_states"])
+        elif reload_due:
+            message_maker.reload()
+        if new_hosts:
+            message_maker.refresh_hosts(new_hosts)
+        reload_due = False
+        new_hosts = list()
+
+        if entry.command == "fast":
+            hostnames = capture_store.read(entry).split()
+        else:
+            hostnames = None
+        cycle_start = time.time()
+        message_device.send_message_quads(itertools.chain.from_iterable(
+            message_maker.iter_make(hostnames)))
+        cycles += 1
+        logger.info("replayed %s cycle captured at %s in %.3f s." %
+                    (entry.command, time.strftime("%Y-%m-%d %H:%M:%S",
+                                                  time.localtime(entry.timestamp)),
+                     time.time() - cycle_start))
+    capture_store.close()
+    logger.info("replayed %d cycles in %.1f s." % (cycles, time.time() - time_start))
 
 
 ###########
@@ -290,12 +2041,18 @@ def parse_args(argv=None):
     parser.add_argument("-c", "--config", metavar="file", dest='config_file', default="./config.yaml", help="Supply YAML configuration file")
     parser.add_argument("-f", "--foreground", action='store_true', dest='run_in_foreground', default=False, help="Don't daemonize; run in foreground.")
     parser.add_argument("--make-config", action='store_true', dest="make_config", default=False, help="Print default config file.")
+    parser.add_argument("--record", metavar="dir", dest="record_dir", default=None, help="Save each cycle's command output into a capture store in dir.")
+    parser.add_argument("--replay", metavar="dir", dest="replay_dir", default=None, help="Run the cycles captured in dir with --record, as fast as possible, then exit.")
+    parser.add_argument("--replay-from", metavar="time", dest="replay_from", type=float, default=None, help="Only replay cycles captured from this time on (seconds since the epoch).")
+    parser.add_argument("--replay-to", metavar="time", dest="replay_to", type=float, default=None, help="Only replay cycles captured up to this time (seconds since the epoch).")
+    parser.add_argument("--replay-device", metavar="device", dest="replay_device", default=None, choices=sorted(message_device_modules.keys()), help="Message device to replay into (default: the config file's).")
     if not argv is None:
         return parser.parse_args()
     else:
         return parser.parse_args(argv)
 
 def get_config_from_file(filename):
+    import yaml
     try:
         with open(filename, 'r') as config_file:
             config = yaml.load_all(config_file).next()
@@ -307,7 +2064,56 @@ def get_config_from_file(filename):
     optional_keys = { "check_interval": 120,
                       "log_level": "INFO",
                       "log_file": "/var/log/sge_to_icinga.log",
-                      "message_copy": False }
+                      "message_copy": False,
+                      "collector": "native",
+                      "collector_shards": 1,
+                      "collector_concurrency": 4,
+                      "collector_stagger": 0,
+                      "stream_queue_hosts": 256,
+                      "command_timeout": 100,
+                      "cycle_deadline": 0,
+                      "poll_fast_interval": 0,
+                      "poll_flap_window": 600,
+                      "threshold_refresh_interval": 600,
+                      "threshold_refresh_unknown_hosts": True,
+                      "threshold_source": "native",
+                      "threshold_merge": "most",
+                      "queue_states": False,
+                      "snapshot_file": "",
+                      "snapshot_interval": 600,
+                      "rollup_host": "",
+                      "rollup_thresholds": [],
+                      "rollup_sample_hosts": 0,
+                      "cells": [],
+                      "delta_only": False,
+                      "freshness_threshold": 600,
+                      "heartbeat_fraction": 0.5,
+                      "message_device": "send_nsca",
+                      "nsca_port": 5667,
+                      "nsca_password": "",
+                      "nsca_encryption": 0,
+                      "nsca_timeout": 10,
+                      "nsca_max_output_length": 512,
+                      "nsca_workers": 4,
+                      "nsca_batch_results": 500,
+                      "nsca_batch_bytes": 65536,
+                      "nsca_batch_timeout": 10,
+                      "nsca_batch_retries": 2,
+                      "spool_directory": "",
+                      "spool_max_bytes": 268435456,
+                      "spool_segment_bytes": 4194304,
+                      "spool_drain_rate": 200,
+                      "spool_drain_interval": 30,
+                      "icinga_api_endpoints": [],
+                      "icinga_api_workers": 8,
+                      "icinga_api_timeout": 10,
+                      "icinga_api_retries": 2,
+                      "icinga_max_parallel": 8,
+                      "icinga_reconcile_interval": 3600,
+                      "icinga_delete_missing_hosts": False,
+                      "icinga_delete_max_fraction": 0.1,
+                      "metrics_port": 0,
+                      "metrics_address": "" }
 
     for key in must_have_keys:
         if not key in config.keys():
@@ -324,6 +2130,78 @@ def get_config_from_file(filename):
             logger.error("unrecognised key in config file: %s" % key)
             sys.exit(2)
 
+    cell_must_have_keys = ["name", "sge_root", "sge_cell"]
+    cell_optional_keys = ["check_interval", "collector", "collector_shards",
+                          "collector_concurrency", "collector_stagger",
+                          "command_timeout", "cycle_deadline",
+                          "poll_fast_interval", "poll_flap_window",
+                          "threshold_refresh_interval", "threshold_refresh_unknown_hosts",
+                          "threshold_source", "threshold_merge", "queue_states",
+                          "rollup_host", "rollup_thresholds", "rollup_sample_hosts"]
+    # ^-- each cell takes these from the top level unless it has its own
+    cells = list()
+    for cell in config["cells"]:
+        if not isinstance(cell, dict):
+            logger.error("unrecognised cell in config file: %s" % cell)
+            sys.exit(2)
+        for key in cell_must_have_keys:
+            if not key in cell.keys():
+                logger.error("mandatory key not found in cell in config file: %s" % key)
+                sys.exit(2)
+        for key in cell.keys():
+            if ((not key in cell_must_have_keys) and
+                (not key in cell_optional_keys)):
+                logger.error("unrecognised key in cell in config file: %s" % key)
+                sys.exit(2)
+        settings = { key: config[key] for key in cell_optional_keys }
+        settings.update(cell)
+        settings["name"] = str(settings["name"])
+        cells.append(settings)
+    config["cells"] = cells
+
+    if len(set([ x["name"] for x in cells ])) != len(cells):
+        logger.error("cell names in config file aren't unique.")
+        sys.exit(2)
+
+    if cells and config["snapshot_file"]:
+        logger.error("snapshot_file can't be used with cells.")
+        sys.exit(2)
+
+    for settings in [ config ] + cells:
+        if not settings["collector"] in ["native", "xml", "yaml"]:
+            logger.error("unrecognised collector in config file: %s" % settings["collector"])
+            sys.exit(2)
+
+        if not settings["threshold_source"] in ["native", "script"]:
+            logger.error("unrecognised threshold_source in config file: %s" % settings["threshold_source"])
+            sys.exit(2)
+
+        if not settings["threshold_merge"] in ["most", "strictest", "union"]:
+            logger.error("unrecognised threshold_merge in config file: %s" % settings["threshold_merge"])
+            sys.exit(2)
+
+    if not config["message_device"] in message_device_modules.keys():
+        logger.error("unrecognised message_device in config file: %s" % config["message_device"])
+        sys.exit(2)
+
+    if not config["nsca_encryption"] in NSCA_ENCRYPTION_METHODS:
+        logger.error("unsupported nsca_encryption in config file: %s" % config["nsca_encryption"])
+        sys.exit(2)
+
+    for settings in [ config ] + cells:
+        if settings["rollup_host"]:
+            try:
+                import numpy
+            except ImportError:
+                logger.error("rollup_host is set in config file, but numpy isn't installed.")
+                sys.exit(2)
+        for threshold in settings["rollup_thresholds"]:
+            if ((not isinstance(threshold, dict)) or
+                (sorted(threshold.keys()) != ["aggregate", "relop", "service", "value"]) or
+                (cmp_op_from_string(threshold["relop"]) is None)):
+                logger.error("unrecognised rollup threshold in config file: %s" % threshold)
+                sys.exit(2)
+
     return config
 
 def print_default_config_file():
@@ -331,10 +2209,70 @@ def print_default_config_file():
                      "log_file: /var/log/sge_to_icinga.log\n" +
                      "log_level: INFO\n" +
                      "message_copy: /var/log/message_copy\n" +
+                     "collector: native\n" +
+                     "collector_shards: 1\n" +
+                     "collector_concurrency: 4\n" +
+                     "collector_stagger: 0\n" +
+                     "stream_queue_hosts: 256\n" +
+                     "command_timeout: 100\n" +
+                     "cycle_deadline: 0\n" +
+                     "# ^-- 0 for 90% of the check interval\n" +
+                     "poll_fast_interval: 0\n" +
+                     "poll_flap_window: 600\n" +
+                     "threshold_refresh_interval: 600\n" +
+                     "threshold_refresh_unknown_hosts: True\n" +
+                     "threshold_source: native\n" +
+                     "threshold_merge: most\n" +
+                     "queue_states: False\n" +
+                     "snapshot_file: \"\"\n" +
+                     "# e.g. snapshot_file: /var/lib/sge_to_icinga/snapshot.pickle\n" +
+                     "snapshot_interval: 600\n" +
+                     "rollup_host: \"\"\n" +
+                     "rollup_thresholds: []\n" +
+                     "# e.g. rollup_thresholds:\n" +
+                     "#        - { service: micproblems, aggregate: critical, relop: \">=\", value: 5 }\n" +
+                     "#        - { service: uncontactable, aggregate: fraction, relop: \">\", value: 0.05 }\n" +
+                     "rollup_sample_hosts: 0\n" +
+                     "# ^-- 0 works the min/percentiles/max out over every host; on a big cluster,\n" +
+                     "#     a number of hosts to work them out over a sample of instead\n" +
+                     "cells: []\n" +
+                     "# e.g. cells:\n" +
+                     "#        - { name: legion, sge_root: /opt/sge, sge_cell: legion }\n" +
+                     "#        - { name: grace, sge_root: /opt/sge, sge_cell: grace, check_interval: 300 }\n" +
+                     "delta_only: False\n" +
+                     "freshness_threshold: 600\n" +
+                     "heartbeat_fraction: 0.5\n" +
                      "icinga_server: https://localhost:5665\n" +
                      "icinga_username: icinga\n" +
                      "icinga_password: icinga\n" +
-                     "nsca_dest_host: localhost\n"
+                     "nsca_dest_host: localhost\n" +
+                     "message_device: send_nsca\n" +
+                     "nsca_port: 5667\n" +
+                     "nsca_password: \"\"\n" +
+                     "nsca_encryption: 0\n" +
+                     "nsca_timeout: 10\n" +
+                     "nsca_max_output_length: 512\n" +
+                     "nsca_workers: 4\n" +
+                     "nsca_batch_results: 500\n" +
+                     "nsca_batch_bytes: 65536\n" +
+                     "nsca_batch_timeout: 10\n" +
+                     "nsca_batch_retries: 2\n" +
+                     "spool_directory: \"\"\n" +
+                     "spool_max_bytes: 268435456\n" +
+                     "spool_segment_bytes: 4194304\n" +
+                     "spool_drain_rate: 200\n" +
+                     "spool_drain_interval: 30\n" +
+                     "icinga_api_endpoints: []\n" +
+                     "icinga_api_workers: 8\n" +
+                     "icinga_api_timeout: 10\n" +
+                     "icinga_api_retries: 2\n" +
+                     "icinga_max_parallel: 8\n" +
+                     "icinga_reconcile_interval: 3600\n" +
+                     "icinga_delete_missing_hosts: False\n" +
+                     "icinga_delete_max_fraction: 0.1\n" +
+                     "# ^-- more of Icinga's SGE hosts than this gone at once looks like SGE failing: none are deleted\n" +
+                     "metrics_port: 0\n" +
+                     "metrics_address: \"\"\n"
                      )
     pass
 
@@ -366,12 +2304,31 @@ def main():
     config = get_config_from_file(args.config_file)
     logger.removeHandler(temp_handle)
 
+    global command_timeout
+    command_timeout = config["command_timeout"]
+
+    if args.replay_dir is not None:
+        args.run_in_foreground = True
+        # ^-- so it logs to the terminal
+        configure_logger_returning_log_file_handle(args, config)
+        replay_captures(config, CaptureStore(args.replay_dir),
+                        args.replay_from, args.replay_to, args.replay_device)
+        sys.exit(0)
+
     log_file_handle = configure_logger_returning_log_file_handle(args, config)
     # ^-- this needs to get explicitly preserved by the daemon setup
     #     all other file handles get closed
 
+    capture_store = None
+    if args.record_dir is not None:
+        if config["cells"]:
+            logger.error("--record can't be used with cells.")
+            sys.exit(2)
+        capture_store = CaptureStore(args.record_dir)
+        record_commands(capture_store)
+
     # Only option left is run daemon
-    d = MessageMakerDaemon(config, log_file_handle)
+    d = MessageMakerDaemon(config, log_file_handle, capture_store)
     d.start(args.run_in_foreground)
     sys.stderr.write("Program should not reach this point. Eep.\n")
     sys.exit(2)
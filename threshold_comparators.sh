@@ -1,4 +1,7 @@
 #!/usr/bin/env bash
+set -o pipefail
+# ^-- so a qconf that fails fails the script, rather than passing on
+#     no comparators
 
 qconf -sc \
     | awk ' /^[^#]/ { print $1 " " $4 " " $3 } '